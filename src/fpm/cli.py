@@ -1,7 +1,18 @@
 import os
+import glob
 import click
 import logging
 import tempfile
+import functools
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from click.core import ParameterSource
+
+import numpy as np
 
 from fpm import __version__
 from fpm.generators.dot import visualize_frame_tree
@@ -13,9 +24,13 @@ from fpm.generators.prov import (
     artefact_prov_metadata,
     jsonld_prov_metadata,
 )
+from fpm.contexts import METAMODEL_CONTEXTS, fetch_context, save_context
+from fpm.utils import enable_template_bytecode_cache
+from fpm.geometry import get_geometry_model
 from fpm.graph import (
     build_graph_from_directory,
     get_floorplan_model_name,
+    get_transform_index,
     save_compact_graph,
 )
 from fpm.generators.gazebo import gazebo_world, door_object_models
@@ -32,7 +47,7 @@ from fpm.generators.soprano import (
     get_rci_tasks,
     get_nvl_representation,
 )
-from fpm.generators.scenery import generate_fpm_rep_from_rdf
+from fpm.generators.scenery import generate_fpm_rep_from_rdf, use_ifc_templates
 from textx import generator_for_language_target, metamodel_for_language
 
 from fpm.logging import logger as floorplan_logger
@@ -42,6 +57,8 @@ floorplan_logger.setLevel(logging.DEBUG)
 logger = logging.getLogger("floorplan.cli")
 logger.setLevel(logging.DEBUG)
 
+PIPELINE_TARGETS = ["mesh", "occ-grid", "gazebo", "tasks", "door-keyframes"]
+
 
 def configure(ctx, param, filename):
     if not filename:
@@ -184,13 +201,14 @@ def transform(ctx, model_path, output_path, debug, **kwargs):
             with tempfile.TemporaryDirectory(prefix="scg_") as tmpdir:
                 tmp_path = os.path.join(tmpdir, "json-ld")
                 generator(mm, model, output_path=tmp_path, overwrite=True)
-                g = build_graph_from_directory([tmp_path])
+                g = build_graph_from_directory([tmp_path], workers=1)
             output_file = save_compact_graph(
                 g, output_path, model_base_iri=kwargs.get("model_base_iri")
             )
             res = [output_file]
     except Exception as e:
         logger.error(f"Error transforming model: {e}")
+        raise
 
     jsonld_prov_metadata(model_path, res)
     if kwargs.get("prov"):
@@ -243,14 +261,49 @@ def transform(ctx, model_path, output_path, debug, **kwargs):
     show_default=True,
     help="Default model IRI to be used as a prefix in the PROV models",
 )
-def variation(ctx, model_path, variations, seed, output_path, **kwargs):
+@click.option(
+    "-j",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of worker processes generating variations",
+)
+@click.option(
+    "--transform",
+    is_flag=True,
+    help="Flag to transform each variation into JSON-LD as soon as it is generated",
+)
+@click.option(
+    "-t",
+    "--target",
+    "targets",
+    type=click.Choice(PIPELINE_TARGETS, case_sensitive=False),
+    multiple=True,
+    help="Artefacts to generate for each variation (implies --transform)",
+)
+def variation(
+    ctx,
+    model_path,
+    variations,
+    seed,
+    output_path,
+    workers,
+    transform,
+    targets,
+    **kwargs,
+):
     """Generate FPM model variations from a variation specification
 
     This command generates multiple FPM model variations by applying probability
     distributions to spatial attributes as specified in a .variation file.
 
     Each resulting model follows the format <floorplan_name>_<seed>.fpm and can be
-    further transformed into JSON-LD and other artefacts.
+    further transformed into JSON-LD and other artefacts. With several workers,
+    `--transform` or `--target`, each variation (and its artefacts) is saved to its
+    own folder, <output path>/variation-<index>. The variations are transformed
+    with the default model IRI of `floorplan transform`, unless `--model-base-iri`
+    is given.
 
     This command is equivalent to using TextX's CLI:
 
@@ -268,21 +321,38 @@ def variation(ctx, model_path, variations, seed, output_path, **kwargs):
     if seed is not None:
         logger.info(f"Using seed: {seed}")
 
-    generator = generator_for_language_target("fpm-variation", "fpm")
-    mm = metamodel_for_language("fpm-variation")
-    model = mm.model_from_file(model_path)
-    try:
-        f, res = generator(
-            mm,
-            model,
+    if workers > 1 or transform or targets:
+        # The variations are transformed with the default model IRI of transform,
+        # unless one is given
+        transform_kwargs = dict(kwargs)
+        if ctx.get_parameter_source("model_base_iri") == ParameterSource.DEFAULT:
+            del transform_kwargs["model_base_iri"]
+        f, res = _stream_variations(
+            model_path,
+            variations,
+            seed,
             output_path,
-            overwrite=True,
-            debug=False,
-            variations=variations,
-            seed=seed,
+            workers,
+            transform,
+            targets,
+            **transform_kwargs,
         )
-    except Exception as e:
-        logger.error(f"Error generating variations: {e}")
+    else:
+        generator = generator_for_language_target("fpm-variation", "fpm")
+        mm = metamodel_for_language("fpm-variation")
+        model = mm.model_from_file(model_path)
+        try:
+            f, res = generator(
+                mm,
+                model,
+                output_path,
+                overwrite=True,
+                debug=False,
+                variations=variations,
+                seed=seed,
+            )
+        except Exception as e:
+            logger.error(f"Error generating variations: {e}")
 
     var_prov_metadata(model_path, f, res)
 
@@ -290,6 +360,121 @@ def variation(ctx, model_path, variations, seed, output_path, **kwargs):
         var_prov_generation_graph(model_path, f, res, output_path, **kwargs)
 
 
+@functools.cache
+def _load_variation_model(model_path):
+    mm = metamodel_for_language("fpm-variation")
+    return mm, mm.model_from_file(model_path)
+
+
+def _generate_variation(model_path, output_path, seed, transform, targets, **kwargs):
+    """Generate a single variation (and its artefacts) in a worker process
+
+    The output path must be exclusive to this variation, as the name of the
+    generated model does not depend on the seed
+    """
+    generator = generator_for_language_target("fpm-variation", "fpm")
+    mm, model = _load_variation_model(model_path)
+    os.makedirs(output_path, exist_ok=True)
+    f, res = generator(
+        mm,
+        model,
+        output_path,
+        overwrite=True,
+        debug=False,
+        variations=1,
+        seed=seed,
+    )
+    if transform or targets:
+        for fpm_file in res:
+            _batch_process_model(fpm_file, output_path, targets, **kwargs)
+    return f, res
+
+
+def _stream_variations(
+    model_path, variations, seed, output_path, workers, transform, targets, **kwargs
+):
+    # Each variation gets its own seed, derived deterministically from the base seed
+    seed_seq = np.random.SeedSequence(seed)
+    if seed is None:
+        logger.info(f"Base seed for derived seeds: {seed_seq.entropy}")
+    seeds = seed_seq.generate_state(variations).tolist()
+
+    # Each variation is generated in its own folder, named after its index
+    width = len(str(variations - 1))
+
+    fpm_file = model_path
+    generated_files = list()
+    failed = list()
+    pending = dict()
+
+    def _collect():
+        nonlocal fpm_file
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            var_seed = pending.pop(future)
+            try:
+                fpm_file, res = future.result()
+                collisions = set(res).intersection(generated_files)
+                if collisions:
+                    raise RuntimeError(
+                        "Overwrote {}".format(", ".join(sorted(collisions)))
+                    )
+                generated_files.extend(res)
+                logger.info(
+                    f"[{len(generated_files)}/{variations}] Generated variation with seed {var_seed}"
+                )
+            except Exception as e:
+                logger.error(f"Error generating variation with seed {var_seed}: {e}")
+                failed.append(var_seed)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for i, var_seed in enumerate(seeds):
+            # Bound the variations in flight, so memory does not grow with their number
+            if len(pending) >= 2 * workers:
+                _collect()
+            var_output_path = os.path.join(
+                output_path, "variation-{:0{}d}".format(i, width)
+            )
+            future = executor.submit(
+                _generate_variation,
+                model_path,
+                var_output_path,
+                var_seed,
+                transform,
+                targets,
+                **kwargs,
+            )
+            pending[future] = var_seed
+        while pending:
+            _collect()
+
+    if failed:
+        logger.error(f"{len(failed)} of {variations} variations failed")
+    return fpm_file, generated_files
+
+
+@floorplan.command(
+    name="fetch-contexts",
+    short_help="Fetch the JSON-LD contexts of the metamodels for offline use",
+)
+@click.option(
+    "-o",
+    "--output-path",
+    type=click.Path(resolve_path=True),
+    default=None,
+    help="Context store to save the contexts to (default: the user cache)",
+)
+def fetch_contexts(output_path):
+    """Fetch the JSON-LD contexts of the metamodels into a local context store
+
+    The contexts are then loaded from the store when compacting JSON-LD models, without network access.
+    """
+    for url in METAMODEL_CONTEXTS:
+        document = fetch_context(url)
+        path = save_context(url, document, output_path)
+        logger.info("Saved %s to %s", url, path)
+
+
 @floorplan.command(
     short_help="Generate FPM JSON-LD models from an IFCLD model",
 )
@@ -313,12 +498,37 @@ def variation(ctx, model_path, variations, seed, output_path, **kwargs):
     "--debug",
     is_flag=True,
 )
-def ifc(ctx, model_path, output_path, debug, **kwargs):
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    show_default=True,
+    help="Cache the compiled templates on disk",
+)
+@click.option(
+    "--use-templates",
+    is_flag=True,
+    help="Render all the FPM nodes with the Jinja templates instead of building them",
+)
+@click.option(
+    "-j",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of worker processes (default: number of CPUs)",
+)
+def ifc(
+    ctx, model_path, output_path, debug, use_cache, use_templates, workers, **kwargs
+):
 
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    generate_fpm_rep_from_rdf(model_path, output_path, debug)
+    if use_cache:
+        enable_template_bytecode_cache()
+    use_ifc_templates(use_templates)
+
+    generate_fpm_rep_from_rdf(model_path, output_path, debug, workers)
 
 
 @floorplan.group(
@@ -372,16 +582,34 @@ def ifc(ctx, model_path, output_path, debug, **kwargs):
     show_default=True,
     help="Default model IRI to be used as a prefix in the PROV models",
 )
-def generate(ctx, inputs, **kwargs):
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    show_default=True,
+    help="Reuse a snapshot of the parsed models if the input files are unchanged, "
+    "and cache the compiled templates on disk",
+)
+@click.option(
+    "-j",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of worker processes parsing the input models",
+)
+def generate(ctx, inputs, use_cache, workers, **kwargs):
     """Generate execution artefacts from JSON-LD models"""
 
     logger.debug("generate command arguments: inputs: %s, kwargs: %s", inputs, kwargs)
-    _load_graph_to_ctx(ctx, inputs)
+    if use_cache:
+        enable_template_bytecode_cache()
+    _load_graph_to_ctx(ctx, inputs, use_cache, workers)
 
 
-def _load_graph_to_ctx(ctx, input_paths):
+def _load_graph_to_ctx(ctx, input_paths, use_cache=False, workers=1):
     logger.debug("Loading graph from paths: %s", input_paths)
-    g = build_graph_from_directory(input_paths)
+    g = build_graph_from_directory(input_paths, use_cache=use_cache, workers=workers)
     try:
         model_name = get_floorplan_model_name(g)
     except ValueError as e:
@@ -392,6 +620,51 @@ def _load_graph_to_ctx(ctx, input_paths):
     ctx.obj["g"] = g
 
 
+@generate.command(
+    name="all", short_help="Generate several artefacts from a single model load"
+)
+@click.pass_context
+@click.option(
+    "-t",
+    "--target",
+    "targets",
+    type=click.Choice(PIPELINE_TARGETS, case_sensitive=False),
+    default=PIPELINE_TARGETS,
+    show_default=True,
+    multiple=True,
+    help="Artefacts to generate",
+)
+def generate_all(ctx, targets):
+    """Generate several artefacts with the default options of their commands
+
+    The geometry model and the frame transformations are extracted once from the
+    graph and shared by all generators, which then run one after the other. Use the
+    individual commands (which can also be chained) to change their options.
+
+    The SOPRANO artefacts, e.g. the polyline representation of `soprano-poly`, are
+    only generated by their own commands.
+    """
+    g = ctx.obj["g"]
+    logger.info("Building shared indexes for: %s", ", ".join(targets))
+    get_transform_index(g)
+    get_geometry_model(g)
+
+    # Invoked from the generate group, as if the commands were chained
+    group_ctx = ctx.parent
+    failed = list()
+    for target in targets:
+        cmd = group_ctx.command.get_command(group_ctx, target)
+        try:
+            group_ctx.invoke(cmd)
+            logger.info("Generated %s", target)
+        except Exception as e:
+            logger.error("Error generating %s: %s", target, e)
+            failed.append(target)
+
+    if failed:
+        raise click.ClickException("Failed to generate: {}".format(", ".join(failed)))
+
+
 @generate.command(short_help="Generate a 3D-mesh of the floorplan")
 @click.pass_context
 @click.option(
@@ -401,12 +674,27 @@ def _load_graph_to_ctx(ctx, input_paths):
 )
 @click.option(
     "--format",
-    type=click.Choice(["stl", "gltf"], case_sensitive=False),
+    type=click.Choice(["stl", "gltf", "glb"], case_sensitive=False),
     default=["stl"],
     show_default=True,
     multiple=True,
     help="Output format of the 3D mesh",
 )
+@click.option(
+    "--backend",
+    type=click.Choice(["blender", "native"], case_sensitive=False),
+    default="blender",
+    show_default=True,
+    help="Mesh backend: Blender, or native writers that run without Blender",
+)
+@click.option(
+    "--blender-processes",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of Blender processes, each meshing a partition of the elements, "
+    "which are then written with the native writers",
+)
 def mesh(ctx, **kwargs):
     """Generate a 3D-mesh in STL or gltF 2.0 format"""
     output_file = get_3d_mesh(**ctx.obj, **ctx.parent.params, **kwargs)
@@ -545,6 +833,57 @@ def gazebo(ctx, **kwargs):
     show_default=True,
     help="Resolution of the pgm file in m/pixel",
 )
+@click.option(
+    "--pyramid",
+    type=click.FLOAT,
+    multiple=True,
+    help="Additional resolutions (in m/pixel) to save from the same geometry, as <model name>_<resolution>",
+)
+@click.option(
+    "--slice-height",
+    "slice_heights",
+    type=click.FLOAT,
+    multiple=True,
+    help="Additional laser heights (in m) to save from the same geometry, as <model name>_z<height>",
+)
+@click.option(
+    "--voxel-grid/--no-voxel-grid",
+    default=False,
+    show_default=True,
+    help="Also save a bit-packed 3D occupancy grid as <model name>_voxels.npy",
+)
+@click.option(
+    "--voxel-height",
+    type=click.FLOAT,
+    default=None,
+    help="Height of the voxels in m, defaults to the resolution",
+)
+@click.option(
+    "--distance-field/--no-distance-field",
+    default=False,
+    show_default=True,
+    help="Also save the distance (in m) of each cell to the nearest obstacle as <model name>_distance.npy",
+)
+@click.option(
+    "--inflation-radius",
+    type=click.FLOAT,
+    multiple=True,
+    help="Save a Nav2 costmap with the obstacles inflated up to this radius (in m), as <model name>_costmap_<radius>",
+)
+@click.option(
+    "--inscribed-radius",
+    type=click.FLOAT,
+    default=0.0,
+    show_default=True,
+    help="Inscribed radius of the robot (in m) for the inflated costmaps",
+)
+@click.option(
+    "--cost-scaling-factor",
+    type=click.FLOAT,
+    default=3.0,
+    show_default=True,
+    help="Exponential decay of the cost with the distance to obstacles in the inflated costmaps",
+)
 @click.option(
     "--occupied-threshold",
     type=click.FLOAT,
@@ -602,6 +941,12 @@ def gazebo(ctx, **kwargs):
     help="Which element frames to visualize",
     multiple=True,
 )
+@click.option(
+    "--tile-size",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Build the grid in a memory-mapped file and also save it as tiles of this size (in pixels)",
+)
 def occ_grid(ctx, **kwargs):
     """Generate the occupancy grid map of the floorplan"""
     logger.info("Generating occupancy grid...")
@@ -774,20 +1119,12 @@ def soprano_hdt(ctx, **kwargs):
     if kwargs.get("ros_frames"):
         gen_ros_frames(**ctx.obj, **ctx.parent.params, **kwargs)
     if kwargs.get("visualize"):
-        logger.info("Visualizing milling task in the occupancy grid")
+        logger.info("Visualizing milling task and frames on the occupancy grid")
         get_occ_grid(
             **ctx.obj,
             **ctx.parent.params,
             **kwargs,
             milling_task=tasks,
-            source="bim",
-            save=False,
-        )
-        logger.info("Visualizing frames on occupancy grid")
-        get_occ_grid(
-            **ctx.obj,
-            **ctx.parent.params,
-            **kwargs,
             visualize_frames=["outlet", "duct", "wall"],
             source="bim",
             save=False,
@@ -825,6 +1162,157 @@ def visualize(ctx, inputs, output_path, **kwargs):
     )
 
 
+def _get_batch_models(models):
+    model_paths = list()
+    for m in models:
+        if os.path.isdir(m):
+            model_paths.extend(sorted(glob.glob(os.path.join(m, "*.fpm"))))
+        else:
+            model_paths.extend(sorted(glob.glob(m)))
+    return list(dict.fromkeys(model_paths))
+
+
+def _get_batch_model_names(model_paths):
+    """Output folder names of the models, unique among them
+
+    Models are named after their file, or after their path relative to the common
+    folder of the models if several of them have the same file name.
+    """
+    names = [os.path.splitext(os.path.basename(m))[0] for m in model_paths]
+    duplicates = {n for n in names if names.count(n) > 1}
+    if not duplicates:
+        return dict(zip(model_paths, names))
+
+    common_path = os.path.commonpath([os.path.dirname(m) for m in model_paths])
+    return {
+        m: (
+            os.path.splitext(os.path.relpath(m, common_path))[0]
+            if name in duplicates
+            else name
+        )
+        for m, name in zip(model_paths, names)
+    }
+
+
+def _batch_process_model(model_path, output_path, targets, model_name=None, **kwargs):
+    """Transform a model and generate its artefacts in a worker process"""
+    if model_name is None:
+        model_name = os.path.splitext(os.path.basename(model_path))[0]
+    model_output_path = os.path.join(output_path, model_name)
+    jsonld_path = os.path.join(model_output_path, "json-ld")
+    os.makedirs(jsonld_path, exist_ok=True)
+
+    args = ["transform", "-m", model_path, "-o", jsonld_path]
+    if kwargs.get("model_base_iri"):
+        args.extend(["--model-base-iri", kwargs["model_base_iri"]])
+    if kwargs.get("prov"):
+        args.append("--prov")
+    # Errors are raised as they are, instead of being reported by click
+    floorplan.main(args, standalone_mode=False)
+    if targets:
+        args = ["generate", "-i", jsonld_path, "-o", model_output_path, "-j", "1"]
+        if kwargs.get("prov"):
+            args.append("--prov")
+        args.extend(["all", *[a for t in targets for a in ("-t", t)]])
+        floorplan.main(args, standalone_mode=False)
+
+    return model_output_path
+
+
+@floorplan.command(short_help="Transform and generate artefacts for many FPM models")
+@click.pass_context
+@click.option(
+    "-m",
+    "--models",
+    required=True,
+    multiple=True,
+    help="Directory with .fpm models or glob pattern of the models to process",
+)
+@click.option(
+    "-o",
+    "--output-path",
+    type=click.Path(resolve_path=True),
+    default=os.path.join("."),
+    help="Output path for generated artefacts, one folder per model",
+)
+@click.option(
+    "-t",
+    "--target",
+    "targets",
+    type=click.Choice(PIPELINE_TARGETS, case_sensitive=False),
+    multiple=True,
+    help="Artefacts to generate after the transformation into JSON-LD",
+)
+@click.option(
+    "-j",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of worker processes (default: number of CPUs)",
+)
+@click.option(
+    "--prov",
+    is_flag=True,
+    help="Flag to whether to generate a PROV graph of this activity",
+)
+@click.option(
+    "--model-base-iri",
+    type=click.STRING,
+    default="https://secorolab.github.io/models/floorplan/",
+    show_default=True,
+    help="Default model IRI to be used as a prefix in the PROV models",
+)
+def batch(ctx, models, output_path, targets, workers, **kwargs):
+    """Transform many FPM models into JSON-LD and generate their artefacts
+
+    Each model is processed in a worker process, equivalent to running:
+
+    ```
+    floorplan transform -m <model> -o <output path>/<model name>/json-ld
+    floorplan generate -i <output path>/<model name>/json-ld -o <output path>/<model name> all -t <target>
+    ```
+
+    The `--prov` option is passed to both commands, and `--model-base-iri` to the
+    transformation. Models with the same file name are saved to folders named after
+    their path relative to the common folder of the models.
+
+    Errors in one model do not stop the batch; the failed models are reported at the end.
+    """
+    model_paths = _get_batch_models(models)
+    if not model_paths:
+        raise click.ClickException("No models found in {}".format(", ".join(models)))
+
+    total = len(model_paths)
+    logger.info("Processing %d models with targets: %s", total, ", ".join(targets))
+    model_names = _get_batch_model_names(model_paths)
+    failed = dict()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                _batch_process_model,
+                m,
+                output_path,
+                targets,
+                model_name=model_names[m],
+                **kwargs,
+            ): m
+            for m in model_paths
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            model_path = futures[future]
+            try:
+                future.result()
+                logger.info("[%d/%d] Processed %s", i, total, model_path)
+            except Exception as e:
+                logger.error("[%d/%d] Error processing %s: %s", i, total, model_path, e)
+                failed[model_path] = e
+
+    if failed:
+        for model_path, e in failed.items():
+            logger.error("Failed: %s (%s)", model_path, e)
+        raise click.ClickException("{} of {} models failed".format(len(failed), total))
+
+
 if __name__ == "__main__":
     import sys
 
@@ -0,0 +1,485 @@
+import json
+import functools
+import collections
+
+from pyld import jsonld
+from rdflib import RDF, BNode, Graph, Literal, URIRef
+from rdflib.namespace import XSD
+
+from fpm.contexts import get_jsonld_options, get_missing_context
+
+try:
+    from pyld.iri_resolver import unresolve
+except ImportError:  # pyld < 3
+
+    def unresolve(absolute_iri, base_iri=""):
+        return jsonld.remove_base(base_iri, absolute_iri)
+
+
+# Datatypes of the literals written as native JSON values, as rdflib's serializer does
+NATIVE_TYPES = {XSD.boolean, XSD.integer, XSD.double, XSD.string}
+
+# Looking up terms in rdflib's namespaces is slow, so these are resolved once
+RDF_FIRST, RDF_REST, RDF_NIL, RDF_TYPE, RDF_LIST = (
+    RDF.first,
+    RDF.rest,
+    RDF.nil,
+    RDF.type,
+    RDF.List,
+)
+
+
+class TermMap:
+    """Compaction rules of a JSON-LD context, precomputed once
+
+    Follows the term selection and value compaction of the JSON-LD compaction
+    algorithm (as implemented by pyld) for terms with @id, @vocab or datatype
+    coercion and with @list or @set containers, which is what the metamodel
+    contexts use. Other containers, language maps and reverse terms are not
+    selected, so their properties are written with compact IRIs instead.
+    Contexts scoped to types or properties are not applied: write_compact leaves
+    the contexts that define them to pyld.
+    """
+
+    def __init__(self, context):
+        processor = jsonld.JsonLdProcessor()
+        try:
+            active_ctx = processor.process_context(
+                {"mappings": {}}, context, get_jsonld_options()
+            )
+        except jsonld.JsonLdError as e:
+            raise get_missing_context(e) or e
+        self.mappings = {
+            term: definition
+            for term, definition in active_ctx["mappings"].items()
+            if definition is not None and definition.get("@id")
+        }
+        self.has_scoped_contexts = any(
+            "@context" in definition for definition in self.mappings.values()
+        )
+        self.base = active_ctx.get("@base")
+        self.vocab = active_ctx.get("@vocab")
+        self.default_language = active_ctx.get("@language", "@none")
+        self.has_default_language = "@language" in active_ctx
+        self.inverse = self._get_inverse_context()
+        self._iris = dict()
+        self._terms = dict()
+
+    def _get_inverse_context(self):
+        inverse = dict()
+        # Terms are preferred by shortest and then lexicographically least
+        for term in sorted(self.mappings, key=lambda t: (len(t), t)):
+            mapping = self.mappings[term]
+            if mapping.get("reverse"):
+                continue
+            container = "".join(sorted(mapping.get("@container", ["@none"])))
+            entry = inverse.setdefault(mapping["@id"], dict()).setdefault(
+                container, {"@language": {}, "@type": {}, "@any": {}}
+            )
+            entry["@any"].setdefault("@none", term)
+            if mapping.get("@type") == "@none":
+                entry["@type"].setdefault("@none", term)
+                entry["@language"].setdefault("@none", term)
+            elif "@type" in mapping:
+                entry["@type"].setdefault(mapping["@type"], term)
+            elif "@language" in mapping:
+                language = mapping["@language"]
+                entry["@language"].setdefault(
+                    "@null" if language is None else language, term
+                )
+            else:
+                entry["@language"].setdefault(self.default_language, term)
+                entry["@type"].setdefault("@none", term)
+                entry["@language"].setdefault("@none", term)
+        return inverse
+
+    def compact_iri(self, iri, vocab=False):
+        key = (iri, vocab)
+        compacted = self._iris.get(key)
+        if compacted is None:
+            compacted = self._compact_iri(iri, vocab)
+            self._iris[key] = compacted
+        return compacted
+
+    def _compact_iri(self, iri, vocab, select=True):
+        if vocab:
+            if select:
+                term = self.select_term(
+                    iri, ["@set", "@none"], "@type", ["@id", "@none"]
+                )
+                if term is not None:
+                    return term
+            if self.vocab and iri.startswith(self.vocab) and iri != self.vocab:
+                suffix = iri[len(self.vocab) :]
+                if suffix not in self.mappings:
+                    return suffix
+
+        candidate = None
+        for term, definition in self.mappings.items():
+            prefix = definition["@id"]
+            if ":" in term or prefix == iri or not iri.startswith(prefix):
+                continue
+            curie = term + ":" + iri[len(prefix) :]
+            usable = (definition.get("_prefix") and curie not in self.mappings) or (
+                self.mappings.get(curie, {}).get("@id") == iri
+            )
+            if usable and (
+                candidate is None or (len(curie), curie) < (len(candidate), candidate)
+            ):
+                candidate = curie
+        if candidate is not None:
+            return candidate
+
+        if not vocab and self.base:
+            return unresolve(iri, self.base)
+        return iri
+
+    def select_term(self, iri, containers, type_or_language, prefs):
+        container_map = self.inverse.get(iri)
+        if container_map is None:
+            return None
+        for container in containers:
+            entry = container_map.get(container)
+            if entry is None:
+                continue
+            for pref in prefs:
+                term = entry[type_or_language].get(pref)
+                if term is not None:
+                    return term
+        return None
+
+    def get_term(self, iri, value):
+        """Term (or compact IRI) of a property for an expanded value"""
+        key = (iri, _value_signature(value, self))
+        term = self._terms.get(key)
+        if term is None:
+            term = self._select_property_term(iri, *key[1])
+            if term is None:
+                # No term matches the value, so fall back to @vocab or a compact IRI
+                term = self._compact_iri(iri, vocab=True, select=False)
+            self._terms[key] = term
+        return term
+
+    def _select_property_term(self, iri, kind, type_or_language, preferred, is_term):
+        containers = []
+        if kind == "@list":
+            containers.append("@list")
+        else:
+            containers.append("@set")
+        containers.append("@none")
+
+        if kind == "@id":
+            prefs = ["@vocab", "@id"] if is_term else ["@id", "@vocab"]
+        else:
+            prefs = [preferred]
+        prefs.append("@none")
+        return self.select_term(iri, containers, type_or_language, prefs)
+
+    def compact_value(self, term, value):
+        mapping = self.mappings.get(term, {})
+        coercion = mapping.get("@type")
+        if "@list" in value:
+            if "@list" in mapping.get("@container", []):
+                return [self.compact_value(term, v) for v in value["@list"]]
+            # Lists nested in a list are only coerced by a term with a @list container
+            items = [
+                self.compact_value(None if "@list" in v else term, v)
+                for v in value["@list"]
+            ]
+            return {"@list": items}
+
+        if "@id" in value:
+            compacted = self.compact_iri(value["@id"], vocab=coercion == "@vocab")
+            if coercion in ("@id", "@vocab"):
+                return compacted
+            return {"@id": compacted}
+
+        if coercion != "@none":
+            if "@type" in value and value["@type"] == coercion:
+                return value["@value"]
+            if "@language" in value and value["@language"] == mapping.get("@language"):
+                return value["@value"]
+            null_language = "@language" in mapping and mapping["@language"] is None
+            if len(value) == 1 and (
+                not self.has_default_language
+                or not isinstance(value["@value"], str)
+                or null_language
+            ):
+                return value["@value"]
+
+        compacted = dict()
+        if "@type" in value:
+            compacted["@type"] = self.compact_iri(value["@type"], vocab=True)
+        elif "@language" in value:
+            compacted["@language"] = value["@language"]
+        compacted["@value"] = value["@value"]
+        return compacted
+
+    def compact_node(self, node):
+        """Compact an expanded node object whose values are references, values or lists"""
+        compacted = dict()
+        if "@id" in node:
+            compacted["@id"] = self.compact_iri(node["@id"])
+        types = [self.compact_iri(t, vocab=True) for t in node.get("@type", [])]
+        if types:
+            compacted["@type"] = types[0] if len(types) == 1 else types
+
+        for iri in sorted(k for k in node if not k.startswith("@")):
+            for value in node[iri]:
+                term = self.get_term(iri, value)
+                container = self.mappings.get(term, {}).get("@container", [])
+                as_array = "@set" in container or "@list" in container
+                v = self.compact_value(term, value)
+                if term not in compacted:
+                    compacted[term] = [v] if as_array and "@list" not in value else v
+                elif "@list" in container:
+                    raise ValueError(
+                        "Property {} of {} has more than one list".format(
+                            term, node.get("@id")
+                        )
+                    )
+                else:
+                    values = compacted[term]
+                    if not isinstance(values, list):
+                        values = compacted[term] = [values]
+                    values.append(v)
+        return compacted
+
+
+def _value_signature(value, term_map):
+    """Kind, type or language and preferred value of an expanded value for term selection"""
+    if "@list" in value:
+        items = value["@list"]
+        if not items:
+            return ("@list", "@any", "@none", False)
+        common_language, common_type = None, None
+        for item in items:
+            item_language, item_type = "@none", "@none"
+            if "@value" in item:
+                if "@language" in item:
+                    item_language = item["@language"]
+                elif "@type" in item:
+                    item_type = item["@type"]
+                else:
+                    item_language = "@null"
+            else:
+                item_type = "@id"
+            if common_language is None:
+                common_language = item_language
+            elif item_language != common_language and "@value" in item:
+                common_language = "@none"
+            if common_type is None:
+                common_type = item_type
+            elif item_type != common_type:
+                common_type = "@none"
+        if common_type != "@none":
+            return ("@list", "@type", common_type, False)
+        return ("@list", "@language", common_language, False)
+
+    if "@id" in value:
+        # References to IRIs that compact to a term prefer @vocab coercion
+        term = term_map.compact_iri(value["@id"], vocab=True)
+        is_term = term_map.mappings.get(term, {}).get("@id") == value["@id"]
+        return ("@id", "@type", "@id", is_term)
+    if "@language" in value:
+        return ("@value", "@language", value["@language"], False)
+    if "@type" in value:
+        return ("@value", "@type", value["@type"], False)
+    return ("@value", "@language", "@null", False)
+
+
+@functools.lru_cache(maxsize=16)
+def _get_term_map(context_key):
+    return TermMap(json.loads(context_key))
+
+
+def get_term_map(context):
+    """Get the (cached) term map of a context"""
+    if isinstance(context, dict) and "@context" in context:
+        context = context["@context"]
+    return _get_term_map(json.dumps(context, sort_keys=True))
+
+
+def _node_id(node):
+    if isinstance(node, BNode):
+        return node.n3()
+    return str(node)
+
+
+def _literal_value(literal: Literal):
+    value = str(literal)
+    if literal.datatype in NATIVE_TYPES:
+        native = literal.toPython()
+        if isinstance(native, (bool, int, float, str)):
+            value = native
+    if literal.datatype is not None:
+        return {"@type": str(literal.datatype), "@value": value}
+    if literal.language:
+        return {"@language": literal.language, "@value": value}
+    return {"@value": value}
+
+
+def _get_list_items(properties, references, node, list_nodes):
+    """Items of a well-formed RDF list, or None if the node is not one
+
+    As in pyld's conversion from RDF, the nodes of the list must be blank nodes
+    referenced once and only have rdf:first and rdf:rest (and an rdf:List type).
+    """
+    items = list()
+    seen = set()
+    while node != RDF_NIL:
+        if not isinstance(node, BNode) or node in seen or references[node] != 1:
+            return None
+        first, rest = None, None
+        for p, o in properties.get(node, ()):
+            if p == RDF_FIRST and first is None:
+                first = o
+            elif p == RDF_REST and rest is None:
+                rest = o
+            elif p != RDF_TYPE or o != RDF_LIST:
+                return None
+        if first is None or rest is None:
+            return None
+        seen.add(node)
+        items.append(first)
+        node = rest
+    list_nodes.update(seen)
+    return items
+
+
+def _expanded_value(properties, references, o, list_nodes):
+    if isinstance(o, Literal):
+        return _literal_value(o)
+    if o == RDF_NIL or isinstance(o, BNode):
+        items = _get_list_items(properties, references, o, list_nodes)
+        if items is not None:
+            return {
+                "@list": [
+                    _expanded_value(properties, references, i, list_nodes)
+                    for i in items
+                ]
+            }
+    return {"@id": _node_id(o)}
+
+
+def expand_graph(g: Graph):
+    """Expanded JSON-LD node objects of a graph, without serializing it
+
+    The triples are indexed by subject, taking the predicates and objects of each
+    subject in the order of the graph's subject index, as rdflib's JSON-LD
+    serializer does: iterating over the whole graph yields them in hash order,
+    which changes between runs. RDF lists are written as @list objects and their
+    nodes are not included. The nodes are sorted by @id.
+    """
+    properties = dict()
+    references = collections.Counter()
+    for s in dict.fromkeys(g.subjects()):
+        predicate_objects = properties[s] = list(g.predicate_objects(s))
+        for p, o in predicate_objects:
+            if isinstance(o, BNode):
+                references[o] += 1
+
+    list_nodes = set()
+    nodes = list()
+    for s, predicate_objects in properties.items():
+        node = {"@id": _node_id(s)}
+        for p, o in predicate_objects:
+            if p == RDF_TYPE and isinstance(o, URIRef):
+                node.setdefault("@type", list()).append(str(o))
+            else:
+                value = _expanded_value(properties, references, o, list_nodes)
+                node.setdefault(str(p), list()).append(value)
+        nodes.append((s, node))
+    nodes = [node for s, node in nodes if s not in list_nodes]
+    return sorted(nodes, key=lambda node: node["@id"])
+
+
+def flatten_expanded(expanded):
+    """Node map of an expanded JSON-LD document, as pyld's flatten does
+
+    Embedded nodes are replaced by references, nodes with the same @id are merged
+    and blank nodes are relabelled in document order.
+    """
+    node_map = dict()
+    bnodes = dict()
+
+    def node_id(node_id=None):
+        if node_id is None or node_id.startswith("_:"):
+            key = node_id if node_id is not None else object()
+            if key not in bnodes:
+                bnodes[key] = "_:b{}".format(len(bnodes))
+            return bnodes[key]
+        return node_id
+
+    def add_value(values, value):
+        if "@list" in value or value not in values:
+            values.append(value)
+
+    def flatten_value(value):
+        if "@list" in value:
+            return {"@list": [flatten_value(v) for v in value["@list"]]}
+        if "@value" in value:
+            return value
+        return {"@id": flatten_node(value)}
+
+    def flatten_node(element):
+        i = node_id(element.get("@id"))
+        node = node_map.setdefault(i, {"@id": i})
+        for t in element.get("@type", []):
+            types = node.setdefault("@type", list())
+            t = node_id(t) if t.startswith("_:") else t
+            if t not in types:
+                types.append(t)
+        for key, values in element.items():
+            if key.startswith("@"):
+                continue
+            node_values = node.setdefault(key, list())
+            for value in values:
+                add_value(node_values, flatten_value(value))
+        return i
+
+    for element in expanded:
+        if "@graph" in element:
+            for e in element["@graph"]:
+                flatten_node(e)
+            element = {k: v for k, v in element.items() if k != "@graph"}
+            if len(element) <= 1:
+                continue
+        flatten_node(element)
+
+    # Nodes that were only referenced are not included
+    return [node_map[k] for k in sorted(node_map) if len(node_map[k]) > 1]
+
+
+def write_compact(nodes, context):
+    """Compacted JSON-LD document of expanded (flat) node objects"""
+    term_map = get_term_map(context)
+    if isinstance(context, dict) and "@context" in context:
+        context = context["@context"]
+    if term_map.has_scoped_contexts:
+        try:
+            return jsonld.compact(nodes, {"@context": context}, get_jsonld_options())
+        except jsonld.JsonLdError as e:
+            raise get_missing_context(e) or e
+    graph = [term_map.compact_node(node) for node in nodes]
+    if len(graph) == 1:
+        return {"@context": context, **graph[0]}
+    return {"@context": context, "@graph": graph}
+
+
+def compact_graph(g: Graph, context):
+    """Compacted JSON-LD document of an rdflib graph"""
+    return write_compact(expand_graph(g), context)
+
+
+def compact_nodes(nodes, context):
+    """Compacted and flattened JSON-LD document of nodes written in a context"""
+    if isinstance(context, dict) and "@context" in context:
+        context = context["@context"]
+    try:
+        expanded = jsonld.expand(
+            {"@graph": nodes, "@context": context}, get_jsonld_options()
+        )
+    except jsonld.JsonLdError as e:
+        raise get_missing_context(e) or e
+    return write_compact(flatten_expanded(expanded), context)
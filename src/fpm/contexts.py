@@ -0,0 +1,132 @@
+import os
+import copy
+import json
+import logging
+import tempfile
+import functools
+from urllib.parse import urlsplit
+
+from pyld import jsonld
+
+from fpm import snapshot
+
+logger = logging.getLogger("floorplan.contexts")
+logger.setLevel(logging.DEBUG)
+
+# Version of the layout of the context store
+CONTEXT_STORE_VERSION = 1
+CONTEXT_CACHE_SIZE = 64
+
+BUNDLED_CONTEXTS_PATH = os.path.join(os.path.dirname(__file__), "contexts")
+
+METAMODEL_CONTEXTS = [
+    "http://comp-rob2b.github.io/metamodels/qudt.json",
+    "https://comp-rob2b.github.io/metamodels/geometry/coordinates.json",
+    "https://comp-rob2b.github.io/metamodels/geometry/spatial-relations.json",
+    "https://comp-rob2b.github.io/metamodels/geometry/structural-entities.json",
+    "https://secorolab.github.io/metamodels/geometry/coordinates.json",
+    "https://secorolab.github.io/metamodels/geometry/polytope.json",
+    "https://secorolab.github.io/metamodels/floorplan/floorplan.json",
+    "https://secorolab.github.io/metamodels/acceptance-criteria/bdd/environment.json",
+]
+
+
+class ContextNotFoundError(LookupError):
+    """A context is not in the context store and could not be fetched"""
+
+
+def get_context_dirs():
+    """Directories of the context store, in lookup order
+
+    The contexts bundled with the package come first, followed by the ones fetched
+    to $FPM_CACHE_DIR/contexts (see fpm.snapshot.get_cache_dir)
+    """
+    cache_dir = os.path.join(
+        snapshot.get_cache_dir(), "contexts", "v{}".format(CONTEXT_STORE_VERSION)
+    )
+    return [BUNDLED_CONTEXTS_PATH, cache_dir]
+
+
+def get_context_path(context_dir, url):
+    """Path of a context in the store, mirroring its host and path (without the scheme)"""
+    parts = urlsplit(url)
+    return os.path.join(context_dir, parts.netloc, *parts.path.strip("/").split("/"))
+
+
+def save_context(url, document, context_dir=None):
+    """Save a context document to the store, writing to a temporary file first"""
+    if context_dir is None:
+        context_dir = get_context_dirs()[-1]
+    path = get_context_path(context_dir, url)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(document, f, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not save context %s to %s: %s", url, context_dir, e)
+    return path
+
+
+def fetch_context(url):
+    """Fetch a context with the default (remote) document loader of pyld"""
+    remote_doc = jsonld.get_document_loader()(url, {})
+    document = remote_doc.get("document")
+    if isinstance(document, str):
+        document = json.loads(document)
+    return document
+
+
+@functools.lru_cache(maxsize=CONTEXT_CACHE_SIZE)
+def load_context(url):
+    """Load a context from the store, fetching it into the user cache the first time"""
+    context_dirs = get_context_dirs()
+    for context_dir in context_dirs:
+        path = get_context_path(context_dir, url)
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+
+    logger.info("Context %s is not in the context store, fetching it", url)
+    try:
+        document = fetch_context(url)
+    except Exception as e:
+        raise ContextNotFoundError(
+            "Context {} is not in the context store ({}) and could not be fetched, "
+            "save it there with `floorplan fetch-contexts`".format(
+                url, ", ".join(context_dirs)
+            )
+        ) from e
+    save_context(url, document)
+    return document
+
+
+def get_missing_context(error):
+    """ContextNotFoundError behind an error of pyld, if a context was missing"""
+    while error is not None:
+        if isinstance(error, ContextNotFoundError):
+            return error
+        error = getattr(error, "cause", None) or error.__cause__
+    return None
+
+
+def document_loader(url, options=None):
+    """pyld document loader that serves the contexts from the local store
+
+    The documents are tagged as static, so that pyld keeps the resolved and
+    processed contexts in its shared LRU cache across compactions.
+    """
+    return {
+        "contextUrl": None,
+        "documentUrl": url,
+        # pyld resolves relative URLs in place
+        "document": copy.deepcopy(load_context(url)),
+        "tag": "static",
+    }
+
+
+def get_jsonld_options(**options):
+    """Options for pyld's API functions to resolve the contexts from the context store"""
+    options.setdefault("documentLoader", document_loader)
+    return options
@@ -0,0 +1,303 @@
+"""Native builders of the FPM JSON-LD nodes of the IFC templates
+
+Each builder is registered for a template in templates/ifc, takes the same variables
+and returns the same nodes as rendering the template and loading the JSON, without
+the round trip through text. See fpm.generators.scenery.render_ifc_template.
+"""
+
+from fpm.graph import get_list_items
+from ifcld.interpreters.namespaces import IFC_CONCEPTS
+
+NODE_BUILDERS = dict()
+
+POINT_TYPE = ["3D", "Euclidean", "Point"]
+POSITION_COORD_TYPE = ["PositionReference", "PositionCoordinate", "VectorXYZ"]
+
+
+def node_builder(template_path):
+    """Register a builder for the nodes of a template"""
+
+    def register(builder):
+        NODE_BUILDERS[template_path] = builder
+        return builder
+
+    return register
+
+
+def _number(value):
+    """JSON number of a value written by a template (integers stay integers)"""
+    text = str(value)
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def _get_numbers(g, node, *path):
+    for predicate in path:
+        node = g.value(node, predicate)
+    return [_number(v) for v in get_list_items(g, node)]
+
+
+def _point_nodes(point_id, element_id, coordinates, length_unit, frame_id=None):
+    """Point, position and coordinates of a point w.r.t. the origin of a frame"""
+    if frame_id is None:
+        frame_id = element_id
+    position_id = "position-{}".format(point_id)
+    return [
+        {"@id": point_id, "@type": list(POINT_TYPE)},
+        {
+            "@id": position_id,
+            "@type": "Position",
+            "of": point_id,
+            "with-respect-to": "{}-origin".format(frame_id),
+            "quantity-kind": "Length",
+        },
+        {
+            "@id": "position-coord-{}-wrt-{}-origin".format(point_id, element_id),
+            "@type": list(POSITION_COORD_TYPE),
+            "of-position": position_id,
+            "as-seen-by": "{}-frame".format(frame_id),
+            "unit": length_unit,
+            "coordinates": coordinates,
+        },
+    ]
+
+
+def _point_ids(element_id, indices):
+    return ["{}-point-{}".format(element_id, i) for i in indices]
+
+
+@node_builder("ifc/placement/object-placement.json.jinja")
+def object_placement(placement_id, **kwargs):
+    placement_frame = placement_id + "-frame"
+    placement_origin = placement_id + "-origin"
+    pose_id = "pose-" + placement_id
+    return [
+        {
+            "@id": "pose-coord-" + placement_id,
+            "@type": [
+                "PoseReference",
+                "PoseCoordinate",
+                "DirectionCosineXYZ",
+                "VectorXYZ",
+            ],
+            "of-pose": pose_id,
+        },
+        {
+            "@id": pose_id,
+            "@type": "Pose",
+            "of": placement_frame,
+            "quantity-kind": ["Angle", "Length"],
+        },
+        {"@id": placement_frame, "@type": "Frame", "origin": placement_origin},
+        {"@id": placement_origin, "@type": list(POINT_TYPE)},
+    ]
+
+
+@node_builder("ifc/placement/placement-rel-to.json.jinja")
+def placement_rel_to(placement_id, ref_placement_id=None, world_frame=False, **kwargs):
+    if world_frame:
+        frame = "world-frame"
+    else:
+        frame = "{}-frame".format(ref_placement_id)
+    return [
+        {
+            "@id": "pose-coord-{}".format(placement_id),
+            "@type": "PoseCoordinate",
+            "as-seen-by": frame,
+        },
+        {
+            "@id": "pose-{}".format(placement_id),
+            "@type": "Pose",
+            "with-respect-to": frame,
+        },
+    ]
+
+
+@node_builder("ifc/placement/rel-placement-axis.json.jinja")
+def rel_placement_axis(placement_id, g, relative_placement, **kwargs):
+    axis = _get_numbers(
+        g, relative_placement, IFC_CONCEPTS["axis"], IFC_CONCEPTS["directionratios"]
+    )
+    return [
+        {
+            "@id": "pose-coord-{}".format(placement_id),
+            "@type": "DirectionCosineXYZ",
+            "unit": "UNITLESS",
+            "direction-cosine-z": axis[:3],
+        }
+    ]
+
+
+@node_builder("ifc/placement/rel-placement-refdirection.json.jinja")
+def rel_placement_refdirection(placement_id, g, relative_placement, **kwargs):
+    refdirection = _get_numbers(
+        g,
+        relative_placement,
+        IFC_CONCEPTS["refdirection"],
+        IFC_CONCEPTS["directionratios"],
+    )
+    return [
+        {
+            "@id": "pose-coord-{}".format(placement_id),
+            "@type": "DirectionCosineXYZ",
+            "unit": "UNITLESS",
+            "direction-cosine-x": refdirection[:3],
+        }
+    ]
+
+
+@node_builder("ifc/placement/rel-placement-coords.json.jinja")
+def rel_placement_coords(placement_id, g, relative_placement, length_unit, **kwargs):
+    coords = _get_numbers(
+        g, relative_placement, IFC_CONCEPTS["location"], IFC_CONCEPTS["coordinates"]
+    )
+    return [
+        {
+            "@id": "pose-coord-{}".format(placement_id),
+            "@type": "PoseCoordinate",
+            "unit": length_unit,
+            "coordinates": coords[:3],
+        }
+    ]
+
+
+@node_builder("ifc/base/circle-profile.json.jinja")
+def circle_profile(
+    parent_id,
+    element_id,
+    point_id,
+    radius,
+    depth,
+    extruded_dir,
+    relative_placement,
+    g,
+    length_unit,
+    **kwargs,
+):
+    polygon_id = "{}-polygon".format(element_id)
+    center_id = "{}-center".format(point_id)
+    coords = _get_numbers(
+        g, relative_placement, IFC_CONCEPTS["location"], IFC_CONCEPTS["coordinates"]
+    )
+    return [
+        {
+            "@id": parent_id,
+            "shape": polygon_id,
+            "3d-shape": "{}-cylinder".format(element_id),
+        },
+        {
+            "@id": polygon_id,
+            "@type": "Circle",
+            "center": center_id,
+            "quantity-kind": ["Radius"],
+            "unit": length_unit,
+            "radius": _number(radius),
+        },
+        {
+            "@id": "{}-cylinder".format(element_id),
+            "@type": "Cylinder",
+            "base": polygon_id,
+            "axis": [_number(d) for d in extruded_dir[:3]],
+            "height": _number(depth),
+            "unit": length_unit,
+        },
+        *_point_nodes(center_id, element_id, coords[:2], length_unit),
+    ]
+
+
+@node_builder("ifc/base/rectangle-profile.json.jinja")
+def rectangle_profile(parent_id, element_id, coords, length_unit, **kwargs):
+    nodes = [
+        {
+            "@id": parent_id,
+            "shape": "{}-polygon".format(element_id),
+            "3d-shape": "{}-polyhedron".format(element_id),
+        },
+        {
+            "@id": "{}-polygon".format(element_id),
+            "@type": "Polygon",
+            "points": _point_ids(element_id, range(1, 5)),
+        },
+        {
+            "@id": "{}-polyhedron".format(element_id),
+            "@type": "Polyhedron",
+            "points": _point_ids(element_id, range(1, 9)),
+            "faces": [],
+        },
+    ]
+    for point_id, p in zip(_point_ids(element_id, range(1, len(coords) + 1)), coords):
+        coordinates = [_number(c) for c in p]
+        nodes.extend(_point_nodes(point_id, element_id, coordinates, length_unit))
+    return nodes
+
+
+@node_builder("ifc/walls/wall-polygon.json.jinja")
+def wall_polygon(parent_id, element_id, coords, length_unit, **kwargs):
+    point_ids = _point_ids(element_id, range(1, len(coords) + 1))
+    nodes = [
+        {"@id": parent_id, "shape": "{}-polygon".format(element_id)},
+        {
+            "@id": "{}-polygon".format(element_id),
+            "@type": "Polygon",
+            "points": point_ids,
+        },
+    ]
+    for point_id, p in zip(point_ids, coords):
+        coordinates = [_number(c) for c in p]
+        nodes.extend(_point_nodes(point_id, element_id, coordinates, length_unit))
+    return nodes
+
+
+@node_builder("ifc/walls/wall-polyhedron.json.jinja")
+def wall_polyhedron(
+    parent_id, element_id, coords, depth, extruded_dir, length_unit, **kwargs
+):
+    base = coords[:4]
+    top_ids = _point_ids(element_id, range(5, len(base) + 5))
+    nodes = [
+        {"@id": parent_id, "3d-shape": "{}-polyhedron".format(element_id)},
+        {
+            "@id": "{}-polyhedron".format(element_id),
+            "@type": "Polyhedron",
+            "points": _point_ids(element_id, range(1, len(base) + 1)) + top_ids,
+            "faces": [],
+        },
+    ]
+    z = _number(depth.toPython() * extruded_dir[-1].toPython())
+    for point_id, p in zip(top_ids, base):
+        coordinates = [_number(p[0]), _number(p[1]), z]
+        nodes.extend(_point_nodes(point_id, element_id, coordinates, length_unit))
+    return nodes
+
+
+@node_builder("ifc/base/polygonal-face-set.json.jinja")
+def polygonal_face_set(
+    parent_id, element_id, placement_id, coords, faces, g, length_unit, **kwargs
+):
+    coords = list(coords)
+    point_ids = _point_ids(element_id, range(1, len(coords) + 1))
+    nodes = [
+        {"@id": parent_id, "3d-shape": "{}-polyhedron".format(element_id)},
+        {
+            "@id": "{}-polyhedron".format(element_id),
+            "@type": "Polyhedron",
+            "points": point_ids,
+            "faces": [
+                _point_ids(
+                    element_id,
+                    get_list_items(g, g.value(f, IFC_CONCEPTS["coordindex"])),
+                )
+                for f in faces
+            ],
+        },
+    ]
+    for point_id, p in zip(point_ids, coords):
+        coordinates = [_number(c) for c in get_list_items(g, p)][:3]
+        nodes.extend(
+            _point_nodes(
+                point_id, element_id, coordinates, length_unit, frame_id=placement_id
+            )
+        )
+    return nodes
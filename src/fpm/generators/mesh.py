@@ -3,13 +3,25 @@ import json
 import os.path
 import subprocess
 import tempfile
-
-from fpm.graph import get_floorplan_model_name, get_3d_structure
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fpm.geometry import get_geometry_model
+from fpm.graph import get_floorplan_model_name
+from fpm.transformations.mesh import (
+    OPENING_ELEMENTS,
+    SOLID_ELEMENTS,
+    export_mesh,
+    save_meshes,
+)
 from fpm.utils import get_output_path
 
 logger = logging.getLogger("floorplan.generators.mesh")
 logger.setLevel(logging.DEBUG)
 
+ELEMENT_KEYS = SOLID_ELEMENTS + OPENING_ELEMENTS
+
 
 def generate_3d_mesh(g, output_path, include_doors=False, **custom_args):
     file_format = custom_args.get("format", "stl")
@@ -18,34 +30,35 @@ def generate_3d_mesh(g, output_path, include_doors=False, **custom_args):
     elements = {}
     model_name = get_floorplan_model_name(g)
     elements["model_name"] = model_name
+    model = get_geometry_model(g)
 
     logger.debug("Getting 3D structure for walls")
-    walls = get_3d_structure(g, "Wall")
+    walls = model.get_3d_structure("Wall")
     elements["walls"] = walls
 
     logger.debug("Getting 3D structure for columns")
-    columns = get_3d_structure(g, "Column")
+    columns = model.get_3d_structure("Column")
     elements["columns"] = columns
 
     logger.debug("Getting 3D structure for dividers")
-    dividers = get_3d_structure(g, "Divider")
+    dividers = model.get_3d_structure("Divider")
     elements["dividers"] = dividers
 
     if include_doors:
         logger.debug("Getting 3D structure for doors")
-        doors = get_3d_structure(g, "Door")
+        doors = model.get_3d_structure("Door")
         elements["doors"] = doors
 
         logger.debug("Getting 3D structure for door linings")
-        door_linings = get_3d_structure(g, "DoorLining")
+        door_linings = model.get_3d_structure("DoorLining")
         elements["door_linings"] = door_linings
 
     logger.debug("Getting 3D structure for entryways")
-    entryways = get_3d_structure(g, "Entryway")
+    entryways = model.get_3d_structure("Entryway")
     elements["entryways"] = entryways
 
     logger.debug("Getting 3D structure for windows")
-    windows = get_3d_structure(g, "Window")
+    windows = model.get_3d_structure("Window")
     elements["windows"] = windows
 
     output_files = []
@@ -54,10 +67,96 @@ def generate_3d_mesh(g, output_path, include_doors=False, **custom_args):
         elements.setdefault("output_files", []).append((output_path, file_name))
         output_files.append(os.path.join(output_path, file_name))
 
-    run_blender(elements)
+    processes = custom_args.get("blender_processes") or 1
+    if custom_args.get("backend", "blender") == "native":
+        try:
+            export_mesh(elements, use_cache=custom_args.get("use_cache", False))
+        except ValueError as e:
+            logger.warning("%s, falling back to Blender", e)
+            run_blender_parallel(elements, processes)
+    else:
+        run_blender_parallel(elements, processes)
     return output_files
 
 
+def partition_elements(elements, num_partitions):
+    """Split the mesh elements into partitions that can be processed independently
+
+    Openings are kept in the same partition as the walls they void. The clusters of
+    walls and openings are distributed over the partitions by their number of vertices.
+    """
+    parent = dict()
+
+    def find(name):
+        while parent.setdefault(name, name) != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    entries = [(key, e) for key in ELEMENT_KEYS for e in elements.get(key, [])]
+    for key, e in entries:
+        for wall in e.get("voids", list()):
+            parent[find(e.get("name"))] = find(wall)
+
+    clusters = dict()
+    for key, e in entries:
+        clusters.setdefault(find(e.get("name")), []).append((key, e))
+
+    sizes = [0] * num_partitions
+    partitions = [dict() for _ in range(num_partitions)]
+    for cluster in sorted(
+        clusters.values(), key=lambda c: -sum(len(e["vertices"]) for _, e in c)
+    ):
+        i = sizes.index(min(sizes))
+        for key, e in cluster:
+            partitions[i].setdefault(key, []).append(e)
+            sizes[i] += len(e["vertices"])
+
+    return [p for p in partitions if p]
+
+
+def run_blender_parallel(elements, processes):
+    """Runs the blender transformation on partitions of the elements in parallel
+
+    Each Blender process saves its triangulated meshes, which are merged into the
+    output files with the native mesh writers. With a single process, Blender
+    writes the output files itself.
+    """
+    partitions = partition_elements(elements, processes) if processes > 1 else []
+    if len(partitions) < 2:
+        return run_blender(elements)
+
+    logger.info("Running Blender on %d partitions", len(partitions))
+    with tempfile.TemporaryDirectory(prefix="fpm_mesh_") as tmpdir:
+        for i, partition in enumerate(partitions):
+            partition["model_name"] = elements.get("model_name")
+            partition["mesh_data"] = os.path.join(tmpdir, f"partition-{i}.json")
+
+        with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+            list(executor.map(run_blender, partitions))
+
+        meshes = dict()
+        for partition in partitions:
+            with open(partition["mesh_data"]) as f:
+                for m in json.load(f):
+                    meshes[m["name"]] = (
+                        m["name"],
+                        np.array(m["vertices"], dtype=float).reshape(-1, 3),
+                        np.array(m["triangles"], dtype=np.uint32).reshape(-1, 3),
+                    )
+
+    # Openings are subtracted from the walls and have no mesh of their own
+    names = [e.get("name") for key in SOLID_ELEMENTS for e in elements.get(key, [])]
+    missing = [n for n in names if n not in meshes]
+    if missing:
+        raise ValueError(
+            "Blender did not export the meshes of: {}".format(", ".join(missing))
+        )
+    # Keep the order of the elements
+    ordered = [meshes[n] for n in names]
+    return save_meshes(ordered, elements.get("output_files", []))
+
+
 def run_blender(elements):
     """
     Runs the blender transformation as a subprocess
@@ -1,51 +1,197 @@
 import os
 import logging
+import tempfile
 
-import matplotlib.pyplot as plt
 import numpy as np
-from PIL import Image, ImageDraw, ImageOps
+from PIL import Image, ImageOps
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 from matplotlib.image import AxesImage
 
+from fpm.geometry import get_geometry_model
 from fpm.graph import (
-    get_space_points,
-    get_coordinates_map,
     get_floorplan_model_name,
-    get_element_points,
-    get_opening_points,
-    get_waypoint_coord_wrt_world,
-    get_waypoint_coord_list,
     get_frame_transform,
 )
+from fpm.raster import distance_transform, fill_polygons
 from fpm.utils import load_template, save_file, get_output_path
-from fpm.visualization.plot import plot_2d_frame, plot_2d_robot
+from fpm.visualization.plot import plot_2d_frames, plot_2d_robots
 
 logger = logging.getLogger("floorplan.generators.occ_grid")
 logger.setLevel(logging.DEBUG)
 
 
+OBSTACLE_ELEMENTS = ("Wall", "Column", "Divider")
+OPENING_ELEMENTS = ("Entryway",)
+
+# Cost values of Nav2's costmap_2d
+LETHAL_OBSTACLE = 254
+INSCRIBED_INFLATED_OBSTACLE = 253
+NO_INFORMATION = 255
+
+
 def generate_occ_grid(g, map_name, **custom_args):
-    plt.clf()
     logger.info("Map name: {}".format(map_name))
 
-    resolution = custom_args.get("resolution", 0.05)
+    unknown = custom_args.get("unknown_value", 200)
+    occupied = custom_args.get("occupied_value", 0)
+    free = custom_args.get("free_value", 255)
+
+    logger.debug("Getting geometry model")
+    model = get_geometry_model(g)
+    points, west, south, center, floor = get_map_extent(model, **custom_args)
+
+    metadata = get_map_metadata(map_name, center, **custom_args)
+
+    # Create canvas
+    tile_size = custom_args.get("tile_size")
+    if tile_size:
+        # Memory-mapped canvas for maps that don't fit in memory
+        grid = np.memmap(
+            tempfile.TemporaryFile(),
+            dtype=np.uint8,
+            mode="w+",
+            shape=(floor[1], floor[0]),
+        )
+        grid[:] = unknown
+    else:
+        grid = np.full((floor[1], floor[0]), unknown, dtype=np.uint8)
+
+    # Draw free space from floorplan spaces (rooms)
+    logger.debug("Drawing free space")
+    draw_floorplan_element(points, grid, free, west=west, south=south, **custom_args)
+
+    # Draw obstacles (walls and columns)
+    logger.debug("Drawing walls")
+    draw_floorplan_obstacle(model, "Wall", grid, west, south, occupied, **custom_args)
+    logger.debug("Drawing columns")
+    draw_floorplan_obstacle(model, "Column", grid, west, south, occupied, **custom_args)
+    logger.debug("Drawing dividers")
+    draw_floorplan_obstacle(
+        model, "Divider", grid, west, south, occupied, **custom_args
+    )
+
+    # Clear out wall openings; mark them as free space
+    logger.debug("Drawing entryways")
+    draw_floorplan_opening(model, "Entryway", grid, west, south, free, **custom_args)
+    # draw_floorplan_opening(model, "Window", grid, west, south, free, **custom_args)
+
+    if tile_size:
+        grid.flush()
+        return metadata, grid
+    return metadata, Image.fromarray(grid)
+
 
+def generate_occ_slices(g, map_name, heights, **custom_args):
+    """Generate the occupancy grids of the floorplan at several laser heights
+
+    The free space is drawn once, and the shapes of the obstacles and openings are
+    converted to pixels once, together with their z-extent. Each slice only fills
+    the shapes whose z-extent contains its height, and consecutive slices with the
+    same shapes share their grid. Yields the metadata and grid of each slice.
+    """
     unknown = custom_args.get("unknown_value", 200)
     occupied = custom_args.get("occupied_value", 0)
     free = custom_args.get("free_value", 255)
+
+    model = get_geometry_model(g)
+    points, west, south, center, floor = get_map_extent(model, **custom_args)
+
+    base = np.full((floor[1], floor[0]), unknown, dtype=np.uint8)
+    draw_floorplan_element(points, base, free, west=west, south=south, **custom_args)
+
+    obstacles = list()
+    for element in OBSTACLE_ELEMENTS:
+        obstacles.extend(get_obstacle_shapes(model, element))
+    openings = list()
+    for element in OPENING_ELEMENTS:
+        openings.extend(get_opening_shapes(model, element, **custom_args))
+
+    layers = list()
+    for shapes, fill in [(obstacles, occupied), (openings, free)]:
+        polygons = get_pixel_shapes(
+            [coords for coords, _, _ in shapes], west=west, south=south, **custom_args
+        )
+        z_min = np.array([z for _, z, _ in shapes], dtype=float)
+        z_max = np.array([z for _, _, z in shapes], dtype=float)
+        layers.append((polygons, z_min, z_max, fill))
+
+    key, grid = None, None
+    for height in heights:
+        in_slice = [
+            (z_min <= height) & (height <= z_max) for _, z_min, z_max, _ in layers
+        ]
+        slice_key = tuple(np.packbits(s).tobytes() for s in in_slice)
+        if slice_key != key:
+            key, grid = slice_key, base.copy()
+            for (polygons, _, _, fill), selected in zip(layers, in_slice):
+                fill_polygons(
+                    grid, [polygons[i] for i in np.flatnonzero(selected)], fill
+                )
+
+        slice_name = f"{map_name}_z{height:g}"
+        logger.debug("Slice %s at %.3f m", slice_name, height)
+        metadata = get_map_metadata(
+            slice_name, center, **dict(custom_args, laser_height=float(height))
+        )
+        yield metadata, grid
+
+
+def generate_voxel_grid(g, map_name, **custom_args):
+    """Generate a 3D occupancy grid of the floorplan from its slices
+
+    The voxels are stacked as (z, y, x) layers, one every voxel height from the
+    floor up to the highest element, with each row bit-packed along x.
+    """
+    resolution = custom_args.get("resolution", 0.05)
+    voxel_height = custom_args.get("voxel_height") or resolution
+    occupied = custom_args.get("occupied_value", 0)
+
+    model = get_geometry_model(g)
+    top = float(np.amax(model.vertices[:, 2], initial=0.0))
+    for element in OBSTACLE_ELEMENTS:
+        for e in model.get_elements(element):
+            if e.height is not None:
+                top = max(top, e.height)
+
+    levels = max(int(np.ceil(top / voxel_height)), 1)
+    # Each layer is sampled at the center of its voxels
+    heights = (np.arange(levels) + 0.5) * voxel_height
+
+    voxels = None
+    origin = None
+    slices = generate_occ_slices(g, map_name, heights, **custom_args)
+    for z, (metadata, grid) in enumerate(slices):
+        if voxels is None:
+            origin = metadata.get("origin")
+            width = grid.shape[1]
+            voxels = np.zeros((levels, grid.shape[0], (width + 7) // 8), np.uint8)
+        voxels[z] = np.packbits(grid == occupied, axis=-1)
+
+    metadata = {
+        "voxels": f"{map_name}_voxels.npy",
+        "resolution": resolution,
+        "voxel_height": voxel_height,
+        "origin": [origin[0], origin[1], 0.0],
+        "shape": [levels, voxels.shape[1], width],
+        "axes": "zyx",
+        "bitorder": "big",
+    }
+    return metadata, voxels
+
+
+def get_map_extent(model, **custom_args):
+    """Get the space polygons, the canvas size and the origin of the map"""
+    resolution = custom_args.get("resolution", 0.05)
     border = custom_args.get("border", 50)
 
     points = []
     directions = []
 
-    logger.debug("Getting coordinates map")
-    coords_m = get_coordinates_map(g)
     logger.debug("Getting space points")
-    space_points = get_space_points(g)
-    for s in space_points:
-        logger.debug("Getting waypoint coords")
-        w_coords = get_waypoint_coord_list(g, s.get("points"), coords_m)
-
-        w_coords = np.array(w_coords)
+    for s in model.get_elements("Space"):
+        w_coords = model.get_polygon_coord_array(s)
         points.append(w_coords)
 
         # Get the left/right, top/bottom of each space
@@ -72,90 +218,42 @@ def generate_occ_grid(g, map_name, **custom_args):
         0,
     ]
 
-    metadata = get_map_metadata(map_name, center, **custom_args)
-
-    # Create canvas
     floor = (
         int(abs(east - west) / resolution) + border,
         int(abs(north - south) / resolution) + border,
     )
 
-    im = Image.new("L", floor, unknown)
-    draw = ImageDraw.Draw(im)
+    return points, west, south, center, floor
 
-    # Draw free space from floorplan spaces (rooms)
-    logger.debug("Drawing free space")
-    draw_floorplan_element(points, draw, free, west=west, south=south, **custom_args)
 
-    # Draw obstacles (walls and columns)
-    logger.debug("Drawing walls")
-    draw_floorplan_obstacle(
-        g, "Wall", draw, west, south, occupied, coords_m, **custom_args
-    )
-    logger.debug("Drawing columns")
-    draw_floorplan_obstacle(
-        g, "Column", draw, west, south, occupied, coords_m, **custom_args
-    )
-    logger.debug("Drawing dividers")
-    draw_floorplan_obstacle(
-        g, "Divider", draw, west, south, occupied, coords_m, **custom_args
-    )
-
-    # Clear out wall openings; mark them as free space
-    logger.debug("Drawing entryways")
-    draw_floorplan_opening(
-        g, "Entryway", draw, west, south, free, coords_m, **custom_args
-    )
-    # draw_floorplan_opening(g, "Window", draw, west, south, resolution, border, free, coords_m)
-
-    return metadata, im
-
-
-def draw_floorplan_obstacle(g, element, draw, west, south, fill, coords_map, **kwargs):
-    column_points = get_element_points(g, element)
-    c_points = list()
+def get_obstacle_shapes(model, element):
+    """Get the polygon and z-extent of each obstacle
 
-    laser_height = kwargs.get("laser_height", 0.7)
-    for s in column_points:
-        height = s.get("height")
-        if laser_height > height:
-            # Don't process elements that are below the laser height
-            # This assumes that walls, columns, and dividers start at z=0 (from the floor)
-            continue
-
-        c_coords = get_waypoint_coord_list(g, s.get("points"), coords_map)
-
-        c_coords = np.array(c_coords)
-        c_points.append(c_coords)
-
-    draw_floorplan_element(
-        c_points,
-        draw,
-        fill,
-        west=west,
-        south=south,
-        **kwargs,
-    )
+    This assumes that walls, columns, and dividers start at z=0 (from the floor),
+    elements without a height block all heights.
+    """
+    shapes = list()
+    for s in model.get_elements(element):
+        height = s.height if s.height is not None else float("inf")
+        shapes.append((model.get_polygon_coord_array(s), float("-inf"), height))
+    return shapes
 
 
-def draw_floorplan_opening(g, element, draw, west, south, fill, coords_map, **kwargs):
-    opening_points = get_opening_points(g, element)
+def get_opening_shapes(model, element, **kwargs):
+    """Get the floor-parallel faces of each opening and their z-extent"""
     resolution = kwargs.get("resolution", 0.05)
-    laser_height = kwargs.get("laser_height", 0.7)
-
     source = kwargs.get("source", "fpm")
 
-    all_points = list()
-    for opening in opening_points:
+    shapes = list()
+    for opening in model.get_elements(element):
         opening_height_max = 0.0
         opening_height_min = float("inf")
-        for face in opening:
-            points = [get_waypoint_coord_wrt_world(g, p, coords_map) for p in face]
+        for face in model.get_face_indices(opening):
             if source == "fpm":
-                z_vals = [p.get("z") for p in face]
+                z_vals = model.local_vertices[face, 2]
             else:
-                z_vals = [z for x, y, z in points]
-            if not np.all(np.array(z_vals) == z_vals[0]):
+                z_vals = model.vertices[face, 2]
+            if not np.all(z_vals == z_vals[0]):
                 # Only process faces that are parallel to the floor (where the z is the same)
                 continue
 
@@ -164,25 +262,55 @@ def draw_floorplan_opening(g, element, draw, west, south, fill, coords_map, **kw
             if source == "fpm":
                 f_coords, opening_height_max, opening_height_min = (
                     get_fpm_opening_points(
+                        model,
                         face,
                         opening_height_max,
                         opening_height_min,
                         resolution,
-                        g,
-                        coords_map,
                     )
                 )
             else:
                 f_coords, opening_height_max, opening_height_min = (
                     get_bim_opening_points(
-                        points, opening_height_max, opening_height_min
+                        model.vertices[face], opening_height_max, opening_height_min
                     )
                 )
-            if opening_height_min <= laser_height <= opening_height_max:
-                f_coords = np.array(f_coords)
-                all_points.append(f_coords)
+            # The extent is that of the faces of the opening seen so far
+            shapes.append((np.array(f_coords), opening_height_min, opening_height_max))
+
+    return shapes
+
+
+def draw_floorplan_obstacle(model, element, grid, west, south, fill, **kwargs):
+    laser_height = kwargs.get("laser_height", 0.7)
+
+    # Don't process elements that are below the laser height
+    c_points = [
+        coords
+        for coords, _, height in get_obstacle_shapes(model, element)
+        if laser_height <= height
+    ]
+
+    draw_floorplan_element(
+        c_points,
+        grid,
+        fill,
+        west=west,
+        south=south,
+        **kwargs,
+    )
+
+
+def draw_floorplan_opening(model, element, grid, west, south, fill, **kwargs):
+    laser_height = kwargs.get("laser_height", 0.7)
+
+    all_points = [
+        coords
+        for coords, z_min, z_max in get_opening_shapes(model, element, **kwargs)
+        if z_min <= laser_height <= z_max
+    ]
 
-    draw_floorplan_element(all_points, draw, fill, west=west, south=south, **kwargs)
+    draw_floorplan_element(all_points, grid, fill, west=west, south=south, **kwargs)
 
 
 def get_bim_opening_points(points, opening_height_max, opening_height_min):
@@ -199,40 +327,41 @@ def get_bim_opening_points(points, opening_height_max, opening_height_min):
 
 
 def get_fpm_opening_points(
-    face, opening_height_max, opening_height_min, resolution, graph, coords_map
+    model, face, opening_height_max, opening_height_min, resolution
 ):
     # FPM: Assumptions for direction of XYZ vectors
-    coords = list()
-    for p in face:
-        if p["y"] == 0.0:
-            p["y"] = p["y"] - resolution
-        else:
-            p["y"] = p["y"] + resolution
-        x, y, z = get_waypoint_coord_wrt_world(graph, p, coords_map)
-        coords.append([x, y, 0, 1])
-        if z > opening_height_max:
-            opening_height_max = z
-        elif z < opening_height_min:
-            opening_height_min = z
+    local = model.local_vertices[face].copy()
+    local[:, 1] = np.where(
+        local[:, 1] == 0.0, local[:, 1] - resolution, local[:, 1] + resolution
+    )
+    points = model.to_world(local, model.vertex_frames[face])
 
-    return coords, opening_height_max, opening_height_min
+    return get_bim_opening_points(points, opening_height_max, opening_height_min)
+
+
+def draw_floorplan_element(points, grid, fill, **kwargs):
+    if len(points) == 0:
+        return
 
+    # Convert all shapes to pixel coordinates at once and fill them in a single pass
+    fill_polygons(grid, get_pixel_shapes(points, **kwargs), fill)
 
-def draw_floorplan_element(points, draw, fill, **kwargs):
+
+def get_pixel_shapes(points, **kwargs):
+    """Convert a list of (N,4) world coordinate arrays to pixel polygons"""
     west = kwargs.get("west")
     south = kwargs.get("south")
     resolution = kwargs.get("resolution", 0.05)
     border = kwargs.get("border", 50)
 
-    for shape in points:
-        element_shape = get_2d_shape(west, south, resolution, border, shape=shape)
-        draw_2d_shape(draw, element_shape, fill=fill, **kwargs)
-
+    if len(points) == 0:
+        return []
 
-def draw_2d_shape(draw, shape, fill, outline=None, width=1, **kwargs):
-    draw.polygon(
-        shape[:, 0:2].flatten().tolist(), fill=fill, outline=outline, width=width
+    shapes = get_2d_shape(
+        west, south, resolution, border, shape=np.concatenate(points)[:, 0:2]
     )
+    sections = np.cumsum([len(p) for p in points])[:-1]
+    return np.split(shapes, sections)
 
 
 def get_2d_shape(west, south, resolution, border, points=None, shape=None):
@@ -273,22 +402,59 @@ def get_occ_grid(g, base_path, save=True, **kwargs):
     center = map_metadata.get("origin", [])
 
     if save:
-        # Save the occupancy grid and its metadata
-        file_name = f"{map_name}.yaml"
-        f = save_file(output_path, file_name, map_metadata)
-        output_files.append(f)
+        files = save_occ_grid(im, map_metadata, output_path, map_name, **kwargs)
+        output_files.extend(files)
 
-        img = ImageOps.flip(im)
-        name_image = f"{map_name}.pgm"
-        f = save_file(output_path, name_image, img)
-        output_files.append(f)
+        # Other resolutions reuse the geometry already extracted from the graph
+        resolution = kwargs.get("resolution", 0.05)
+        for level_resolution in kwargs.get("pyramid", []):
+            if level_resolution == resolution:
+                continue
+            level_name = f"{map_name}_{level_resolution:g}"
+            level_args = dict(kwargs, resolution=level_resolution)
+            level_metadata, level_im = generate_occ_grid(g, level_name, **level_args)
+            files = save_occ_grid(
+                level_im, level_metadata, output_path, level_name, **level_args
+            )
+            output_files.extend(files)
+
+        if kwargs.get("distance_field") or kwargs.get("inflation_radius"):
+            files = save_costmaps(
+                np.asarray(im), map_metadata, output_path, map_name, **kwargs
+            )
+            output_files.extend(files)
+
+        slice_heights = kwargs.get("slice_heights")
+        if slice_heights:
+            for slice_metadata, grid in generate_occ_slices(
+                g, map_name, slice_heights, **kwargs
+            ):
+                slice_name = os.path.splitext(slice_metadata["image"])[0]
+                files = save_occ_grid(
+                    Image.fromarray(grid), slice_metadata, output_path, slice_name
+                )
+                output_files.extend(files)
+
+        if kwargs.get("voxel_grid"):
+            voxel_metadata, voxels = generate_voxel_grid(g, map_name, **kwargs)
+            files = save_voxel_grid(voxels, voxel_metadata, output_path, map_name)
+            output_files.extend(files)
+
+    visualize = kwargs.get("draw_map") or kwargs.get("milling_task")
+    if isinstance(im, np.ndarray) and (visualize or kwargs.get("visualize_frames")):
+        im = Image.fromarray(np.asarray(im))
 
     if kwargs.get("draw_map"):
         fig, _ = draw_map(im, center, **kwargs)
         name_image = f"{map_name}.jpg"
-        plt.tight_layout()
+        fig.tight_layout()
         fig.savefig(os.path.join(output_path, name_image), dpi=300, bbox_inches="tight")
 
+    visualize_frames = kwargs.get("visualize_frames", [])
+    if kwargs.get("milling_task") or visualize_frames:
+        # The map is drawn once, and each overlay is added to it and removed once saved
+        _, ax = draw_map(im, center, grid=True, **kwargs)
+
     if kwargs.get("milling_task"):
         logger.debug("Drawing outlet task elements")
         draw_tasks(
@@ -297,11 +463,11 @@ def get_occ_grid(g, base_path, save=True, **kwargs):
             tasks="milling_task",
             map_name=map_name,
             output_path=output_path,
+            ax=ax,
             **kwargs,
         )
 
-    for frame_type in kwargs.get("visualize_frames", []):
-        plt.clf()
+    for frame_type in visualize_frames:
         logger.debug("Drawing frames for %s", frame_type)
         draw_frames(
             g,
@@ -310,17 +476,143 @@ def get_occ_grid(g, base_path, save=True, **kwargs):
             map_name=map_name,
             output_path=output_path,
             frame_type=frame_type,
+            ax=ax,
             **kwargs,
         )
 
     return output_files
 
 
-def _get_im_map(im, center: list[float], **kwargs) -> AxesImage:
+def save_occ_grid(im, map_metadata, output_path, map_name, **kwargs):
+    """Save the occupancy grid and its metadata"""
+    output_files = []
+    file_name = f"{map_name}.yaml"
+    f = save_file(output_path, file_name, map_metadata)
+    output_files.append(f)
+
+    # Memory-mapped grids are flipped and written by streaming
+    img = im[::-1] if isinstance(im, np.ndarray) else ImageOps.flip(im)
+    name_image = f"{map_name}.pgm"
+    f = save_file(output_path, name_image, img)
+    output_files.append(f)
+
+    if isinstance(im, np.ndarray):
+        files = save_map_tiles(
+            im, map_metadata, output_path, map_name, kwargs.get("tile_size")
+        )
+        output_files.extend(files)
+
+    return output_files
+
+
+def get_distance_field(grid, **kwargs):
+    """Distance (in m) from each cell to the nearest occupied cell"""
+    resolution = kwargs.get("resolution", 0.05)
+    occupied = kwargs.get("occupied_value", 0)
+    return distance_transform(grid == occupied) * resolution
+
+
+def get_inflated_costmap(grid, distances, radius, **kwargs):
+    """Costmap of the grid with the obstacles inflated as Nav2's inflation layer does
+
+    Cells within the inscribed radius of an obstacle are inscribed obstacles, and the
+    cost of cells up to the inflation radius decays exponentially with the distance.
+    """
+    unknown = kwargs.get("unknown_value", 200)
+    inscribed_radius = kwargs.get("inscribed_radius", 0.0)
+    cost_scaling_factor = kwargs.get("cost_scaling_factor", 3.0)
+
+    costmap = np.zeros(grid.shape, dtype=np.uint8)
+    inflated = distances <= radius
+    cost = (INSCRIBED_INFLATED_OBSTACLE - 1) * np.exp(
+        -cost_scaling_factor * (distances[inflated] - inscribed_radius)
+    )
+    costmap[inflated] = cost.astype(np.uint8)
+    costmap[grid == unknown] = NO_INFORMATION
+    costmap[distances <= inscribed_radius] = INSCRIBED_INFLATED_OBSTACLE
+    costmap[distances == 0] = LETHAL_OBSTACLE
+    return costmap
+
+
+def save_costmaps(grid, map_metadata, output_path, map_name, **kwargs):
+    """Save the distance field and an inflated costmap for each inflation radius
+
+    The costmaps store the costs of Nav2's costmap_2d, to be loaded in raw mode.
+    """
+    output_files = []
+    distances = get_distance_field(grid, **kwargs)
+
+    if kwargs.get("distance_field"):
+        f = save_file(
+            output_path, f"{map_name}_distance.npy", distances.astype(np.float32)
+        )
+        output_files.append(f)
+
+    for radius in kwargs.get("inflation_radius", []):
+        costmap_name = f"{map_name}_costmap_{radius:g}"
+        costmap = get_inflated_costmap(grid, distances, radius, **kwargs)
+        costmap_metadata = dict(map_metadata)
+        costmap_metadata.update(
+            {
+                "image": f"{costmap_name}.pgm",
+                "mode": "raw",
+                "inflation_radius": radius,
+                "inscribed_radius": kwargs.get("inscribed_radius", 0.0),
+                "cost_scaling_factor": kwargs.get("cost_scaling_factor", 3.0),
+            }
+        )
+        files = save_occ_grid(
+            Image.fromarray(costmap), costmap_metadata, output_path, costmap_name
+        )
+        output_files.extend(files)
+
+    return output_files
+
+
+def save_voxel_grid(voxels, voxel_metadata, output_path, map_name):
+    """Save the bit-packed voxel grid and its metadata"""
+    output_files = []
+    f = save_file(output_path, voxel_metadata["voxels"], voxels)
+    output_files.append(f)
+    f = save_file(output_path, f"{map_name}_voxels.yaml", voxel_metadata)
+    output_files.append(f)
+    return output_files
+
+
+def save_map_tiles(grid, map_metadata, output_path, map_name, tile_size):
+    """Save each tile of the grid as a map with its own metadata"""
+    output_files = []
+    tiles_path = os.path.join(output_path, f"{map_name}-tiles")
+    resolution = map_metadata.get("resolution")
+    orig_x, orig_y, _ = map_metadata.get("origin")
+
+    height, width = grid.shape
+    for i, r in enumerate(range(0, height, tile_size)):
+        for j, c in enumerate(range(0, width, tile_size)):
+            tile_name = f"{map_name}_{i}_{j}"
+            tile = grid[r : r + tile_size, c : c + tile_size]
+            f = save_file(tiles_path, f"{tile_name}.pgm", tile[::-1])
+            output_files.append(f)
+
+            # The origin is the lower-left pixel of the tile, i.e. the first row of the grid
+            tile_metadata = dict(map_metadata)
+            tile_metadata["image"] = f"{tile_name}.pgm"
+            tile_metadata["origin"] = [
+                orig_x + c * resolution,
+                orig_y + r * resolution,
+                0,
+            ]
+            f = save_file(tiles_path, f"{tile_name}.yaml", tile_metadata)
+            output_files.append(f)
+
+    return output_files
+
+
+def _get_im_map(ax, im, center: list[float], **kwargs) -> AxesImage:
     resolution = kwargs.get("resolution", 0.05)
     w, h = im.size
     orig_x, orig_y, _ = center
-    imax = plt.imshow(
+    imax = ax.imshow(
         im,
         cmap="gray",
         interpolation="none",
@@ -337,9 +629,11 @@ def _get_im_map(im, center: list[float], **kwargs) -> AxesImage:
 
 
 def draw_map(im, center: list[float], grid=False, grid_resolution=0.5, **kwargs):
-    imax = _get_im_map(im, center, **kwargs)
-    fig = imax.get_figure()
-    ax = fig.get_axes().pop()
+    # The figure has its own Agg canvas, without using pyplot's global state
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    _get_im_map(ax, im, center, **kwargs)
     ax.yaxis.set_inverted(False)
     ax.set_aspect("equal", adjustable="box")
 
@@ -357,39 +651,49 @@ def draw_map(im, center: list[float], grid=False, grid_resolution=0.5, **kwargs)
     return fig, ax
 
 
-def draw_tasks(im, center, tasks, **kwargs):
+def draw_tasks(im, center, tasks, ax=None, **kwargs):
     logger.info("Drawing tasks: %s", tasks)
-    fig, ax = draw_map(im, center, grid=True, **kwargs)
-    for task in kwargs.get(tasks, []):
-        name = task["name"]
-        nav_pose = task.get("nav_pose")
-        plot_2d_robot(ax, nav_pose, 1.4, 1.9)
-        nav_pose[3, 3] = 0.25
-        plot_2d_frame(ax, nav_pose, name)
-
-        milling_task = np.array(task.get("milling_vector"))
-
-        ax.scatter(
-            milling_task[0, 0],
-            milling_task[0, 1],
-            c="red",
-            marker=".",
-            s=15,
+    if ax is None:
+        _, ax = draw_map(im, center, grid=True, **kwargs)
+    fig = ax.get_figure()
+
+    task_list = kwargs.get(tasks, [])
+    nav_poses = np.array([task.get("nav_pose") for task in task_list], dtype=float)
+    milling_tasks = [np.array(task.get("milling_vector")) for task in task_list]
+
+    artists = list()
+    if task_list:
+        artists.append(plot_2d_robots(ax, nav_poses, 1.4, 1.9))
+        nav_poses[:, 3, 3] = 0.25
+        names = [task["name"] for task in task_list]
+        artists.extend(plot_2d_frames(ax, nav_poses, names))
+
+        start = np.array([m[0, :2] for m in milling_tasks])
+        artists.append(ax.scatter(start[:, 0], start[:, 1], c="red", marker=".", s=15))
+        milling_lines = LineCollection(
+            [m[:, :2] for m in milling_tasks], colors="yellow"
         )
-        ax.plot(milling_task[:, 0], milling_task[:, 1], color="yellow")
+        artists.append(ax.add_collection(milling_lines, autolim=False))
+
     map_name = kwargs.get("map_name")
     output_path = kwargs.get("output_path")
     name_image = "tasks-{}-{}.{}".format(tasks, map_name, "jpg")
 
     fig.savefig(os.path.join(output_path, name_image), dpi=300)
+    for artist in artists:
+        artist.remove()
 
 
-def draw_frames(g, im, center, map_name, output_path, frame_type, **kwargs):
-    fig, ax = draw_map(im, center, grid=True, **kwargs)
+def draw_frames(g, im, center, map_name, output_path, frame_type, ax=None, **kwargs):
+    if ax is None:
+        _, ax = draw_map(im, center, grid=True, **kwargs)
+    fig = ax.get_figure()
     name_image = "{}-frames-{}.{}".format(frame_type, map_name, "jpg")
-    matrices = get_frame_transform(g, frame_type)
-    for m in matrices:
-        m[3, 3] = 0.25
-        plot_2d_frame(ax, m)
+    matrices = np.array(get_frame_transform(g, frame_type), dtype=float)
+    matrices = matrices.reshape(-1, 4, 4)
+    matrices[:, 3, 3] = 0.25
+    artists = plot_2d_frames(ax, matrices)
 
     fig.savefig(os.path.join(output_path, name_image), dpi=300)
+    for artist in artists:
+        artist.remove()
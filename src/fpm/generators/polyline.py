@@ -1,6 +1,7 @@
 import logging
 
-from fpm.graph import get_floorplan_model_name, get_internal_walls
+from fpm.geometry import get_geometry_model
+from fpm.graph import get_floorplan_model_name
 from fpm.utils import save_file, load_template, get_output_path
 
 logger = logging.getLogger("floorplan.generators.polyline")
@@ -13,7 +14,7 @@ def generate_polyline_representation(
     logger.info("Generating polyline representation...")
     model_name = get_floorplan_model_name(g)
     file_name = kwargs.get("file_name", "{}.poly".format(model_name))
-    wall_planes_by_space = get_internal_walls(g)
+    wall_planes_by_space = get_geometry_model(g).get_internal_walls()
 
     template = load_template(template_name, template_path)
     output = template.render(
@@ -1,13 +1,18 @@
 import json
 import os
 import logging
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import rdflib
-from pyld import jsonld
 from rdflib import Graph, RDF
 from rdflib.plugins.sparql import prepareQuery
 
+from fpm import snapshot
+from fpm.compaction import compact_nodes
 from fpm.constants import FP
+from fpm.generators.ifc_nodes import NODE_BUILDERS
 from fpm.graph import get_list_values, get_list_from_ptr
 from fpm.utils import load_template, save_file
 from ifcld.interpreters.namespaces import IFC_CONCEPTS
@@ -16,6 +21,15 @@ from ifcld.query import units_query, convert_units_query, project_units_query
 logger = logging.getLogger("floorplan.generators.scenery")
 logger.setLevel(logging.DEBUG)
 
+# Render the IFC nodes with the templates, see use_ifc_templates
+_use_templates = False
+
+# Maximum number of IFC elements sent at once to a worker process
+ELEMENT_CHUNK_SIZE = 64
+
+# IFC graph of a worker process, see _init_ifc_worker
+_worker_graph = None
+
 
 def add_polyhedron_faces(floorplan):
     from itertools import pairwise
@@ -41,7 +55,7 @@ def add_polyhedron_faces(floorplan):
             f["faces"].append([p1, p2, p3, p4])
 
 
-def generate_fpm_rep_from_rdf(model_path, output_path, debug=False):
+def generate_fpm_rep_from_rdf(model_path, output_path, debug=False, workers=None):
     logger.debug("Output path: %s", output_path)
     model_name = os.path.basename(model_path).lower().replace(".ifc.json", "")
 
@@ -82,45 +96,48 @@ def generate_fpm_rep_from_rdf(model_path, output_path, debug=False):
 
     length_unit = str(g.namespace_manager.curie(query_ifc_units(g)[0])).split(":")[-1]
 
-    logger.info("Transforming IFC local placements...")
-    placements = query_ifc_local_placements(g, length_unit)
-    if debug:
-        file_name = "{}.placement.fpm.json".format(model_name)
-        save_compact_graph(placements, fpm_ctx, output_path, file_name, debug=debug)
-    else:
-        floorplan.extend(placements)
-
-    logger.info("Transforming IFC walls...")
-    walls = query_ifc_walls(g, length_unit)
-    if debug:
-        file_name = "{}.walls.fpm.json".format(model_name)
-        save_compact_graph(walls, fpm_ctx, output_path, file_name, debug=debug)
-    else:
-        floorplan.extend(walls)
+    with get_ifc_executor(g, workers) as executor:
+        logger.info("Transforming IFC local placements...")
+        placements = query_ifc_local_placements(g, length_unit, executor)
+        if debug:
+            file_name = "{}.placement.fpm.json".format(model_name)
+            save_compact_graph(placements, fpm_ctx, output_path, file_name, debug=debug)
+        else:
+            floorplan.extend(placements)
 
-    logger.info("Transforming IFC doors...")
-    doors = query_ifc_doors(g, length_unit)
-    if debug:
-        file_name = "{}.doors.fpm.json".format(model_name)
-        save_compact_graph(doors, fpm_ctx, output_path, file_name, debug=debug)
-    else:
-        floorplan.extend(doors)
+        logger.info("Transforming IFC walls...")
+        walls = query_ifc_walls(g, length_unit, executor)
+        if debug:
+            file_name = "{}.walls.fpm.json".format(model_name)
+            save_compact_graph(walls, fpm_ctx, output_path, file_name, debug=debug)
+        else:
+            floorplan.extend(walls)
 
-    logger.info("Transforming IFC spaces...")
-    spaces = query_ifc_spaces(g, model_name, length_unit)
-    if debug:
-        file_name = "{}.spaces.fpm.json".format(model_name)
-        save_compact_graph(spaces, fpm_ctx, output_path, file_name, debug=debug)
-    else:
-        floorplan.extend(spaces)
+        logger.info("Transforming IFC doors...")
+        doors = query_ifc_doors(g, length_unit, executor)
+        if debug:
+            file_name = "{}.doors.fpm.json".format(model_name)
+            save_compact_graph(doors, fpm_ctx, output_path, file_name, debug=debug)
+        else:
+            floorplan.extend(doors)
 
-    logger.info("Transforming task elements...")
-    task_elements = query_ifc_task_elements(g, length_unit)
-    if debug:
-        file_name = "{}.task.fpm.json".format(model_name)
-        save_compact_graph(task_elements, fpm_ctx, output_path, file_name, debug=debug)
-    else:
-        floorplan.extend(task_elements)
+        logger.info("Transforming IFC spaces...")
+        spaces = query_ifc_spaces(g, model_name, length_unit, executor)
+        if debug:
+            file_name = "{}.spaces.fpm.json".format(model_name)
+            save_compact_graph(spaces, fpm_ctx, output_path, file_name, debug=debug)
+        else:
+            floorplan.extend(spaces)
+
+        logger.info("Transforming task elements...")
+        task_elements = query_ifc_task_elements(g, length_unit, executor=executor)
+        if debug:
+            file_name = "{}.task.fpm.json".format(model_name)
+            save_compact_graph(
+                task_elements, fpm_ctx, output_path, file_name, debug=debug
+            )
+        else:
+            floorplan.extend(task_elements)
 
     stats(g)
 
@@ -140,8 +157,7 @@ def generate_fpm_rep_from_rdf(model_path, output_path, debug=False):
 
 
 def save_compact_graph(g, ctx, output_path, file_name, debug=False):
-    flattened = jsonld.flatten({"@graph": g, "@context": ctx})
-    compact = jsonld.compact(flattened, {"@context": ctx})
+    compact = compact_nodes(g, ctx)
     save_file(
         output_path,
         file_name,
@@ -154,7 +170,25 @@ def get_entity_id(g, e, entity_type="placement"):
     return g.namespace_manager.curie(e).replace("ifc-model:", "{}-".format(entity_type))
 
 
+def use_ifc_templates(enabled=True):
+    """Render all IFC nodes with the Jinja templates instead of the native builders"""
+    global _use_templates
+    _use_templates = enabled
+
+
 def render_ifc_template(template_path, **kwargs):
+    """JSON-LD nodes of an IFC template
+
+    The nodes are built natively if a builder is registered for the template (see
+    fpm.generators.ifc_nodes), unless the templates are used instead.
+    """
+    builder = NODE_BUILDERS.get(template_path)
+    if builder is not None and not _use_templates:
+        nodes = builder(**kwargs)
+        if kwargs.get("debug"):
+            print("\n**\n", json.dumps(nodes, indent=2))
+        return nodes
+
     template = load_template(template_path)
     content = template.render(**kwargs)
     if kwargs.get("debug"):
@@ -162,40 +196,93 @@ def render_ifc_template(template_path, **kwargs):
     return json.loads(content)
 
 
-def query_ifc_local_placements(g: Graph, length_unit):
+def get_ifc_executor(g: Graph, workers=None):
+    """Process pool to transform the IFC elements, or a null context for one worker
+
+    The number of workers defaults to the number of CPUs. Each worker process
+    rebuilds the graph once from a snapshot of it and keeps it read-only, see
+    transform_elements.
+    """
+    if (workers or os.cpu_count()) == 1:
+        return contextlib.nullcontext()
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_ifc_worker,
+        initargs=(snapshot.graph_to_snapshot(g), _use_templates),
+    )
+
+
+def _init_ifc_worker(graph_snapshot, use_templates):
+    global _worker_graph
+    _worker_graph = snapshot.graph_from_snapshot(graph_snapshot)
+    use_ifc_templates(use_templates)
+
+
+def _transform_in_worker(transform, element, args):
+    return transform(_worker_graph, *element, *args)
+
+
+def transform_elements(g: Graph, transform, elements, args=(), executor=None):
+    """Nodes of transform(g, *element, *args) for all elements, in their order
+
+    With an executor (see get_ifc_executor), the elements are sharded over its
+    worker processes and the nodes are merged in the order of the elements, so the
+    result is the same as transforming them serially.
+    """
+    if executor is None or len(elements) < 2:
+        graph_contents = list()
+        for element in elements:
+            graph_contents.extend(transform(g, *element, *args))
+        return graph_contents
+
+    chunk_size = min(ELEMENT_CHUNK_SIZE, -(-len(elements) // (4 * os.cpu_count())))
+    results = executor.map(
+        _transform_in_worker,
+        repeat(transform),
+        elements,
+        repeat(args),
+        chunksize=chunk_size,
+    )
+    return [node for nodes in results for node in nodes]
+
+
+def query_ifc_local_placements(g: Graph, length_unit, executor=None):
+    placements = [(p,) for p in g.subjects(RDF.type, IFC_CONCEPTS["IFCLOCALPLACEMENT"])]
+    return transform_elements(
+        g, transform_ifc_local_placement, placements, (length_unit,), executor
+    )
+
+
+def transform_ifc_local_placement(g: Graph, p, length_unit):
     placements = list()
-    world_frame = list()
+    entity = get_entity_id(g, p)
+    e = render_ifc_template(
+        "ifc/placement/object-placement.json.jinja",
+        placement_id=entity,
+    )
+    placements.extend(e)
 
-    for p in g.subjects(RDF.type, IFC_CONCEPTS["IFCLOCALPLACEMENT"]):
-        entity = get_entity_id(g, p)
-        e = render_ifc_template(
-            "ifc/placement/object-placement.json.jinja",
+    prt = g.value(p, IFC_CONCEPTS["placementrelto"])
+    if prt is not None:
+        prt_entity = get_entity_id(g, prt)
+        pj = render_ifc_template(
+            "ifc/placement/placement-rel-to.json.jinja",
             placement_id=entity,
+            ref_placement_id=prt_entity,
         )
-        placements.extend(e)
-
-        prt = g.value(p, IFC_CONCEPTS["placementrelto"])
-        if prt is not None:
-            prt_entity = get_entity_id(g, prt)
-            pj = render_ifc_template(
-                "ifc/placement/placement-rel-to.json.jinja",
-                placement_id=entity,
-                ref_placement_id=prt_entity,
-            )
-        else:
-            # TODO Adding world_frame to all local placements,
-            #  but this needs to be reviewed as it depends on the geometric context
-            pj = render_ifc_template(
-                "ifc/placement/placement-rel-to.json.jinja",
-                placement_id=entity,
-                world_frame=True,
-            )
-            world_frame.append(pj)
-        placements.extend(pj)
+    else:
+        # TODO Adding world_frame to all local placements,
+        #  but this needs to be reviewed as it depends on the geometric context
+        pj = render_ifc_template(
+            "ifc/placement/placement-rel-to.json.jinja",
+            placement_id=entity,
+            world_frame=True,
+        )
+    placements.extend(pj)
 
-        rp = g.value(p, IFC_CONCEPTS["relativeplacement"])
-        ap = transform_axis_placement_3d(g, rp, entity, length_unit)
-        placements.extend(ap)
+    rp = g.value(p, IFC_CONCEPTS["relativeplacement"])
+    ap = transform_axis_placement_3d(g, rp, entity, length_unit)
+    placements.extend(ap)
 
     return placements
 
@@ -260,7 +347,7 @@ def query_placement_rel_to(g: Graph, placement):
             parent = new_parent
 
 
-def query_ifc_walls(g: Graph, length_unit):
+def query_ifc_walls(g: Graph, length_unit, executor=None):
     wall_concepts = [
         "IFCWALLSTANDARDCASE",
         "IFCWALL",
@@ -277,42 +364,46 @@ def query_ifc_walls(g: Graph, length_unit):
 
     qres = g.query(rep_query)
     logger.info("Total walls: %d", len(qres))
+    walls = [(r["wall"], r["placement"]) for r in qres]
+    return transform_elements(g, transform_ifc_wall, walls, (length_unit,), executor)
+
+
+def transform_ifc_wall(g: Graph, wall, placement, length_unit):
     wall_json = list()
-    for r in qres:
-        wall_id = get_entity_id(g, r["wall"], "wall")
-        placement_id = get_entity_id(g, r["placement"], "placement")
-        logger.debug("%s: %s", wall_id, placement_id)
-        parent = query_placement_rel_to(g, r["placement"])
-        logger.debug(
-            "Highest level parent frame: %s", get_entity_id(g, parent, "placement")
-        )
+    wall_id = get_entity_id(g, wall, "wall")
+    placement_id = get_entity_id(g, placement, "placement")
+    logger.debug("%s: %s", wall_id, placement_id)
+    parent = query_placement_rel_to(g, placement)
+    logger.debug(
+        "Highest level parent frame: %s", get_entity_id(g, parent, "placement")
+    )
 
-        w = render_ifc_template("ifc/walls/wall-entity.json.jinja", wall_id=wall_id)
-        wall_json.append(w)
+    w = render_ifc_template("ifc/walls/wall-entity.json.jinja", wall_id=wall_id)
+    wall_json.append(w)
 
-        # TODO this is hardcoded for now (list of length 1 for this type of wall)
-        representation = query_product_shape_representations(g, r["wall"])[0]
-        for s in g.objects(representation, IFC_CONCEPTS["items"]):
-            depth, position, _, _, g_contents = transform_extruded_area_solid(
-                g, wall_id, s, length_unit
-            )
-            wall_json.extend(g_contents)
+    # TODO this is hardcoded for now (list of length 1 for this type of wall)
+    representation = query_product_shape_representations(g, wall)[0]
+    for s in g.objects(representation, IFC_CONCEPTS["items"]):
+        depth, position, _, _, g_contents = transform_extruded_area_solid(
+            g, wall_id, s, length_unit
+        )
+        wall_json.extend(g_contents)
 
-            w_rep = render_ifc_template(
-                "ifc/walls/wall-representation.json.jinja",
-                wall_id=wall_id,
-                depth=depth,
-                length_unit=length_unit,
-            )
-            wall_json.append(w_rep)
+        w_rep = render_ifc_template(
+            "ifc/walls/wall-representation.json.jinja",
+            wall_id=wall_id,
+            depth=depth,
+            length_unit=length_unit,
+        )
+        wall_json.append(w_rep)
 
-            # Wall placement
-            # TODO for now it assumes position is not None
-            # TODO this also implies that position is 0, 0?
-            obj_placement = create_obj_placement(
-                g, wall_id, placement_id, position, length_unit
-            )
-            wall_json.extend(obj_placement)
+        # Wall placement
+        # TODO for now it assumes position is not None
+        # TODO this also implies that position is 0, 0?
+        obj_placement = create_obj_placement(
+            g, wall_id, placement_id, position, length_unit
+        )
+        wall_json.extend(obj_placement)
 
     return wall_json
 
@@ -586,7 +677,7 @@ def transform_mapped_extruded_area_solid(
     return graph_contents
 
 
-def query_ifc_doors(g: Graph, length_unit):
+def query_ifc_doors(g: Graph, length_unit, executor=None):
     door_wall_query = """
     SELECT DISTINCT ?wall ?opening ?door ?voids ?fills
     WHERE {
@@ -606,113 +697,117 @@ def query_ifc_doors(g: Graph, length_unit):
 
     qres = g.query(door_wall_query)
     logger.info("Total Door-Wall relations: %d", len(qres))
+    doors = [(r["wall"], r["opening"], r["door"]) for r in qres]
+    return transform_elements(g, transform_ifc_door, doors, (length_unit,), executor)
+
+
+def transform_ifc_door(g: Graph, wall, opening, door, length_unit):
     graph_contents = list()
-    for r in qres:
-        wall_id = get_entity_id(g, r["wall"], "wall")
-        opening_id = get_entity_id(g, r["opening"], "opening")
-        door_id = get_entity_id(g, r["door"], "door")
-        logger.debug("%s <-- voids -- %s <-- fills -- %s", wall_id, opening_id, door_id)
-
-        d = render_ifc_template(
-            "ifc/doors/door-entity.json.jinja",
-            door_id=door_id,
-        )
-        graph_contents.append(d)
+    wall_id = get_entity_id(g, wall, "wall")
+    opening_id = get_entity_id(g, opening, "opening")
+    door_id = get_entity_id(g, door, "door")
+    logger.debug("%s <-- voids -- %s <-- fills -- %s", wall_id, opening_id, door_id)
+
+    d = render_ifc_template(
+        "ifc/doors/door-entity.json.jinja",
+        door_id=door_id,
+    )
+    graph_contents.append(d)
 
-        f = render_ifc_template(
-            "ifc/doors/filling-rel.json.jinja",
-            door_id=door_id,
-            opening_id=opening_id,
-        )
+    f = render_ifc_template(
+        "ifc/doors/filling-rel.json.jinja",
+        door_id=door_id,
+        opening_id=opening_id,
+    )
 
-        o = render_ifc_template(
-            "ifc/openings/entryway-entity.json.jinja",
-            opening_id=opening_id,
-        )
-        graph_contents.append(o)
+    o = render_ifc_template(
+        "ifc/openings/entryway-entity.json.jinja",
+        opening_id=opening_id,
+    )
+    graph_contents.append(o)
 
-        v = render_ifc_template(
-            "ifc/openings/voiding-rel.json.jinja",
-            opening_id=opening_id,
-            wall_id=wall_id,
-        )
-        graph_contents.append(v)
+    v = render_ifc_template(
+        "ifc/openings/voiding-rel.json.jinja",
+        opening_id=opening_id,
+        wall_id=wall_id,
+    )
+    graph_contents.append(v)
+
+    logger.info("Processing doorway %s", opening_id)
+    opening_reps = query_product_shape_representations(g, opening)
 
-        logger.info("Processing doorway %s", opening_id)
-        opening_reps = query_product_shape_representations(g, r["opening"])
+    opening_placement = g.value(opening, IFC_CONCEPTS["objectplacement"])
+    opening_placement_id = get_entity_id(g, opening_placement, "placement")
+    parent = query_placement_rel_to(g, opening_placement)
 
-        opening_placement = g.value(r["opening"], IFC_CONCEPTS["objectplacement"])
-        opening_placement_id = get_entity_id(g, opening_placement, "placement")
-        parent = query_placement_rel_to(g, opening_placement)
+    # TODO The current test file only has a single door, test with a case with multiple mapped items
 
-        # TODO The current test file only has a single door, test with a case with multiple mapped items
+    for op_shape in g.objects(opening_reps, IFC_CONCEPTS["items"]):
+        rep, origin, target = query_mapped_item(g, op_shape)
+        origin_id = opening_id + "-" + get_entity_id(g, origin, "mapping-origin")
+        target_id = get_entity_id(g, target, "mapping-target")
 
-        for op_shape in g.objects(opening_reps, IFC_CONCEPTS["items"]):
-            rep, origin, target = query_mapped_item(g, op_shape)
-            origin_id = opening_id + "-" + get_entity_id(g, origin, "mapping-origin")
-            target_id = get_entity_id(g, target, "mapping-target")
+        graph_contents.extend(
+            transform_mapped_item(
+                g, origin, origin_id, target, opening_placement_id, length_unit
+            )
+        )
 
+        # Get the IfcRepresentationItems
+        for o in g.objects(rep, IFC_CONCEPTS["items"]):
             graph_contents.extend(
-                transform_mapped_item(
-                    g, origin, origin_id, target, opening_placement_id, length_unit
+                transform_mapped_extruded_area_solid(
+                    g, o, opening_id, origin_id, length_unit
                 )
             )
 
-            # Get the IfcRepresentationItems
-            for o in g.objects(rep, IFC_CONCEPTS["items"]):
-                graph_contents.extend(
-                    transform_mapped_extruded_area_solid(
-                        g, o, opening_id, origin_id, length_unit
-                    )
-                )
+    logger.info("Processing door %s", door_id)
+    door_reps = query_product_shape_representations(g, door)
+    door_placement = g.value(door, IFC_CONCEPTS["objectplacement"])
+    door_placement_id = get_entity_id(g, door_placement, "placement")
+    parent = query_placement_rel_to(g, door_placement)
 
-        logger.info("Processing door %s", door_id)
-        door_reps = query_product_shape_representations(g, r["door"])
-        door_placement = g.value(r["door"], IFC_CONCEPTS["objectplacement"])
-        door_placement_id = get_entity_id(g, door_placement, "placement")
-        parent = query_placement_rel_to(g, door_placement)
+    for d_shape in g.objects(door_reps, IFC_CONCEPTS["items"]):
+        rep, origin, target = query_mapped_item(g, d_shape)
+        origin_id = door_id + "-" + get_entity_id(g, origin, "mapping-origin")
+        target_id = get_entity_id(g, target, "mapping-target")
 
-        for d_shape in g.objects(door_reps, IFC_CONCEPTS["items"]):
-            rep, origin, target = query_mapped_item(g, d_shape)
-            origin_id = door_id + "-" + get_entity_id(g, origin, "mapping-origin")
-            target_id = get_entity_id(g, target, "mapping-target")
+        graph_contents.extend(
+            transform_mapped_item(
+                g, origin, origin_id, target, door_placement_id, length_unit
+            )
+        )
 
-            graph_contents.extend(
-                transform_mapped_item(
-                    g, origin, origin_id, target, door_placement_id, length_unit
+        aspects = {}
+        for i in g.objects(rep, IFC_CONCEPTS["items"]):
+            shape_aspect = str(get_shape_aspect(g, i)).lower()
+            if shape_aspect in ["framing", "lining", "panel", "handle"]:
+                aspect_id = aspects.setdefault(shape_aspect, 1)
+                parent_id = f"{door_id}-{shape_aspect}-{aspect_id}"
+                aspects[shape_aspect] = aspect_id + 1
+                sa = render_ifc_template(
+                    "ifc/base/shape-aspect.json.jinja",
+                    parent_id=door_id,
+                    element_id=parent_id,
+                    element_type=f"Door{shape_aspect.capitalize()}",
+                    property=shape_aspect,
                 )
-            )
+                graph_contents.extend(sa)
+            else:
+                raise ValueError("Unknown shape aspect: %s" % shape_aspect)
 
-            aspects = {}
-            for i in g.objects(rep, IFC_CONCEPTS["items"]):
-                shape_aspect = str(get_shape_aspect(g, i)).lower()
-                if shape_aspect in ["framing", "lining", "panel", "handle"]:
-                    aspect_id = aspects.setdefault(shape_aspect, 1)
-                    parent_id = f"{door_id}-{shape_aspect}-{aspect_id}"
-                    aspects[shape_aspect] = aspect_id + 1
-                    sa = render_ifc_template(
-                        "ifc/base/shape-aspect.json.jinja",
-                        parent_id=door_id,
-                        element_id=parent_id,
-                        element_type=f"Door{shape_aspect.capitalize()}",
-                        property=shape_aspect,
-                    )
-                    graph_contents.extend(sa)
-                else:
-                    raise ValueError("Unknown shape aspect: %s" % shape_aspect)
-
-                if g.value(i, RDF["type"]) == IFC_CONCEPTS["IFCPOLYGONALFACESET"]:
-                    shape = transform_polygonal_face_set(
-                        g, i, parent_id, length_unit, placement_id=origin_id
-                    )
-                    graph_contents.extend(shape)
-                elif g.value(i, RDF["type"]) == IFC_CONCEPTS["IFCEXTRUDEDAREASOLID"]:
-                    shape = transform_mapped_extruded_area_solid(
-                        g, i, parent_id, origin_id, length_unit
-                    )
-                    graph_contents.extend(shape)
-                else:
-                    logger.warning("Shape is %s", g.value(i, RDF["type"]))
+            if g.value(i, RDF["type"]) == IFC_CONCEPTS["IFCPOLYGONALFACESET"]:
+                shape = transform_polygonal_face_set(
+                    g, i, parent_id, length_unit, placement_id=origin_id
+                )
+                graph_contents.extend(shape)
+            elif g.value(i, RDF["type"]) == IFC_CONCEPTS["IFCEXTRUDEDAREASOLID"]:
+                shape = transform_mapped_extruded_area_solid(
+                    g, i, parent_id, origin_id, length_unit
+                )
+                graph_contents.extend(shape)
+            else:
+                logger.warning("Shape is %s", g.value(i, RDF["type"]))
 
     return graph_contents
 
@@ -767,40 +862,47 @@ def transform_polygonal_face_set(g, element, parent_id, length_unit, placement_i
     return poly
 
 
-def query_ifc_spaces(g: Graph, model_name, length_unit):
-    graph_contents = []
-    spaces = []
-    for s in g.subjects(RDF.type, IFC_CONCEPTS["IFCSPACE"]):
-        space_id = get_entity_id(g, s, "space")
-        spaces.append(space_id)
-
-        space_placement = g.value(s, IFC_CONCEPTS["objectplacement"])
-        space_placement_id = get_entity_id(g, space_placement, "placement")
-        logger.info("Processing %s", space_id)
-        space_json = render_ifc_template(
-            "ifc/spaces/space-entity.json.jinja",
-            space_id=space_id,
-            space_ref_frame=space_placement_id,
-            model_name=model_name,
-            length_unit=length_unit,
-        )
-        graph_contents.extend(space_json)
-
-        space_reps = query_product_shape_representations(g, s)
-        for space_shape in g.objects(space_reps, IFC_CONCEPTS["items"]):
-            space_shape_rep = get_space_shape_rep(
-                g, space_shape, space_id, length_unit, space_placement_id
-            )
-            graph_contents.extend(space_shape_rep)
+def query_ifc_spaces(g: Graph, model_name, length_unit, executor=None):
+    spaces = [(s,) for s in g.subjects(RDF.type, IFC_CONCEPTS["IFCSPACE"])]
+    graph_contents = transform_elements(
+        g, transform_ifc_space, spaces, (model_name, length_unit), executor
+    )
+    space_ids = [get_entity_id(g, s, "space") for s, in spaces]
 
     # TODO This is needed because "spaces" in the metamodel has a @list container. It should probably be a set instead
-    graph_contents.append({"@id": model_name, "spaces": spaces})
+    graph_contents.append({"@id": model_name, "spaces": space_ids})
     print("Getting boundaries!")
-    boundaries = get_wall_space_boundaries(g, length_unit)
+    boundaries = get_wall_space_boundaries(g, length_unit, executor=executor)
     graph_contents.extend(boundaries)
     return graph_contents
 
 
+def transform_ifc_space(g: Graph, s, model_name, length_unit):
+    graph_contents = []
+    space_id = get_entity_id(g, s, "space")
+
+    space_placement = g.value(s, IFC_CONCEPTS["objectplacement"])
+    space_placement_id = get_entity_id(g, space_placement, "placement")
+    logger.info("Processing %s", space_id)
+    space_json = render_ifc_template(
+        "ifc/spaces/space-entity.json.jinja",
+        space_id=space_id,
+        space_ref_frame=space_placement_id,
+        model_name=model_name,
+        length_unit=length_unit,
+    )
+    graph_contents.extend(space_json)
+
+    space_reps = query_product_shape_representations(g, s)
+    for space_shape in g.objects(space_reps, IFC_CONCEPTS["items"]):
+        space_shape_rep = get_space_shape_rep(
+            g, space_shape, space_id, length_unit, space_placement_id
+        )
+        graph_contents.extend(space_shape_rep)
+
+    return graph_contents
+
+
 def get_space_shape_rep(
     g: Graph, space_shape, space_id, length_unit, space_placement_id=None
 ):
@@ -916,7 +1018,9 @@ def query_ifc_units(g: Graph):
     return list(qres)[0]
 
 
-def query_ifc_task_elements(g, length_unit, elements=["IFCOUTLET", "IFCDUCTSEGMENT"]):
+def query_ifc_task_elements(
+    g, length_unit, elements=["IFCOUTLET", "IFCDUCTSEGMENT"], executor=None
+):
     logger.info("Querying for: {}".format(elements))
     task_query = """
     SELECT DISTINCT ?wall ?opening ?object ?voids ?fills
@@ -942,69 +1046,79 @@ def query_ifc_task_elements(g, length_unit, elements=["IFCOUTLET", "IFCDUCTSEGME
         logger.info("Processing {}s".format(concept))
         qres = g.query(q, initBindings={"object_type": IFC_CONCEPTS[concept]})
         logger.info("Total elements: %d", len(qres))
-        for row in qres:
-            wall_id = get_entity_id(g, row["wall"], "wall")
-            opening_id = get_entity_id(g, row["opening"], "opening")
-            object_id = get_entity_id(
-                g, row["object"], concept.replace("IFC", "").lower()
-            )
-            logger.info("Processing {}".format(object_id))
-            logger.debug(
-                "%s <-- voids -- %s <-- fills -- %s", wall_id, opening_id, object_id
-            )
+        task_elements = [(r["wall"], r["opening"], r["object"]) for r in qres]
+        task_contents = transform_elements(
+            g,
+            transform_ifc_task_element,
+            task_elements,
+            (concept, length_unit),
+            executor,
+        )
+        graph_contents.extend(task_contents)
 
-            space, space_placement, plane_pos, plane_shape = query_space_boundary_rel(
-                g, row["object"]
-            )
-            plane_id = object_id + "-milling"
-            plane_pos = transform_axis_placement_3d(g, plane_pos, plane_id, length_unit)
-            graph_contents.extend(plane_pos)
-            space_placement_id = get_entity_id(g, space_placement, "placement")
-            space_id = get_entity_id(g, space, "space")
-            plane_placement = render_ifc_template(
-                "ifc/placement/object-placement.json.jinja",
-                placement_id=plane_id,
-            )
-            graph_contents.extend(plane_placement)
-            plane_rel_to = render_ifc_template(
-                "ifc/placement/placement-rel-to.json.jinja",
-                placement_id=plane_id,
-                ref_placement_id=space_placement_id,
+    return graph_contents
+
+
+def transform_ifc_task_element(g, wall, opening, element, concept, length_unit):
+    graph_contents = list()
+    wall_id = get_entity_id(g, wall, "wall")
+    opening_id = get_entity_id(g, opening, "opening")
+    object_id = get_entity_id(g, element, concept.replace("IFC", "").lower())
+    logger.info("Processing {}".format(object_id))
+    logger.debug("%s <-- voids -- %s <-- fills -- %s", wall_id, opening_id, object_id)
+
+    space, space_placement, plane_pos, plane_shape = query_space_boundary_rel(
+        g, element
+    )
+    plane_id = object_id + "-milling"
+    plane_pos = transform_axis_placement_3d(g, plane_pos, plane_id, length_unit)
+    graph_contents.extend(plane_pos)
+    space_placement_id = get_entity_id(g, space_placement, "placement")
+    space_id = get_entity_id(g, space, "space")
+    plane_placement = render_ifc_template(
+        "ifc/placement/object-placement.json.jinja",
+        placement_id=plane_id,
+    )
+    graph_contents.extend(plane_placement)
+    plane_rel_to = render_ifc_template(
+        "ifc/placement/placement-rel-to.json.jinja",
+        placement_id=plane_id,
+        ref_placement_id=space_placement_id,
+    )
+    graph_contents.extend(plane_rel_to)
+    plane_normal = render_ifc_template(
+        "ifc/task-elements/milling-task.json.jinja",
+        placement_id=plane_id,
+        element_id=plane_id,
+        opening_id=opening_id,
+        wall_id=wall_id,
+        length_unit=length_unit,
+        space_id=space_id,
+    )
+    graph_contents.extend(plane_normal)
+
+    opening_placement = g.value(opening, IFC_CONCEPTS["objectplacement"])
+    opening_placement_id = get_entity_id(g, opening_placement, "placement")
+
+    opening_reps = query_product_shape_representations(g, opening)
+    for rep in g.objects(opening_reps, IFC_CONCEPTS["items"]):
+        logger.debug("Shape representation: %s", g.value(rep, RDF["type"]))
+        if g.value(rep, RDF["type"]) == IFC_CONCEPTS["IFCEXTRUDEDAREASOLID"]:
+            meas = transform_mapped_extruded_area_solid(
+                g, rep, opening_id, opening_placement_id, length_unit
             )
-            graph_contents.extend(plane_rel_to)
-            plane_normal = render_ifc_template(
-                "ifc/task-elements/milling-task.json.jinja",
-                placement_id=plane_id,
-                element_id=plane_id,
-                opening_id=opening_id,
-                wall_id=wall_id,
-                length_unit=length_unit,
-                space_id=space_id,
+            graph_contents.extend(meas)
+        elif g.value(rep, RDF["type"]) == IFC_CONCEPTS["IFCPOLYGONALFACESET"]:
+            poly = transform_polygonal_face_set(
+                g,
+                rep,
+                opening_id,
+                length_unit,
+                placement_id=opening_placement_id,
             )
-            graph_contents.extend(plane_normal)
-
-            opening_placement = g.value(row["opening"], IFC_CONCEPTS["objectplacement"])
-            opening_placement_id = get_entity_id(g, opening_placement, "placement")
-
-            opening_reps = query_product_shape_representations(g, row["opening"])
-            for rep in g.objects(opening_reps, IFC_CONCEPTS["items"]):
-                logger.debug("Shape representation: %s", g.value(rep, RDF["type"]))
-                if g.value(rep, RDF["type"]) == IFC_CONCEPTS["IFCEXTRUDEDAREASOLID"]:
-                    meas = transform_mapped_extruded_area_solid(
-                        g, rep, opening_id, opening_placement_id, length_unit
-                    )
-                    graph_contents.extend(meas)
-                elif g.value(rep, RDF["type"]) == IFC_CONCEPTS["IFCPOLYGONALFACESET"]:
-                    poly = transform_polygonal_face_set(
-                        g,
-                        rep,
-                        opening_id,
-                        length_unit,
-                        placement_id=opening_placement_id,
-                    )
-                    graph_contents.extend(poly)
-                else:
-                    logger.warning("Not a supported shape representation")
+            graph_contents.extend(poly)
+        else:
+            logger.warning("Not a supported shape representation")
 
     return graph_contents
 
@@ -1029,7 +1143,9 @@ def query_space_boundary_rel(g: Graph, obj):
     return res["space"], res["space_placement"], res["position"], res["shape"]
 
 
-def get_wall_space_boundaries(g: Graph, length_unit, objects=("IFCWALL", "IFCSLAB")):
+def get_wall_space_boundaries(
+    g: Graph, length_unit, objects=("IFCWALL", "IFCSLAB"), executor=None
+):
     graph_contents = []
     rep_query = """
     SELECT DISTINCT ?object ?space ?position ?shape ?space_placement
@@ -1046,50 +1162,62 @@ def get_wall_space_boundaries(g: Graph, length_unit, objects=("IFCWALL", "IFCSLA
     """
     for obj in objects:
         print(obj)
-        obj_type = obj.lower().replace("ifc", "")
         qres = g.query(rep_query, initBindings={"obj_type": IFC_CONCEPTS[obj]})
-        for element, space, position, shape, space_placement in qres:
-            print("\t", shape)
-            space_id = get_entity_id(g, space, "space")
-            element_id = get_entity_id(g, element, obj_type)
-            space_placement_id = get_entity_id(g, space_placement, "placement")
-            plane_id = f"{space_id}-{element_id}"
-
-            boundary_ = render_ifc_template(
-                "ifc/spaces/space-boundary.json.jinja",
-                plane_id=plane_id,
-                plane_type=FP["SpaceBoundary"],
-                space_id=space_id,
-                element_id=element_id,
-                property=FP[obj_type],
-            )
-            graph_contents.extend(boundary_)
+        boundaries = [tuple(r) for r in qres]
+        obj_contents = transform_elements(
+            g, transform_space_boundary, boundaries, (obj, length_unit), executor
+        )
+        graph_contents.extend(obj_contents)
 
-            plane_pos = transform_axis_placement_3d(g, position, plane_id, length_unit)
-            graph_contents.extend(plane_pos)
+    return graph_contents
 
-            plane_placement = render_ifc_template(
-                "ifc/placement/object-placement.json.jinja",
-                placement_id=plane_id,
-            )
-            graph_contents.extend(plane_placement)
 
-            plane_rel_to = render_ifc_template(
-                "ifc/placement/placement-rel-to.json.jinja",
-                placement_id=plane_id,
-                ref_placement_id=space_placement_id,
-            )
-            graph_contents.extend(plane_rel_to)
-
-            coords = get_points_polycurve(g, g.value(shape, IFC_CONCEPTS["points"]))
-            polygon = render_ifc_template(
-                "ifc/walls/wall-polygon.json.jinja",
-                parent_id=plane_id,
-                element_id=plane_id,
-                coords=coords,
-                length_unit=length_unit,
-            )
-            graph_contents.extend(polygon)
+def transform_space_boundary(
+    g: Graph, element, space, position, shape, space_placement, obj, length_unit
+):
+    graph_contents = []
+    obj_type = obj.lower().replace("ifc", "")
+    print("\t", shape)
+    space_id = get_entity_id(g, space, "space")
+    element_id = get_entity_id(g, element, obj_type)
+    space_placement_id = get_entity_id(g, space_placement, "placement")
+    plane_id = f"{space_id}-{element_id}"
+
+    boundary_ = render_ifc_template(
+        "ifc/spaces/space-boundary.json.jinja",
+        plane_id=plane_id,
+        plane_type=FP["SpaceBoundary"],
+        space_id=space_id,
+        element_id=element_id,
+        property=FP[obj_type],
+    )
+    graph_contents.extend(boundary_)
+
+    plane_pos = transform_axis_placement_3d(g, position, plane_id, length_unit)
+    graph_contents.extend(plane_pos)
+
+    plane_placement = render_ifc_template(
+        "ifc/placement/object-placement.json.jinja",
+        placement_id=plane_id,
+    )
+    graph_contents.extend(plane_placement)
+
+    plane_rel_to = render_ifc_template(
+        "ifc/placement/placement-rel-to.json.jinja",
+        placement_id=plane_id,
+        ref_placement_id=space_placement_id,
+    )
+    graph_contents.extend(plane_rel_to)
+
+    coords = get_points_polycurve(g, g.value(shape, IFC_CONCEPTS["points"]))
+    polygon = render_ifc_template(
+        "ifc/walls/wall-polygon.json.jinja",
+        parent_id=plane_id,
+        element_id=plane_id,
+        coords=coords,
+        length_unit=length_unit,
+    )
+    graph_contents.extend(polygon)
 
     return graph_contents
 
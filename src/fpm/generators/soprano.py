@@ -5,14 +5,13 @@ from rdflib import Graph, RDF
 from transforms3d.quaternions import mat2quat
 
 from fpm.constants import FP, POLY, GEO, COORD, GEOM, BDD_ENV
+from fpm.geometry import get_geometry_model
 from fpm.graph import (
-    get_3d_structure,
-    get_coordinates_map,
     prefixed,
     get_unit_multiplier,
     get_list_values,
     get_point_position,
-    get_waypoint_coord_wrt_world,
+    get_points_wrt_world,
     get_list_from_ptr,
     get_pose_transform_wrt_world,
     get_coordinates,
@@ -42,21 +41,17 @@ def gen_tts_wall_description(g, base_path, **kwargs):
     template_path = kwargs.get("template_path")
     output_path = get_output_path(base_path, "soprano/hdt")
 
-    entryways_elements = get_3d_structure(g, "Entryway")
-    window_elements = get_3d_structure(g, "Window")
+    geometry = get_geometry_model(g)
+    entryways_elements = geometry.get_3d_structure("Entryway")
+    window_elements = geometry.get_3d_structure("Window")
     openings = dict()
-    for entryway in entryways_elements:
-        voids = entryway.get("voids")
-        e = get_dim_and_center(entryway)
+    for opening in entryways_elements + window_elements:
+        voids = opening.get("voids")
+        e = get_dim_and_center(opening)
         for w in voids:
             openings.setdefault(w, list()).append(e)
 
-    for window in window_elements:
-        voids = window.get("voids")
-        e = get_dim_and_center(window)
-        openings.setdefault(voids, list()).append(e)
-
-    wall_elements = get_3d_structure(g, "Wall")
+    wall_elements = geometry.get_3d_structure("Wall")
     model = list()
     for wall in wall_elements:
         w = get_dim_and_center(wall)
@@ -75,7 +70,6 @@ def gen_tts_wall_description(g, base_path, **kwargs):
 def get_outlet_milling_task(g: Graph, element_type="Opening", **kwargs):
     logger.info("Getting 3D structure of all {}s...".format(element_type))
     elements = list()
-    coords_m = get_coordinates_map(g)
     for e, _, _ in g.triples((None, RDF.type, FP[element_type])):
         name = prefixed(g, e).split(":")[-1]
         space, workspace = get_space_and_workspace(g, e)
@@ -104,10 +98,8 @@ def get_outlet_milling_task(g: Graph, element_type="Opening", **kwargs):
         p = get_point_position(g, center)
         pp = dict(**p)
         pp["z"] = axis[-1].toPython() * height
-        positions = list()
-        for coord in [p, pp]:
-            x, y, z = get_waypoint_coord_wrt_world(g, coord, coords_m)
-            positions.append((x, y, z))
+        positions = [tuple(c) for c in get_points_wrt_world(g, [p, pp]).tolist()]
+        x, y, z = positions[-1]
         logger.debug("Milling vector: %s", positions)
 
         plane = get_milling_plane(g, e)
@@ -204,9 +196,7 @@ def get_duct_milling_task(g: Graph, element_type="Opening", **kwargs):
         m_start_wrt_world = get_pose_transform_wrt_world(g, start_pose_ref)
 
         end_position = get_point_position(g, end)
-        coords_m = get_coordinates_map(g)
-        end_position_coord = get_waypoint_coord_wrt_world(g, end_position, coords_m)
-        end_position_coord = np.array(end_position_coord)
+        end_position_coord = get_points_wrt_world(g, [end_position])[0]
 
         # Find both faces that are parallel to ground
         faces = rdflib.collection.Collection(
@@ -216,13 +206,8 @@ def get_duct_milling_task(g: Graph, element_type="Opening", **kwargs):
         all_faces = []
         for f in faces:
             face = rdflib.collection.Collection(g, f)
-            face_coords = []
-            for point in face:
-                p = get_point_position(g, point)
-
-                x, y, z = get_waypoint_coord_wrt_world(g, p, coords_m)
-                face_coords.append((x, y, z))
-            face_coords = np.array(face_coords)
+            points = [get_point_position(g, point) for point in face]
+            face_coords = get_points_wrt_world(g, points)
             if np.allclose(face_coords[:, 2], face_coords[0, 2]):
                 all_faces.append(face_coords)
 
@@ -0,0 +1,363 @@
+import logging
+
+import numpy as np
+from rdflib import RDF, Graph
+
+from fpm import snapshot
+from fpm.constants import FP, POLY
+from fpm.graph import (
+    get_graph_cache,
+    get_list_values,
+    get_list_from_ptr,
+    get_point_position,
+    get_transform_index,
+    get_unit_multiplier,
+    prefixed,
+)
+
+logger = logging.getLogger("floorplan.geometry")
+logger.setLevel(logging.DEBUG)
+
+ELEMENT_TYPES = (
+    "Space",
+    "Wall",
+    "Column",
+    "Divider",
+    "Door",
+    "DoorLining",
+    "Entryway",
+    "Window",
+)
+OPENING_TYPES = ("Entryway", "Window")
+
+
+class GeometryElement:
+    """Floorplan element of a geometry model
+
+    The points, faces and polygon slices index the arrays of the model:
+    - points: vertices of the polyhedron (3d-shape) of the element
+    - faces: faces of the polyhedron
+    - polygon: vertices of the polygon (shape) of the element
+    """
+
+    __slots__ = (
+        "index",
+        "name",
+        "element_type",
+        "height",
+        "voids",
+        "points",
+        "faces",
+        "polygon",
+    )
+
+    def __init__(self, index, name, element_type):
+        self.index = index
+        self.name = name
+        self.element_type = element_type
+        self.height = None
+        self.voids = ()
+        self.points = slice(0, 0)
+        self.faces = slice(0, 0)
+        self.polygon = slice(0, 0)
+
+    def __repr__(self):
+        return "GeometryElement({}, {})".format(self.element_type, self.name)
+
+
+class GeometryModel:
+    """Geometry of the floorplan elements in contiguous arrays
+
+    - local_vertices: (V,3) coordinates of each vertex wrt the frame it is seen by
+    - vertex_frames: (V,) index of the frame each vertex is seen by
+    - vertices: (V,3) coordinates of each vertex wrt the world frame
+    - face_vertices: indices of the vertices of all faces, one face after the other
+    - face_offsets: (F+1,) start of each face in face_vertices
+    - frames: names of the frames the vertices are seen by
+    - frame_transforms: (N,4,4) transformation of each frame wrt the world frame
+    - element_types: names of the element types
+    - element_tags: (E,) index of the type of each element
+    - names: names of the elements
+    - wall_sets: names of the walls of each element with walls (e.g. spaces)
+    """
+
+    __slots__ = (
+        "local_vertices",
+        "vertex_frames",
+        "vertices",
+        "face_vertices",
+        "face_offsets",
+        "frames",
+        "frame_transforms",
+        "element_types",
+        "element_tags",
+        "names",
+        "elements",
+        "wall_sets",
+        "_by_name",
+    )
+
+    def __init__(
+        self,
+        local_vertices,
+        vertex_frames,
+        face_vertices,
+        face_offsets,
+        frames,
+        frame_transforms,
+        elements,
+        wall_sets,
+    ):
+        self.local_vertices = local_vertices
+        self.vertex_frames = vertex_frames
+        self.face_vertices = face_vertices
+        self.face_offsets = face_offsets
+        self.frames = frames
+        self.frame_transforms = frame_transforms
+        self.elements = elements
+        self.wall_sets = wall_sets
+        self.names = [e.name for e in elements]
+        self.element_types = tuple(dict.fromkeys(e.element_type for e in elements))
+        self.element_tags = np.array(
+            [self.element_types.index(e.element_type) for e in elements],
+            dtype=np.uint8,
+        )
+        self._by_name = {e.name: e for e in elements}
+        self.vertices = self.to_world(local_vertices, vertex_frames)
+
+    def to_world(self, local_vertices, vertex_frames):
+        """Transform (N,3) local coordinates with the frame of each vertex"""
+        homogeneous = np.ones((len(local_vertices), 4))
+        homogeneous[:, :3] = local_vertices
+        T = self.frame_transforms[vertex_frames]
+        return np.einsum("nij,nj->ni", T, homogeneous)[:, :3]
+
+    def get_element(self, name):
+        return self._by_name.get(name)
+
+    def get_elements(self, element_type):
+        if element_type not in self.element_types:
+            return []
+        tag = self.element_types.index(element_type)
+        return [self.elements[i] for i in np.flatnonzero(self.element_tags == tag)]
+
+    def get_vertices(self, element, threshold=None):
+        """World coordinates of the polyhedron vertices of an element
+
+        If a threshold is given, the vertices are moved along the y-axis of their
+        frame, away from y=0, which makes openings slightly thicker than their walls.
+        """
+        if threshold is None:
+            return self.vertices[element.points]
+        local = self.local_vertices[element.points].copy()
+        local[:, 1] = np.where(
+            local[:, 1] == 0.0, local[:, 1] - threshold, local[:, 1] + threshold
+        )
+        return self.to_world(local, self.vertex_frames[element.points])
+
+    def get_face_indices(self, element):
+        """Model-wide vertex indices of each face of an element"""
+        offsets = self.face_offsets[element.faces.start : element.faces.stop + 1]
+        return [self.face_vertices[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+
+    def get_faces(self, element):
+        """Vertex indices of each face of an element, relative to its own vertices"""
+        start = element.points.start
+        return [(f - start).tolist() for f in self.get_face_indices(element)]
+
+    def get_polygon(self, element):
+        """World coordinates of the polygon vertices of an element"""
+        return self.vertices[element.polygon]
+
+    def get_polygon_coord_array(self, element):
+        """(N,4) array of [x, y, 0, 1] world coordinates of the polygon of an element"""
+        polygon = self.get_polygon(element)
+        coords = np.zeros((len(polygon), 4))
+        coords[:, :2] = polygon[:, :2]
+        coords[:, 3] = 1
+        return coords
+
+    def get_3d_structure(self, element_type="Wall", threshold=0.05):
+        """Same structure as fpm.graph.get_3d_structure, without querying the graph"""
+        elements = list()
+        for e in self.get_elements(element_type):
+            if e.points.start == e.points.stop:
+                continue
+            if element_type in OPENING_TYPES:
+                vertices = self.get_vertices(e, threshold)
+            else:
+                vertices = self.get_vertices(e)
+            d = {
+                "name": e.name,
+                "vertices": vertices.tolist(),
+                "faces": self.get_faces(e),
+            }
+            if element_type in OPENING_TYPES:
+                d["voids"] = list(e.voids)
+            elements.append(d)
+
+        return elements
+
+    def get_internal_walls(self):
+        """Same structure as fpm.graph.get_internal_walls, without querying the graph"""
+        wall_planes_by_space = dict()
+        for space_name, wall_names in self.wall_sets.items():
+            wall_planes = dict()
+            for wall_name in wall_names:
+                inner_wall = list()
+                wall = self.get_element(wall_name)
+                faces = self.get_face_indices(wall) if wall is not None else []
+                for f in faces:
+                    # Only one face (the inner face) will have 4 points aligned with the wall frame
+                    f = f[self.local_vertices[f, 1] == 0.0]
+                    if len(f) == 4:
+                        positions = [tuple(p) for p in self.vertices[f].tolist()]
+                        positions.append(positions[0])  # Close the polygon
+                        inner_wall.append(positions)
+                wall_planes[wall_name] = inner_wall
+            wall_planes_by_space[space_name] = wall_planes
+
+        return wall_planes_by_space
+
+
+class _GeometryBuilder:
+    def __init__(self, g: Graph):
+        self.g = g
+        self.local_vertices = list()
+        self.vertex_frames = list()
+        self.face_vertices = list()
+        self.face_offsets = [0]
+        self.frames = dict()
+        self.elements = list()
+        self.wall_sets = dict()
+
+    def add_points(self, point_nodes):
+        start = len(self.local_vertices)
+        for point in point_nodes:
+            p = get_point_position(self.g, point)
+            self.local_vertices.append((p["x"], p["y"], p["z"]))
+            frame = self.frames.setdefault(p["as-seen-by"], len(self.frames))
+            self.vertex_frames.append(frame)
+        return slice(start, len(self.local_vertices))
+
+    def add_polyhedron(self, element: GeometryElement, poly):
+        g = self.g
+        vertex_nodes = get_list_values(g, poly, POLY["points"])
+        element.points = self.add_points(vertex_nodes)
+
+        index = dict()
+        for i, point in enumerate(vertex_nodes, start=element.points.start):
+            index.setdefault(point, i)
+
+        start = len(self.face_offsets) - 1
+        if g.value(poly, POLY["faces"]) is not None:
+            for f in get_list_values(g, poly, POLY["faces"]):
+                try:
+                    face = [index[point] for point in get_list_from_ptr(g, f)]
+                except KeyError:
+                    raise ValueError(
+                        "A face of {} has points outside of its polyhedron".format(
+                            element.name
+                        )
+                    )
+                self.face_vertices.extend(face)
+                self.face_offsets.append(len(self.face_vertices))
+        element.faces = slice(start, len(self.face_offsets) - 1)
+
+    def add_element(self, e, element_type):
+        g = self.g
+        name = prefixed(g, e).split(":")[-1]
+        element = GeometryElement(len(self.elements), name, element_type)
+
+        poly = g.value(e, FP["3d-shape"])
+        if poly is not None and (poly, RDF.type, POLY["Polyhedron"]) in g:
+            self.add_polyhedron(element, poly)
+
+        polygon = g.value(e, FP["shape"])
+        if polygon is not None and g.value(polygon, POLY["points"]) is not None:
+            element.polygon = self.add_points(
+                get_list_values(g, polygon, POLY["points"])
+            )
+
+        height = g.value(e, FP["height"])
+        if height is not None:
+            element.height = height.toPython() * get_unit_multiplier(g, e)
+
+        if g.value(e, FP["voids"]) is not None:
+            voids = get_list_values(g, e, FP["voids"])
+            element.voids = tuple(prefixed(g, v).split(":")[-1] for v in voids)
+
+        self.elements.append(element)
+
+    def add_wall_sets(self):
+        """Walls of every subject with walls, as in fpm.graph.get_internal_walls"""
+        g = self.g
+        for s in g.subjects(FP["walls"], None):
+            name = prefixed(g, s).split(":")[-1]
+            walls = get_list_values(g, s, FP["walls"])
+            self.wall_sets[name] = tuple(prefixed(g, w).split(":")[-1] for w in walls)
+
+    def build(self):
+        index = get_transform_index(self.g)
+        frame_transforms = np.array(
+            [index.get_world_transform(f) for f in self.frames], dtype=float
+        ).reshape(-1, 4, 4)
+        return GeometryModel(
+            np.array(self.local_vertices, dtype=float).reshape(-1, 3),
+            np.array(self.vertex_frames, dtype=np.int32),
+            np.array(self.face_vertices, dtype=np.int32),
+            np.array(self.face_offsets, dtype=np.int64),
+            list(self.frames),
+            frame_transforms,
+            self.elements,
+            self.wall_sets,
+        )
+
+
+def extract_geometry(g: Graph, element_types=ELEMENT_TYPES):
+    """Extract the geometry of all floorplan elements in a single pass over the graph"""
+    builder = _GeometryBuilder(g)
+    for element_type in element_types:
+        logger.info("Extracting geometry of all {}s...".format(element_type))
+        if element_type == "Space":
+            # Spaces are taken from the floorplan, as in get_space_points
+            floorplan = g.value(predicate=RDF.type, object=FP["FloorPlan"])
+            nodes = get_list_values(g, floorplan, FP["spaces"]) if floorplan else []
+        else:
+            nodes = g.subjects(RDF.type, FP[element_type])
+        for e in nodes:
+            builder.add_element(e, element_type)
+    builder.add_wall_sets()
+
+    model = builder.build()
+    logger.info(
+        "Geometry model: %d elements, %d vertices, %d faces",
+        len(model.elements),
+        len(model.local_vertices),
+        len(model.face_offsets) - 1,
+    )
+    return model
+
+
+def get_geometry_model(g: Graph):
+    """Get the geometry model of a graph, extracting it on first use
+
+    If the graph was loaded from a snapshot, the model is cached with it
+    """
+    cache = get_graph_cache(g)
+    model = cache.get("geometry-model")
+    if model is not None:
+        return model
+
+    key = cache.get("snapshot")
+    if key is not None:
+        # Extracted models are only valid for the code that extracted them
+        code_hash = snapshot.get_code_hash(__name__, "fpm.graph")
+        key = "{}-{}".format(key, code_hash[:16])
+        model = snapshot.load_snapshot(key, "geometry")
+    if model is None:
+        model = extract_geometry(g)
+        if key is not None:
+            snapshot.save_snapshot(key, "geometry", model)
+    cache["geometry-model"] = model
+    return model
@@ -4,16 +4,20 @@ import os
 import glob
 import logging
 import json
-from pyld import jsonld
+import weakref
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
 import rdflib
 from rdflib import RDF, Graph, Literal
+from rdflib.events import Event
+from rdflib.plugins.stores.memory import Memory
+from rdflib.store import TripleAddedEvent, TripleRemovedEvent
 from rdflib.tools.rdf2dot import rdf2dot
 from transforms3d.quaternions import mat2quat
 
-from fpm import traversal
+from fpm import compaction, snapshot, traversal
 from fpm.constants import (
     GEO,
     GEOM,
@@ -28,22 +32,119 @@ from fpm.utils import build_transformation_matrix
 logger = logging.getLogger("floorplan.graph")
 logger.setLevel(logging.DEBUG)
 
+_graph_caches = weakref.WeakKeyDictionary()
+_graph_sizes = weakref.WeakKeyDictionary()
 
-def build_graph_from_directory(inputs: tuple, draw_dot=False):
+
+def get_graph_cache(g: Graph):
+    """Cache for data derived from a graph
+
+    The cache is cleared whenever the graph store reports added or removed triples.
+    rdflib's Memory store does not report removed triples, so the cache is also
+    cleared if the number of triples changed since it was last used.
+    """
+    cache = _graph_caches.get(g)
+    if cache is None:
+        cache = dict()
+
+        def invalidate(event: Event):
+            cache.clear()
+
+        g.store.dispatcher.subscribe(TripleAddedEvent, invalidate)
+        g.store.dispatcher.subscribe(TripleRemovedEvent, invalidate)
+        _graph_caches[g] = cache
+
+    size = len(g)
+    if _graph_sizes.get(g) != size:
+        cache.clear()
+        _graph_sizes[g] = size
+    return cache
+
+
+def build_graph_from_directory(
+    inputs: tuple, draw_dot=False, use_cache=False, workers=1
+):
     # Build the graph by reading all composable models in the input folder
-    g = rdflib.Graph()
+    if use_cache:
+        key = snapshot.get_snapshot_key(snapshot.get_input_files(inputs))
+        cached = snapshot.load_snapshot(key, "graph")
+        if cached is not None:
+            logger.info("Loading graph from snapshot {}".format(key[:12]))
+            g = snapshot.graph_from_snapshot(cached)
+        else:
+            g = _parse_graph_from_directory(inputs, workers)
+            snapshot.save_snapshot(key, "graph", snapshot.graph_to_snapshot(g))
+        # Derived data (e.g. the geometry model) can be cached with the same key,
+        # the entry is cleared if the graph is modified
+        get_graph_cache(g)["snapshot"] = key
+    else:
+        g = _parse_graph_from_directory(inputs, workers)
+
+    if draw_dot:
+        with open("floorplan.dot", "w+") as dotfile:
+            rdf2dot(g, dotfile)
+
+    return g
+
+
+class _BindingLog(Memory):
+    """Memory store that logs the namespace bindings requested while parsing
+
+    No namespace is reported as bound, so the namespace manager passes the requested
+    prefixes through without renaming them. Binding them again in the same order
+    renames them as parsing into the merged graph would.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.bindings = list()
+
+    def bind(self, prefix, namespace, override=True):
+        self.bindings.append((prefix, str(namespace)))
+
+    def namespace(self, prefix):
+        return None
+
+    def prefix(self, namespace):
+        return None
+
+    def namespaces(self):
+        return iter(())
+
+
+def _parse_model_file(file_path: str):
+    store = _BindingLog()
+    g = rdflib.Graph(store=store)
+    g.parse(file_path, format="json-ld")
+    return store.bindings, list(g)
+
+
+def _parse_graph_from_directory(inputs: tuple, workers=1):
+    input_models = list()
     for input_folder in inputs:
-        input_models = glob.glob(os.path.join(input_folder, "*.json"))
-        logger.info("Found {} models in {}".format(len(input_models), input_folder))
+        models = glob.glob(os.path.join(input_folder, "*.json"))
+        logger.info("Found {} models in {}".format(len(models), input_folder))
+        input_models.extend(models)
+
+    g = rdflib.Graph()
+    # workers=None uses a process per CPU
+    if workers == 1 or len(input_models) < 2:
         for file_path in input_models:
             logger.info("Adding {}".format(file_path))
             g.parse(file_path, format="json-ld")
             logger.debug("\t...done!")
+        return g
 
-    if draw_dot:
-        with open("floorplan.dot", "w+") as dotfile:
-            rdf2dot(g, dotfile)
-
+    # Each file is parsed into its own graph in a worker process,
+    # the results are merged in the order of the files
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_parse_model_file, input_models)
+        for file_path, (bindings, triples) in zip(input_models, results):
+            logger.info("Adding {}".format(file_path))
+            for prefix, ns in bindings:
+                g.bind(prefix, ns)
+            g.addN((s, p, o, g) for s, p, o in triples)
+            logger.debug("\t...done!")
     return g
 
 
@@ -63,13 +164,12 @@ def save_compact_graph(g: Graph, output_path: str, model_base_iri: str):
             "https://comp-rob2b.github.io/metamodels/geometry/spatial-relations.json",
         ]
     }
-    d = json.loads(g.serialize(format="json-ld"))
     output_file = os.path.join(output_path, "floorplan.fpm.json")
 
-    compact_graph = jsonld.compact(d, context)
+    compacted = compaction.compact_graph(g, context)
 
     with open(output_file, "w+") as fp:
-        json.dump(compact_graph, fp)
+        json.dump(compacted, fp)
 
     return output_file
 
@@ -98,6 +198,31 @@ def get_list_from_ptr(g: Graph, ptr):
     return result_list
 
 
+def get_list_index(g: Graph):
+    """First item and rest of every node of the RDF lists of a graph"""
+    cache = get_graph_cache(g)
+    index = cache.get("lists")
+    if index is None:
+        rest = dict(g.subject_objects(RDF.rest))
+        index = {
+            ptr: (item, rest.get(ptr)) for ptr, item in g.subject_objects(RDF.first)
+        }
+        cache["lists"] = index
+    return index
+
+
+def get_list_items(g: Graph, ptr):
+    """Items of an RDF list, read from the list index of the graph"""
+    index = get_list_index(g)
+    items = list()
+    while ptr in index:
+        item, ptr = index[ptr]
+        items.append(item)
+        if len(items) > len(index):
+            raise ValueError("RDF list is cyclic")
+    return items
+
+
 def get_point_position(g: Graph, point):
     position = g.value(predicate=GEOM["of"], object=point)
     coordinates = g.value(predicate=COORD["of-position"], object=position)
@@ -138,6 +263,16 @@ def get_floorplan_model_name(g: Graph):
 
 
 def traverse_to_world_origin(g: Graph, frame):
+    cache = get_graph_cache(g)
+    path = cache.get(("world-path", frame))
+    if path is None:
+        path = _traverse_to_world_origin(g, frame)
+        cache[("world-path", frame)] = path
+
+    return list(path)
+
+
+def _traverse_to_world_origin(g: Graph, frame):
     # Go through the geometric relation predicates
     pred_filter = traversal.filter_by_predicates([GEOM["with-respect-to"], GEOM["of"]])
     # Algorithm to traverse the graph
@@ -169,9 +304,12 @@ def traverse_to_world_origin(g: Graph, frame):
     return path
 
 
-def get_transformation_matrix_wrt_frame(g: Graph, root, target):
-    # TODO Refactor this since it's duplicated with utils.py
-    # Only used for the object instances (doors)
+def get_pose_path(g: Graph, root, target):
+    """Poses between two frames, starting from the target frame"""
+    cache = get_graph_cache(g)
+    poses_path = cache.get(("pose-path", root, target))
+    if poses_path is not None:
+        return list(poses_path)
 
     # Configure the traversal algorithm
     f = [GEOM["with-respect-to"], GEOM["of"]]
@@ -198,6 +336,15 @@ def get_transformation_matrix_wrt_frame(g: Graph, root, target):
             poses_path.append(current_node)
         current_node = pose_frame_node_tree[current_node]
 
+    cache[("pose-path", root, target)] = poses_path
+    return list(poses_path)
+
+
+def get_transformation_matrix_wrt_frame(g: Graph, root, target):
+    # TODO Refactor this since it's duplicated with utils.py
+    # Only used for the object instances (doors)
+    poses_path = get_pose_path(g, root, target)
+
     # Calculate and operate the transformation matrices
     T = np.eye(4)
     for pose in poses_path[::-1]:
@@ -307,7 +454,6 @@ def get_3d_structure(g: Graph, element="Wall", threshold=0.05):
     """
     logger.info("Getting 3D structure of all {}s...".format(element))
     elements = list()
-    coords_m = get_coordinates_map(g)
     for e, _, _ in g.triples((None, RDF.type, FP[element])):
         name = prefixed(g, e).split(":")[-1]
 
@@ -315,7 +461,7 @@ def get_3d_structure(g: Graph, element="Wall", threshold=0.05):
         if g.value(poly, RDF.type) != POLY["Polyhedron"]:
             continue
         vertices = get_list_values(g, poly, POLY["points"])
-        positions = list()
+        points = list()
         for point in vertices:
             p = get_point_position(g, point)
             if element in ["Window", "Entryway"]:
@@ -323,9 +469,8 @@ def get_3d_structure(g: Graph, element="Wall", threshold=0.05):
                     p["y"] = p["y"] - threshold
                 else:
                     p["y"] = p["y"] + threshold
-
-            x, y, z = get_waypoint_coord_wrt_world(g, p, coords_m)
-            positions.append((x, y, z))
+            points.append(p)
+        positions = get_points_wrt_world(g, points).tolist()
 
         faces_nodes = get_list_values(g, poly, POLY["faces"])
         faces = list()
@@ -344,7 +489,6 @@ def get_3d_structure(g: Graph, element="Wall", threshold=0.05):
 
 
 def get_internal_walls(g: Graph):
-    coords_m = get_coordinates_map(g)
     logger.info("Getting internal walls...")
     wall_planes_by_space = dict()
     for s, r, w in g.triples((None, FP["walls"], None)):
@@ -358,12 +502,12 @@ def get_internal_walls(g: Graph):
             inner_wall = list()
             for f in faces_nodes:
                 face_vertices = get_list_from_ptr(g, f)
-                positions = list()
+                points = list()
                 for point in face_vertices:
                     p = get_point_position(g, point)
                     if p["y"] == 0.0:
-                        x, y, z = get_waypoint_coord_wrt_world(g, p, coords_m)
-                        positions.append((x, y, z))
+                        points.append(p)
+                positions = [tuple(c) for c in get_points_wrt_world(g, points).tolist()]
 
                 # Only one face (the inner face) will have 4 points aligned with the wall frame
                 if len(positions) == 4:
@@ -455,46 +599,149 @@ def get_path_positions(g: Graph, path):
     return positions
 
 
-def get_waypoint_coord_wrt_world(g: Graph, point, coordinates_map):
-    """Gets the coordinates of a point wrt world frame"""
-
-    frame = point["as-seen-by"]
+def compose_frame_transform_wrt_world(g: Graph, frame, coordinates_map):
+    """Compose the transformation matrix that maps points seen by a frame to the world frame"""
     path = traverse_to_world_origin(g, frame)
 
     path_positions = get_path_positions(g, path)
 
-    p = np.array([[point["x"]], [point["y"]], [point["z"]], [1]]).astype(float)
-
     path_positions = path_positions[::-1]
     path_positions.append(0)
+    T = np.eye(4)
     for pose, next_pose in zip(path_positions[:-1], path_positions[1:]):
 
         coordinates = coordinates_map[pose]
-        T = build_transformation_matrix(**coordinates).astype(float)
+        new_T = build_transformation_matrix(**coordinates).astype(float)
         if not next_pose == 0:
             if next_pose.count("wall") > 1 and (
                 "entryway" not in pose and "window" not in pose
             ):
-                T = np.linalg.pinv(T)
+                new_T = np.linalg.pinv(new_T)
+
+        T = np.dot(new_T, T)
 
-        p = np.dot(T, p)
+    return T
 
-    x = p[0, 0].item()
-    y = p[1, 0].item()
-    z = p[2, 0].item()
 
-    return x, y, z
+def compose_pose_chain_wrt_world(g: Graph, frame):
+    """Compose the pose transformations from a frame to the world frame
 
+    frame: prefixed name of the frame. Poses must be given as direction cosines.
+    """
+    transformation_path = traverse_to_world_origin(g, frame)
+
+    T = np.eye(4)
+    for t in transformation_path[::-1]:
+        if g.value(t, RDF["type"]) == GEO["Frame"]:
+            continue
+        new_pose_ref = g.value(predicate=COORD["of-pose"], object=t)
+        new_m = get_coordinates(g, new_pose_ref)
+        new_m = _coord_to_np_matrix(new_m)
+        T = np.dot(new_m, T)
+
+    return T
+
+
+class FrameTransformIndex:
+    """Index of the frame-to-world transformations of a graph
+
+    Each frame is traversed to the world frame only once, after which the composed
+    transformation matrix is reused for every point or pose that refers to it.
+    """
+
+    def __init__(self, g: Graph, coordinates_map=None):
+        self.g = g
+        if coordinates_map is None:
+            coordinates_map = get_coordinates_map(g)
+        self.coordinates_map = coordinates_map
+        self._world_transforms = dict()
+        self._pose_chains = dict()
+
+    def get_world_transform(self, frame):
+        """Transformation matrix of a frame (prefixed name) wrt the world frame"""
+        T = self._world_transforms.get(frame)
+        if T is None:
+            T = compose_frame_transform_wrt_world(self.g, frame, self.coordinates_map)
+            self._world_transforms[frame] = T
+        return T
+
+    def get_pose_chain(self, frame):
+        """Composed pose transformations of a frame (prefixed name) wrt the world frame"""
+        T = self._pose_chains.get(frame)
+        if T is None:
+            T = compose_pose_chain_wrt_world(self.g, frame)
+            self._pose_chains[frame] = T
+        return T
+
+    def transform_point(self, point):
+        """Coordinates of a point (as returned by get_point_position) wrt world frame"""
+        T = self.get_world_transform(point["as-seen-by"])
+        p = np.array([point["x"], point["y"], point["z"], 1.0], dtype=float)
+        x, y, z, _ = np.dot(T, p)
+        return x.item(), y.item(), z.item()
+
+    def transform_points(self, frame, points):
+        """Transform an (N,4) array of homogeneous points seen by a frame to the world frame"""
+        T = self.get_world_transform(frame)
+        return np.dot(points, T.T)
+
+    def transform_point_list(self, points):
+        """World coordinates of a list of points as an (N,3) array
+
+        Points are grouped by their as-seen-by frame, so that each composed
+        transformation is applied to all its points in a single multiplication.
+        """
+        coords = np.ones((len(points), 4))
+        frames = dict()
+        for i, p in enumerate(points):
+            coords[i, :3] = p["x"], p["y"], p["z"]
+            frames.setdefault(p["as-seen-by"], list()).append(i)
+
+        for frame, idx in frames.items():
+            coords[idx] = self.transform_points(frame, coords[idx])
+
+        return coords[:, :3]
+
+
+def get_transform_index(g: Graph, coordinates_map=None):
+    """Get the transform index of a graph, building it on first use
+
+    The coordinates map is only used when a new index is built.
+    """
+    cache = get_graph_cache(g)
+    index = cache.get("transform-index")
+    if index is None:
+        logger.debug("Building frame transform index")
+        index = FrameTransformIndex(g, coordinates_map)
+        cache["transform-index"] = index
+    return index
+
+
+def get_waypoint_coord_wrt_world(g: Graph, point, coordinates_map):
+    """Gets the coordinates of a point wrt world frame"""
+    index = get_transform_index(g, coordinates_map)
+    return index.transform_point(point)
+
+
+def get_points_wrt_world(g: Graph, points):
+    """Gets the coordinates of a list of points wrt world frame as an (N,3) array"""
+    return get_transform_index(g).transform_point_list(points)
 
-def get_waypoint_coord_list(g: Graph, points, coordinates_map):
-    w_coords = list()
-    for p in points:
-        x, y, _ = get_waypoint_coord_wrt_world(g, p, coordinates_map)
-        w_coords.append([x, y, 0, 1])
+
+def get_waypoint_coord_array(g: Graph, points, coordinates_map=None):
+    """Gets the (N,4) array of [x, y, 0, 1] coordinates of points wrt world frame"""
+    coords = get_transform_index(g, coordinates_map).transform_point_list(points)
+    w_coords = np.zeros((len(points), 4))
+    w_coords[:, :2] = coords[:, :2]
+    w_coords[:, 3] = 1
 
     return w_coords
 
 
+def get_waypoint_coord_list(g: Graph, points, coordinates_map):
+    return get_waypoint_coord_array(g, points, coordinates_map).tolist()
+
+
 def _coord_to_np_matrix(coord, scale=1.0):
     t = np.zeros((4, 4))
     t[0, 3] = coord.get("x")
@@ -513,17 +760,9 @@ def get_pose_transform_wrt_world(g: Graph, pose_ref):
     m = _coord_to_np_matrix(coord)
     pose = g.value(pose_ref, COORD["of-pose"])
     frame = g.value(pose, GEOM["with-respect-to"])
-    transformation_path = traverse_to_world_origin(g, prefixed(g, frame))
+    T = get_transform_index(g).get_pose_chain(prefixed(g, frame))
 
-    for t in transformation_path[::-1]:
-        if g.value(t, RDF["type"]) == GEO["Frame"]:
-            continue
-        new_pose_ref = g.value(predicate=COORD["of-pose"], object=t)
-        new_m = get_coordinates(g, new_pose_ref)
-        new_m = _coord_to_np_matrix(new_m)
-        m = np.dot(new_m, m)
-
-    return m
+    return np.dot(T, m)
 
 
 def get_frame_transform(g: Graph, filter_str: str):
@@ -559,7 +798,6 @@ def get_frame_tree(g: Graph, poses=None):
                     "p": list(m[:3, 3]),
                     "q": list(mat2quat(m[:3, :3])),
                 }
-                # TODO This is not optimal, rewrite to avoid loops for transforms we already know
                 frames[frame] = d
                 frame = t
             else:
@@ -589,42 +827,75 @@ def get_floorplan_elements(g: Graph, floorplan_elements: list):
     return poses
 
 
-def get_spaces(g: Graph):
-    boundary_query = """
-    SELECT DISTINCT ?boundary ?space ?shape
-    WHERE {
-        ?boundary rdf:type fpm:SpaceBoundary .
-        ?boundary fpm:spaces/rdf:rest*/rdf:first ?space .
-        ?space rdf:type fpm:Space  .
-        ?boundary fpm:shape ?shape .
+def _get_boundary_plane(g: Graph, boundary, shape, position_refs, pose_refs):
+    point = g.value(shape, POLY["points"] / RDF["first"])
+    asb = g.value(position_refs.get(point), COORD["as-seen-by"])
+    assert g.value(asb, RDF["type"]) == GEO["Frame"]
+    pose_ref = pose_refs.get(asb)
+    normal = get_list_values(g, pose_ref, COORD["direction-cosine-z"])
+    normal = [x.toPython() for x in normal]
+    pose_wrt_world = get_pose_transform_wrt_world(g, pose_ref)
+    return {
+        "name": prefixed(g, boundary).split(":")[-1],
+        "position": pose_wrt_world[:3, 3].round(4),
+        "normal": normal,
     }
+
+
+def get_space_boundary_index(g: Graph):
+    """Get the boundary planes of each space, indexed in a single pass over the boundaries
+
+    Each boundary is resolved once, even if it bounds several spaces, and the poses
+    of the boundary frames are composed with the transform index of the graph.
     """
+    cache = get_graph_cache(g)
+    index = cache.get("space-boundaries")
+    if index is not None:
+        return index
+
+    # Reverse lookups of the position of the points and the pose of the frames
+    position_refs = dict()
+    for position_ref, position in g.subject_objects(COORD["of-position"]):
+        for point in g.objects(position, GEOM["of"]):
+            position_refs.setdefault(point, position_ref)
+    pose_refs = dict()
+    for pose_ref, pose in g.subject_objects(COORD["of-pose"]):
+        for frame in g.objects(pose, GEOM["of"]):
+            pose_refs.setdefault(frame, pose_ref)
+
+    planes = dict()
+    boundaries = dict()
+    for boundary in g.subjects(RDF["type"], FP["SpaceBoundary"]):
+        shapes = list(g.objects(boundary, FP["shape"]))
+        for ptr in g.objects(boundary, FP["spaces"]):
+            if ptr == RDF.nil:
+                continue
+            for space in get_list_from_ptr(g, ptr):
+                if (space, RDF["type"], FP["Space"]) not in g:
+                    continue
+                space_planes = boundaries.setdefault(space, dict())
+                for shape in shapes:
+                    key = (boundary, shape)
+                    if key not in planes:
+                        planes[key] = _get_boundary_plane(
+                            g, boundary, shape, position_refs, pose_refs
+                        )
+                    space_planes[key] = planes[key]
+
+    index = {space: list(p.values()) for space, p in boundaries.items()}
+    cache["space-boundaries"] = index
+    return index
+
+
+def get_spaces(g: Graph):
+    boundaries = get_space_boundary_index(g)
     space_nodes = g.subjects(predicate=RDF["type"], object=FP["Space"])
     spaces = []
 
     for node in space_nodes:
-        result = g.query(
-            boundary_query, initNs={"fpm": FP, "rdf": RDF}, initBindings={"space": node}
-        )
-        planes = []
-        for r, s, shape in result:
-            point = g.value(shape, POLY["points"] / RDF["first"])
-            position_ref = g.value(
-                predicate=COORD["of-position"] / GEOM["of"], object=point
-            )
-            asb = g.value(position_ref, COORD["as-seen-by"])
-            assert g.value(asb, RDF["type"]) == GEO["Frame"]
-            pose_ref = g.value(predicate=COORD["of-pose"] / GEOM["of"], object=asb)
-            normal = get_list_values(g, pose_ref, COORD["direction-cosine-z"])
-            normal = [x.toPython() for x in normal]
-            pose_wrt_world = get_pose_transform_wrt_world(g, pose_ref)
-            planes.append(
-                {
-                    "name": prefixed(g, r).split(":")[-1],
-                    "position": pose_wrt_world[:3, 3].round(4),
-                    "normal": normal,
-                    "color": random.choices(range(256), k=3),
-                }
-            )
+        planes = [
+            dict(plane, color=random.choices(range(256), k=3))
+            for plane in boundaries.get(node, [])
+        ]
         spaces.append({"space": prefixed(g, node).split(":")[-1], "planes": planes})
     return spaces
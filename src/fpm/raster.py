@@ -0,0 +1,212 @@
+import numpy as np
+
+BLOCK_SIZE = 1 << 22
+
+
+def _round_up(x):
+    return np.where(x >= 0, np.floor(x + 0.5), -np.floor(np.abs(x) + 0.5)).astype(int)
+
+
+def _round_down(x):
+    return np.where(x >= 0, np.ceil(x - 0.5), -np.ceil(np.abs(x) - 0.5)).astype(int)
+
+
+def _roundf(x):
+    """C's roundf, rounding halves away from zero"""
+    return np.float32(np.copysign(np.floor(abs(float(x)) + 0.5), x))
+
+
+def _connect_corners(x, y, edge, x0, y0, dx, edge_min, edge_max, y_max):
+    """Move the intersections at sharp corners as PIL does to keep them connected
+
+    This follows the "Connect discontiguous corners" step of PIL's polygon filler
+    (libImaging/Draw.c), applied to the intersections of an edge on its lower row,
+    or on its upper row if it is the last one.
+    """
+    one = np.float32(1)
+
+    def edge_x(k, row):
+        return np.float32(row - y0[k]) * dx[k] + np.float32(x0[k])
+
+    # An intersection only moves if its edge advances more than a pixel per row
+    candidates = (np.abs(dx[edge]) > 1) & (
+        (y == edge_min[edge]) | ((y == edge_max[edge]) & (y == y_max))
+    )
+    for c in np.flatnonzero(candidates):
+        i, row, xc = edge[c], y[c], x[c]
+        for k in range(i):
+            if (row != edge_min[k] and row != edge_max[k]) or dx[k] == 0:
+                continue
+            if _roundf(xc) != _roundf(edge_x(k, row)):
+                continue
+            # The points of the edges on the next row, or the previous one for the last
+            offset = -1 if row == edge_max[i] else 1
+            if not edge_min[k] <= row + offset <= edge_max[k]:
+                continue
+            adjacent = edge_x(i, row + offset)
+            adjacent_other = edge_x(k, row + offset)
+            if xc > adjacent + one and xc > adjacent_other + one:
+                x[c] = _roundf(max(adjacent, adjacent_other)) + one
+            elif xc < adjacent - one and xc < adjacent_other - one:
+                x[c] = _roundf(min(adjacent, adjacent_other)) - one
+            break
+
+
+def _polygon_spans(polygon, height):
+    """Horizontal (row, x start, x end) spans filling a polygon with integer vertices
+
+    Scanlines pass through the pixel rows and intersections are rounded inwards,
+    following the rules of PIL's ImageDraw.polygon, including drawing horizontal
+    edges and connecting the pixels of sharp corners.
+    """
+    if len(polygon) > 1 and np.array_equal(polygon[0], polygon[-1]):
+        # PIL only closes the polygon if the last point is not the first one
+        polygon = polygon[:-1]
+    if len(polygon) < 2:
+        return []
+    x0, y0 = polygon[:, 0], polygon[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+
+    horizontal = y0 == y1
+    spans = [
+        (
+            y0[horizontal],
+            np.minimum(x0, x1)[horizontal],
+            np.maximum(x0, x1)[horizontal],
+        )
+    ]
+
+    x0, y0, x1, y1 = x0[~horizontal], y0[~horizontal], x1[~horizontal], y1[~horizontal]
+    if len(x0) == 0:
+        return spans
+
+    edge_min = np.minimum(y0, y1)
+    edge_max = np.maximum(y0, y1)
+    y_min = max(int(edge_min.min()), 0)
+    y_max = min(int(edge_max.max()), height)
+    dx = (x1 - x0).astype(np.float32) / (y1 - y0).astype(np.float32)
+
+    # One intersection for each edge and row it crosses
+    first = np.maximum(edge_min, y_min)
+    count = np.maximum(np.minimum(edge_max, y_max) - first + 1, 0)
+    edge = np.repeat(np.arange(len(count)), count)
+    y = first[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(count) - count, count)
+    x = (y - y0[edge]).astype(np.float32) * dx[edge] + x0[edge].astype(np.float32)
+    _connect_corners(x, y, edge, x0, y0, dx, edge_min, edge_max, y_max)
+
+    # The upper end of an edge counts twice, except on the last row
+    twice = (y == edge_max[edge]) & (y < y_max)
+    x = np.concatenate([x, x[twice]])
+    y = np.concatenate([y, y[twice]])
+
+    # Pairs of sorted intersections on each row delimit the filled spans
+    order = np.lexsort((x, y))
+    x, y = x[order], y[order]
+    row_start = np.r_[True, y[1:] != y[:-1]]
+    start_index = np.maximum.accumulate(np.where(row_start, np.arange(len(y)), 0))
+    rank = np.arange(len(y)) - start_index
+    has_pair = np.r_[y[1:] == y[:-1], False]
+    i = np.flatnonzero((rank % 2 == 0) & has_pair)
+    spans.append((y[i], _round_up(x[i]), _round_down(x[i + 1])))
+
+    return spans
+
+
+def fill_polygons(grid, polygons, fill):
+    """Fill all polygons (in pixel coordinates) on a 2D array in a single pass"""
+    height, width = grid.shape
+    spans = list()
+    for polygon in polygons:
+        polygon = np.asarray(polygon, dtype=int).reshape(-1, 2)
+        if len(polygon) > 0:
+            spans.extend(_polygon_spans(polygon, height))
+    if not spans:
+        return grid
+
+    rows = np.concatenate([s[0] for s in spans])
+    start = np.concatenate([s[1] for s in spans])
+    end = np.concatenate([s[2] for s in spans])
+
+    start = np.clip(start, 0, width)
+    end = np.clip(end, -1, width - 1)
+    valid = (rows >= 0) & (rows < height) & (end >= start)
+    rows, start, end = rows[valid], start[valid], end[valid]
+
+    # Mark the start and end of each span and accumulate along the rows,
+    # in blocks of rows to bound the memory used for large grids
+    block = max(1, BLOCK_SIZE // (width + 1))
+    for r in range(0, height, block):
+        in_block = (rows >= r) & (rows < r + block)
+        marks = np.zeros((min(block, height - r), width + 1), dtype=np.int16)
+        np.add.at(marks, (rows[in_block] - r, start[in_block]), 1)
+        np.add.at(marks, (rows[in_block] - r, end[in_block] + 1), -1)
+        filled = np.cumsum(marks[:, :width], axis=1, dtype=np.int16) > 0
+        grid[r : r + block][filled] = fill
+
+    return grid
+
+
+def _squared_distance_1d(f):
+    """1D squared distance transform of each row of f
+
+    Lower envelope of the parabolas rooted at each cell (Felzenszwalb and
+    Huttenlocher), built for all rows at once.
+    """
+    m, n = f.shape
+    base = np.arange(m) * n
+    # Root and value (f(v) + v^2) of the parabolas of the envelope, and their boundaries
+    v = np.zeros(m * n, dtype=np.int64)
+    h = np.empty(m * n)
+    h[base] = f[:, 0]
+    z = np.full(m * (n + 1), np.inf)
+    z_base = np.arange(m) * (n + 1)
+    z[z_base] = -np.inf
+    k = base.copy()
+
+    for q in range(1, n):
+        fq = f[:, q] + q * q
+        while True:
+            s = (fq - h[k]) / (2 * (q - v[k]))
+            hidden = s <= z[k - base + z_base]
+            if not hidden.any():
+                break
+            k -= hidden
+        k += 1
+        v[k] = q
+        h[k] = fq
+        z[k - base + z_base] = s
+        # Drop the boundaries of the parabolas removed from the envelope
+        z[k - base + z_base + 1] = np.inf
+
+    d = np.empty_like(f)
+    k = base.copy()
+    for q in range(n):
+        while True:
+            after = z[k - base + z_base + 1] < q
+            if not after.any():
+                break
+            k += after
+        vk = v[k]
+        d[:, q] = h[k] + q * (q - 2 * vk)
+
+    return d
+
+
+def distance_transform(mask):
+    """Euclidean distance (in pixels) from each cell to the nearest True cell of a 2D mask
+
+    Linear-time exact transform: distances along the columns with a forward and a
+    backward scan, then the squared distances along the rows.
+    Cells are at an infinite distance if the mask is empty.
+    """
+    height, width = mask.shape
+    far = height + width
+    g = np.empty((height, width))
+    g[0] = np.where(mask[0], 0, far)
+    for r in range(1, height):
+        g[r] = np.where(mask[r], 0, g[r - 1] + 1)
+    for r in range(height - 2, -1, -1):
+        np.minimum(g[r], g[r + 1] + 1, out=g[r])
+
+    f = _squared_distance_1d(np.minimum(g, far) ** 2)
+    return np.where(f >= far * far, np.inf, np.sqrt(f))
@@ -0,0 +1,110 @@
+import os
+import sys
+import glob
+import pickle
+import hashlib
+import logging
+import tempfile
+import functools
+
+import rdflib
+from rdflib import Graph
+
+import fpm
+
+logger = logging.getLogger("floorplan.snapshot")
+logger.setLevel(logging.DEBUG)
+
+SNAPSHOT_FORMAT = 1
+
+
+def get_cache_dir():
+    """Directory of the snapshot cache
+
+    Defaults to $XDG_CACHE_HOME/fpm (~/.cache/fpm) and can be overriden with $FPM_CACHE_DIR
+    """
+    cache_dir = os.environ.get("FPM_CACHE_DIR")
+    if cache_dir is None:
+        cache_home = os.environ.get(
+            "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+        )
+        cache_dir = os.path.join(cache_home, "fpm")
+    return cache_dir
+
+
+def get_input_files(inputs: tuple):
+    files = list()
+    for input_folder in inputs:
+        files.extend(sorted(glob.glob(os.path.join(input_folder, "*.json"))))
+    return files
+
+
+def get_snapshot_key(files: list):
+    """Hash of the content of the input files and the versions of the libraries that produced the snapshot"""
+    h = hashlib.sha256()
+    # The version is only substituted in installed packages
+    version = getattr(fpm, "__version__", None)
+    h.update("{}:{}:{}".format(SNAPSHOT_FORMAT, version, rdflib.__version__).encode())
+    for file_path in files:
+        h.update(os.path.basename(file_path).encode())
+        with open(file_path, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+@functools.cache
+def get_code_hash(*module_names):
+    """Hash of the source code of the modules that build a cached object
+
+    The package version alone does not invalidate the snapshots when the code
+    changes, as it is only substituted in installed packages.
+    """
+    h = hashlib.sha256()
+    for name in module_names:
+        with open(sys.modules[name].__file__, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _snapshot_path(key: str, name: str):
+    return os.path.join(get_cache_dir(), "{}.{}.pickle".format(key, name))
+
+
+def load_snapshot(key: str, name: str):
+    """Load a cached object, returns None if there is no (valid) snapshot"""
+    path = _snapshot_path(key, name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception as e:
+        logger.warning("Ignoring invalid snapshot %s: %s", path, e)
+        return None
+
+
+def save_snapshot(key: str, name: str, obj):
+    """Save an object to the cache, writing to a temporary file first"""
+    cache_dir = get_cache_dir()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, _snapshot_path(key, name))
+    except OSError as e:
+        logger.warning("Could not save snapshot to %s: %s", cache_dir, e)
+
+
+def graph_to_snapshot(g: Graph):
+    namespaces = [(prefix, str(ns)) for prefix, ns in g.namespaces()]
+    return namespaces, list(g)
+
+
+def graph_from_snapshot(snapshot):
+    namespaces, triples = snapshot
+    g = rdflib.Graph()
+    for prefix, ns in namespaces:
+        g.bind(prefix, ns, override=True, replace=True)
+    g.addN((s, p, o, g) for s, p, o in triples)
+    return g
@@ -1,4 +1,5 @@
 import os
+import json
 import bpy
 import bmesh
 import logging
@@ -6,6 +7,8 @@ import logging
 logger = logging.getLogger("floorplan.transformations.blender")
 logger.setLevel(logging.DEBUG)
 
+ELEMENT_NAME_PROPERTY = "fpm_name"
+
 
 def create_mesh(collection, name, vertices, faces):
     """Creates a mesh"""
@@ -25,6 +28,8 @@ def create_mesh(collection, name, vertices, faces):
     me.update()
 
     obj = bpy.data.objects.new(name, me)
+    # Blender truncates long names and renames duplicates, keep the element name
+    obj[ELEMENT_NAME_PROPERTY] = name
     collection.objects.link(obj)
 
 
@@ -106,6 +111,10 @@ def main(elements):
     create_element_mesh(building, windows)
     subtract_opening(windows)
 
+    mesh_data = elements.get("mesh_data")
+    if mesh_data:
+        save_mesh_data(mesh_data)
+
     output_files = []
     for output_path, file_name in elements.get("output_files", []):
         f = save_file(file_name, output_path)
@@ -114,6 +123,29 @@ def main(elements):
     return output_files
 
 
+def save_mesh_data(output_file):
+    """Saves the triangulated meshes as JSON, e.g. to merge them with other meshes"""
+    meshes = []
+    for obj in bpy.data.objects:
+        if obj.type != "MESH":
+            continue
+        bm = bmesh.new()
+        bm.from_mesh(obj.data)
+        bmesh.ops.triangulate(bm, faces=bm.faces)
+        bm.verts.index_update()
+        meshes.append(
+            {
+                "name": obj.get(ELEMENT_NAME_PROPERTY, obj.name),
+                "vertices": [list(obj.matrix_world @ v.co) for v in bm.verts],
+                "triangles": [[v.index for v in f.verts] for f in bm.faces],
+            }
+        )
+        bm.free()
+
+    with open(output_file, "w") as f:
+        json.dump(meshes, f)
+
+
 def save_file(file_name, output_path):
     if not os.path.exists(output_path):
         os.makedirs(output_path)
@@ -133,7 +165,6 @@ def save_file(file_name, output_path):
 
 
 if __name__ == "__main__":
-    import json
     import sys
 
     args = sys.argv
@@ -0,0 +1,453 @@
+import os
+import json
+import base64
+import hashlib
+import struct
+import logging
+
+import numpy as np
+
+from fpm import snapshot
+
+logger = logging.getLogger("floorplan.transformations.mesh")
+logger.setLevel(logging.DEBUG)
+
+SOLID_ELEMENTS = ["walls", "columns", "dividers", "doors", "door_linings"]
+OPENING_ELEMENTS = ["entryways", "windows"]
+
+# Version of the cached meshes, to be bumped with every change to how they are built
+MESH_FORMAT = 2
+
+
+def orient_faces(faces):
+    """Flip faces so that neighbouring faces traverse their shared edges in opposite directions"""
+    faces = [list(f) for f in faces]
+    edge_faces = dict()
+    for i, f in enumerate(faces):
+        for a, b in zip(f, f[1:] + f[:1]):
+            edge_faces.setdefault(frozenset((a, b)), []).append(i)
+
+    visited = [False] * len(faces)
+    for start in range(len(faces)):
+        if visited[start]:
+            continue
+        visited[start] = True
+        stack = [start]
+        while stack:
+            i = stack.pop()
+            f = faces[i]
+            directed = set(zip(f, f[1:] + f[:1]))
+            for a, b in directed:
+                for j in edge_faces[frozenset((a, b))]:
+                    if visited[j]:
+                        continue
+                    n = faces[j]
+                    if (a, b) in set(zip(n, n[1:] + n[:1])):
+                        n.reverse()
+                    visited[j] = True
+                    stack.append(j)
+    return faces
+
+
+def _newell_normal(points):
+    x, y, z = points.T
+    x1, y1, z1 = np.roll(points, -1, axis=0).T
+    return np.array(
+        [
+            np.sum((y - y1) * (z + z1)),
+            np.sum((z - z1) * (x + x1)),
+            np.sum((x - x1) * (y + y1)),
+        ]
+    )
+
+
+def triangulate_face(vertices, face):
+    """Triangulate a planar polygon by ear clipping, keeping its orientation"""
+    if len(face) == 3:
+        return [tuple(face)]
+
+    points = vertices[face]
+    normal = _newell_normal(points)
+    # Project onto the plane most aligned with the face
+    axis = np.argmax(np.abs(normal))
+    uv = np.delete(points, axis, axis=1)
+    if normal[axis] < 0:
+        uv = uv[:, ::-1]
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    def inside(p, a, b, c):
+        return cross(a, b, p) >= 0 and cross(b, c, p) >= 0 and cross(c, a, p) >= 0
+
+    remaining = list(range(len(face)))
+    triangles = list()
+    while len(remaining) > 3:
+        n = len(remaining)
+        for k in range(n):
+            i, j, l = remaining[k - 1], remaining[k], remaining[(k + 1) % n]
+            a, b, c = uv[i], uv[j], uv[l]
+            if cross(a, b, c) <= 0:
+                continue
+            if any(inside(uv[m], a, b, c) for m in remaining if m not in (i, j, l)):
+                continue
+            triangles.append((face[i], face[j], face[l]))
+            remaining.pop(k)
+            break
+        else:
+            # Degenerate polygon, fall back to a fan
+            break
+    triangles.extend(
+        (face[remaining[0]], face[remaining[k]], face[remaining[k + 1]])
+        for k in range(1, len(remaining) - 1)
+    )
+    return triangles
+
+
+def triangulate(vertices, faces):
+    """(T,3) triangles of a closed polyhedron with its normals pointing outwards"""
+    vertices = np.asarray(vertices, dtype=float)
+    triangles = list()
+    for f in orient_faces(faces):
+        triangles.extend(triangulate_face(vertices, f))
+    triangles = np.array(triangles, dtype=np.uint32).reshape(-1, 3)
+
+    v0, v1, v2 = (vertices[triangles[:, i]] for i in range(3))
+    volume = np.einsum("ij,ij->i", v0, np.cross(v1, v2)).sum()
+    if volume < 0:
+        triangles = triangles[:, ::-1]
+    return np.ascontiguousarray(triangles)
+
+
+def wall_frame(vertices, faces):
+    """Origin and (along, up, normal) axes of a wall, with the normal of its largest face"""
+    vertices = np.asarray(vertices, dtype=float)
+    normals = np.array([_newell_normal(vertices[f]) for f in faces])
+    normal = normals[np.argmax(np.linalg.norm(normals, axis=1))]
+    normal = normal / np.linalg.norm(normal)
+
+    up = np.array([0.0, 0.0, 1.0]) - normal[2] * normal
+    if np.linalg.norm(up) < 1e-6:
+        return None
+    up = up / np.linalg.norm(up)
+    along = np.cross(up, normal)
+    return vertices.min(axis=0), np.array([along, up, normal])
+
+
+def _box_extent(local, tol=1e-6):
+    """(3,2) min/max of the local coordinates if the vertices are the 8 corners of a box
+
+    Each corner must be a vertex exactly once, so other polyhedra with their vertices
+    on the corners of their bounding box (e.g. prisms) are not taken as boxes.
+    """
+    lo, hi = local.min(axis=0), local.max(axis=0)
+    if len(local) != 8 or np.any(hi - lo <= tol):
+        return None
+    at_lo, at_hi = np.isclose(local, lo, atol=tol), np.isclose(local, hi, atol=tol)
+    if not np.all(at_lo | at_hi):
+        return None
+    corners = at_hi @ np.array([1, 2, 4])
+    if len(set(corners.tolist())) != 8:
+        return None
+    return np.stack([lo, hi], axis=1)
+
+
+def _quad(o, e1, e2, normal):
+    if np.dot(np.cross(e1, e2), normal) < 0:
+        e1, e2 = e2, e1
+    return [o, o + e1, o + e1 + e2, o + e2]
+
+
+def subtract_box_openings(vertices, faces, openings, tol=1e-6):
+    """Cut box openings out of a box wall in its local frame
+
+    All openings of the wall are subtracted at once in the 2D plane of the wall and
+    the result is extruded through its thickness. Returns None if the wall or an
+    opening are not boxes aligned with the wall frame, or if an opening does not
+    go through the wall.
+    """
+    frame = wall_frame(vertices, faces)
+    if frame is None:
+        return None
+    origin, axes = frame
+    wall = _box_extent((np.asarray(vertices, dtype=float) - origin) @ axes.T, tol)
+    if wall is None:
+        return None
+    (u0, u1), (v0, v1), (w0, w1) = wall
+
+    cuts = list()
+    for opening in openings:
+        box = _box_extent((np.asarray(opening, dtype=float) - origin) @ axes.T, tol)
+        if box is None:
+            return None
+        (a0, a1), (b0, b1), (c0, c1) = box
+        a0, a1, b0, b1 = max(a0, u0), min(a1, u1), max(b0, v0), min(b1, v1)
+        if a1 - a0 <= tol or b1 - b0 <= tol or c1 <= w0 or c0 >= w1:
+            # The opening does not intersect the wall
+            continue
+        if c0 > w0 + tol or c1 < w1 - tol:
+            # Only part of the thickness of the wall would be removed
+            return None
+        cuts.append((a0, a1, b0, b1))
+
+    xs = np.unique([u0, u1] + [x for c in cuts for x in c[:2]])
+    ys = np.unique([v0, v1] + [y for c in cuts for y in c[2:]])
+    cx, cy = np.meshgrid((xs[:-1] + xs[1:]) / 2, (ys[:-1] + ys[1:]) / 2, indexing="ij")
+    solid = np.ones(cx.shape, dtype=bool)
+    for a0, a1, b0, b1 in cuts:
+        solid &= ~((a0 < cx) & (cx < a1) & (b0 < cy) & (cy < b1))
+    padded = np.pad(solid, 1, constant_values=False)
+
+    quads = list()
+    depth = np.array([0.0, 0.0, w1 - w0])
+    for i, j in zip(*np.nonzero(solid)):
+        dx = np.array([xs[i + 1] - xs[i], 0.0, 0.0])
+        dy = np.array([0.0, ys[j + 1] - ys[j], 0.0])
+        o = np.array([xs[i], ys[j], w0])
+        quads.append(_quad(o, dx, dy, -depth))
+        quads.append(_quad(o + depth, dx, dy, depth))
+        # Sides towards the boundary of the wall or a cut
+        if not padded[i, j + 1]:
+            quads.append(_quad(o, dy, depth, -dx))
+        if not padded[i + 2, j + 1]:
+            quads.append(_quad(o + dx, dy, depth, dx))
+        if not padded[i + 1, j]:
+            quads.append(_quad(o, dx, depth, -dy))
+        if not padded[i + 1, j + 2]:
+            quads.append(_quad(o + dy, dx, depth, dy))
+
+    local = np.array(quads).reshape(-1, 3)
+    local, index = np.unique(np.round(local, 9), axis=0, return_inverse=True)
+    index = index.reshape(-1, 4)
+    triangles = np.concatenate([index[:, [0, 1, 2]], index[:, [0, 2, 3]]])
+    return origin + local @ axes, triangles.astype(np.uint32)
+
+
+def element_hash(element, openings=()):
+    """Hash of the geometry of an element and of the openings voiding it"""
+    h = hashlib.sha256()
+    h.update(str(MESH_FORMAT).encode())
+    h.update(str(element.get("name")).encode())
+    h.update(np.asarray(element.get("vertices"), dtype=float).tobytes())
+    h.update(json.dumps(element.get("faces")).encode())
+    for opening in openings:
+        h.update(np.asarray(opening, dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def build_meshes(elements, cache=None):
+    """(name, vertices, triangles) of each element with a solid mesh
+
+    The openings are subtracted from the walls they void. Raises a ValueError if
+    that requires a general boolean operation.
+
+    If a cache dict is given, the meshes of elements whose hash is in the cache are
+    reused. Afterwards, the cache only contains the meshes of the current elements.
+    """
+    voids = dict()
+    for key in OPENING_ELEMENTS:
+        for opening in elements.get(key, []):
+            for wall in opening.get("voids", list()):
+                voids.setdefault(wall, []).append(opening.get("vertices"))
+
+    meshes = list()
+    current = dict()
+    for key in SOLID_ELEMENTS:
+        for e in elements.get(key, []):
+            name = e.get("name")
+            openings = voids.get(name, []) if key == "walls" else []
+            h = element_hash(e, openings) if cache is not None else None
+            if h is not None and h in cache:
+                vertices, triangles = cache[h]
+            else:
+                vertices = np.array(e.get("vertices"), dtype=float).reshape(-1, 3)
+                if openings:
+                    result = subtract_box_openings(vertices, e.get("faces"), openings)
+                    if result is None:
+                        raise ValueError(
+                            "Openings of {} can't be subtracted natively".format(name)
+                        )
+                    vertices, triangles = result
+                else:
+                    triangles = triangulate(vertices, e.get("faces"))
+            meshes.append((name, vertices, triangles))
+            if h is not None:
+                current[h] = (vertices, triangles)
+
+    if cache is not None:
+        reused = len(set(current) & set(cache))
+        logger.info("Reused %d of %d element meshes", reused, len(meshes))
+        cache.clear()
+        cache.update(current)
+    return meshes
+
+
+def save_stl(meshes, output_file):
+    """Binary STL with the triangles of all meshes"""
+    triangles = [v[t] for _, v, t in meshes]
+    triangles = np.concatenate(triangles) if triangles else np.zeros((0, 3, 3))
+    normals = np.cross(
+        triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]
+    )
+    norm = np.linalg.norm(normals, axis=1, keepdims=True)
+    normals = np.divide(normals, norm, out=np.zeros_like(normals), where=norm > 0)
+
+    records = np.zeros(
+        len(triangles),
+        dtype=[("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attr", "<u2")],
+    )
+    records["normal"] = normals
+    records["vertices"] = triangles
+
+    with open(output_file, "wb") as f:
+        f.write(b"floorplan".ljust(80, b"\0"))
+        f.write(struct.pack("<I", len(records)))
+        f.write(records.tobytes())
+
+
+def _gltf_document(meshes):
+    """glTF 2.0 document with one node per mesh and its binary buffer"""
+    buffer = bytearray()
+    doc = {
+        "asset": {"version": "2.0", "generator": "floorplan"},
+        "scene": 0,
+        "scenes": [{"nodes": list(range(len(meshes)))}],
+        "nodes": [],
+        "meshes": [],
+        "accessors": [],
+        "bufferViews": [],
+        "buffers": [],
+    }
+
+    def add_view(data, target):
+        while len(buffer) % 4:
+            buffer.append(0)
+        doc["bufferViews"].append(
+            {
+                "buffer": 0,
+                "byteOffset": len(buffer),
+                "byteLength": len(data),
+                "target": target,
+            }
+        )
+        buffer.extend(data)
+        return len(doc["bufferViews"]) - 1
+
+    for i, (name, vertices, triangles) in enumerate(meshes):
+        # glTF is Y-up, the floorplan is Z-up
+        positions = vertices[:, [0, 2, 1]].astype(np.float32)
+        positions[:, 2] *= -1
+        indices = triangles.astype(np.uint32)
+
+        view = add_view(positions.tobytes(), 34962)
+        doc["accessors"].append(
+            {
+                "bufferView": view,
+                "componentType": 5126,
+                "count": len(positions),
+                "type": "VEC3",
+                "min": positions.min(axis=0).tolist(),
+                "max": positions.max(axis=0).tolist(),
+            }
+        )
+        view = add_view(indices.tobytes(), 34963)
+        doc["accessors"].append(
+            {
+                "bufferView": view,
+                "componentType": 5125,
+                "count": indices.size,
+                "type": "SCALAR",
+            }
+        )
+        doc["meshes"].append(
+            {
+                "name": name,
+                "primitives": [
+                    {
+                        "attributes": {"POSITION": 2 * i},
+                        "indices": 2 * i + 1,
+                        "mode": 4,
+                    }
+                ],
+            }
+        )
+        doc["nodes"].append({"name": name, "mesh": i})
+
+    while len(buffer) % 4:
+        buffer.append(0)
+    doc["buffers"].append({"byteLength": len(buffer)})
+    return doc, bytes(buffer)
+
+
+def save_gltf(meshes, output_file):
+    """glTF 2.0 file, as binary GLB or as JSON with the buffer embedded"""
+    doc, buffer = _gltf_document(meshes)
+    if output_file.endswith(".glb"):
+        content = json.dumps(doc, separators=(",", ":")).encode()
+        content += b" " * (-len(content) % 4)
+        with open(output_file, "wb") as f:
+            f.write(struct.pack("<III", 0x46546C67, 2, 28 + len(content) + len(buffer)))
+            f.write(struct.pack("<II", len(content), 0x4E4F534A))
+            f.write(content)
+            f.write(struct.pack("<II", len(buffer), 0x004E4942))
+            f.write(buffer)
+    else:
+        data = base64.b64encode(buffer).decode()
+        doc["buffers"][0]["uri"] = "data:application/octet-stream;base64," + data
+        with open(output_file, "w") as f:
+            json.dump(doc, f)
+
+
+def save_meshes(meshes, output_files):
+    """Save the meshes to each (output path, file name) in STL or glTF format"""
+    saved_files = []
+    for output_path, file_name in output_files:
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+
+        ext = os.path.splitext(file_name)[1]
+        output_file = os.path.abspath(os.path.join(output_path, file_name))
+        if ext in [".stl"]:
+            save_stl(meshes, output_file)
+        elif ext in [".gltf", ".glb"]:
+            save_gltf(meshes, output_file)
+        else:
+            logger.error("Unsupported mesh format: %s", ext)
+            continue
+
+        logger.info(f"Generated {output_file}")
+        saved_files.append(output_file)
+
+    return saved_files
+
+
+def get_mesh_cache_key(elements):
+    """Key of the mesh cache of a model, for its name and output paths
+
+    Models with the same name (e.g. variations) are saved to different output
+    paths, so they do not evict each other's meshes.
+    """
+    h = hashlib.sha256()
+    h.update(str(elements.get("model_name")).encode())
+    output_paths = [path for path, _ in elements.get("output_files", [])]
+    for path in dict.fromkeys(output_paths):
+        h.update(os.path.abspath(path).encode())
+    return h.hexdigest()
+
+
+def export_mesh(elements, use_cache=False):
+    """Equivalent of the Blender transformation for prismatic walls and openings
+
+    With use_cache, the meshes of unchanged elements are reused from the previous run
+    """
+    if not use_cache:
+        meshes = build_meshes(elements)
+        return save_meshes(meshes, elements.get("output_files", []))
+
+    key = get_mesh_cache_key(elements)
+    cache = snapshot.load_snapshot(key, "mesh") or dict()
+    previous = set(cache)
+    meshes = build_meshes(elements, cache)
+    if set(cache) != previous:
+        snapshot.save_snapshot(key, "mesh", cache)
+    return save_meshes(meshes, elements.get("output_files", []))
@@ -9,8 +9,7 @@ import logging
 
 from fpm.graph import (
     get_space_points,
-    get_coordinates_map,
-    get_waypoint_coord_wrt_world,
+    get_points_wrt_world,
 )
 
 logger = logging.getLogger("floorplan.transformations.tasks")
@@ -96,7 +95,7 @@ def create_inset_json_ld(model, width):
     return tree_structure
 
 
-def transform_insets(g, inset_model_framed, coordinates_map):
+def transform_insets(g, inset_model_framed):
     plt.axis("equal")
     ax = plt.gca()
     insets = []
@@ -105,15 +104,14 @@ def transform_insets(g, inset_model_framed, coordinates_map):
 
         inset_points = []
 
-        for point in inset["points"]:
+        coords = get_points_wrt_world(g, inset["points"]).tolist()
+        for point, (x, y, _) in zip(inset["points"], coords):
 
             # Get the space name and point ID from the inset ID
             # TODO Fix this so we don't rely on human-readable IDs with semantic meaning
             id_sem = point["name"].split("-")
             name = "{}-point-{}".format(id_sem[5], id_sem[3])
 
-            x, y, _ = get_waypoint_coord_wrt_world(g, point, coordinates_map)
-
             inset_points.append({"id": name, "x": x, "y": y, "z": 0, "yaw": 0})
 
         yaml_json = {
@@ -141,11 +139,7 @@ def get_all_disinfection_tasks(g, inset_width):
     logger.debug("Creating the insets...")
     inset_model_framed = create_inset_json_ld(space_points, inset_width)
 
-    logger.debug("Calculating transformation path...")
-    # This just gets the coordinates of all poses in the graph, it doesn't calculate anything
-    coordinates_map = get_coordinates_map(g)
-
     logger.debug("Transforming the insets")
-    insets = transform_insets(g, inset_model_framed, coordinates_map)
+    insets = transform_insets(g, inset_model_framed)
 
     return [dict(id=inset["name"], task=[inset]) for inset in insets]
@@ -1,17 +1,30 @@
 import os
 import tomllib
 import logging
+import functools
 
 import yaml
 import json
 
 import numpy as np
 
-from jinja2 import Environment, FileSystemLoader, PackageLoader
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    PackageLoader,
+)
+
+from fpm import snapshot
 
 logger = logging.getLogger("floorplan.utils")
 logger.setLevel(logging.DEBUG)
 
+TEMPLATE_CACHE_SIZE = 512
+
+# Bytecode cache shared by the template environments, see enable_template_bytecode_cache
+_bytecode_cache = None
+
 
 def load_config_file(file_path):
     with open(file_path, "rb") as f:
@@ -33,13 +46,54 @@ def render_model_template(
     return save_file(output_folder, file_name, output)
 
 
-def load_template(template_name, template_folder=None):
+@functools.cache
+def get_template_environment(template_folder=None):
+    """Jinja environment for a template folder (or the templates of the package)
+
+    Environments are created once per folder and process. Templates are not
+    checked for changes on disk after they are compiled.
+    """
     if template_folder is None:
         loader = PackageLoader("fpm")
     else:
         loader = FileSystemLoader(template_folder)
-    env = Environment(loader=loader)
-    return env.get_template(template_name)
+    return Environment(
+        loader=loader,
+        cache_size=TEMPLATE_CACHE_SIZE,
+        auto_reload=False,
+        bytecode_cache=_bytecode_cache,
+    )
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _load_template(template_name, template_folder):
+    return get_template_environment(template_folder).get_template(template_name)
+
+
+def load_template(template_name, template_folder=None):
+    """Compiled template, memoized by name and folder"""
+    if template_folder is not None:
+        template_folder = os.path.abspath(template_folder)
+    return _load_template(template_name, template_folder)
+
+
+def enable_template_bytecode_cache(cache_dir=None):
+    """Cache the compiled templates on disk to skip compiling them in new processes
+
+    The cache is in $FPM_CACHE_DIR/templates by default (see fpm.snapshot.get_cache_dir)
+    """
+    global _bytecode_cache
+    if cache_dir is None:
+        cache_dir = os.path.join(snapshot.get_cache_dir(), "templates")
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        logger.warning("Could not create the template cache %s: %s", cache_dir, e)
+        return
+    _bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    # Environments created from now on use the cache
+    _load_template.cache_clear()
+    get_template_environment.cache_clear()
 
 
 def save_file(output_path, file_name, contents, debug=False):
@@ -58,6 +112,10 @@ def save_file(output_path, file_name, contents, debug=False):
                 json.dump(contents, f, indent=4)
             else:
                 json.dump(contents, f)
+    elif ext == ".pgm" and isinstance(contents, np.ndarray):
+        write_pgm(output_file, contents)
+    elif ext == ".npy":
+        np.save(output_file, contents)
     elif ext in [".pgm", ".jpg"]:
         contents.save(output_file, quality=100)
     else:
@@ -68,6 +126,16 @@ def save_file(output_path, file_name, contents, debug=False):
     return output_file
 
 
+def write_pgm(output_file, grid, block_size=1 << 22):
+    """Write a (possibly memory-mapped) uint8 array as a binary PGM, streaming blocks of rows"""
+    height, width = grid.shape
+    block = max(1, block_size // max(width, 1))
+    with open(output_file, "wb") as f:
+        f.write(b"P5\n%d %d\n255\n" % (width, height))
+        for r in range(0, height, block):
+            f.write(np.ascontiguousarray(grid[r : r + block], dtype=np.uint8).tobytes())
+
+
 def build_transformation_matrix(x, y, z, alpha=None, beta=0.0, gamma=0.0, **kwargs):
 
     t = np.array([[x], [y], [z], [1]])
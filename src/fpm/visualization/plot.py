@@ -1,5 +1,6 @@
 import matplotlib.pyplot as plt
 from matplotlib.axes import Axes
+from matplotlib.collections import LineCollection, PatchCollection
 import numpy as np
 
 # colors = ("#FF6666", "#005533", "#1199EE")  # Colorblind-safe RGB
@@ -38,7 +39,7 @@ def plot_3d_frame(ax, matrix, name=None):
     )
 
 
-def plot_2d_robot(ax, matrix, width, length):
+def _robot_footprint(matrix, width, length, **kwargs):
     x_vector = get_vector_x_axis(matrix)
     x_vector = x_vector / np.linalg.norm(x_vector)
     if np.dot(x_vector, np.array([1.0, 0.0, 0.0])) == 0.0:
@@ -48,20 +49,28 @@ def plot_2d_robot(ax, matrix, width, length):
 
     x = matrix[0, 3] - (width / 2)
     y = matrix[1, 3] - (length / 2)
+    return plt.Rectangle(
+        (x, y), width, length, rotation_point="center", angle=angle, **kwargs
+    )
+
+
+def plot_2d_robot(ax, matrix, width, length):
     ax.add_patch(
-        plt.Rectangle(
-            (x, y),
-            width,
-            length,
-            rotation_point="center",
-            angle=angle,
-            alpha=0.25,
-            fc="grey",
-            edgecolor="black",
+        _robot_footprint(
+            matrix, width, length, alpha=0.25, fc="grey", edgecolor="black"
         )
     )
 
 
+def plot_2d_robots(ax, matrices, width, length):
+    """Plot the footprint of a robot at several poses as a single collection"""
+    footprints = [_robot_footprint(m, width, length) for m in matrices]
+    robots = PatchCollection(
+        footprints, alpha=0.25, facecolor="grey", edgecolor="black"
+    )
+    return ax.add_collection(robots, autolim=False)
+
+
 def get_vector_x_axis(matrix):
     loc = np.array([matrix[:3, 3], matrix[:3, 3]])
     line = np.zeros((2, 3))
@@ -109,6 +118,36 @@ def plot_2d_frame(ax: Axes, matrix, name=None, label_axis=False):
         )
 
 
+def plot_2d_frames(ax: Axes, matrices, names=None):
+    """Plot several frames in 2D, with a single collection of lines for each axis
+
+    Returns the artists that were added, e.g. to remove them from the plot later
+    """
+    matrices = np.asarray(matrices, dtype=float).reshape(-1, 4, 4)
+    artists = list()
+    loc = matrices[:, :2, 3]
+    for i, c in enumerate(colors):
+        tip = loc + matrices[:, :2, i] * matrices[:, 3, 3, np.newaxis]
+        lines = LineCollection(np.stack([loc, tip], axis=1), colors=c)
+        artists.append(ax.add_collection(lines, autolim=False))
+
+    for matrix, name in zip(matrices, names or []):
+        if name is None:
+            continue
+        artists.append(
+            ax.text(
+                matrix[0, 3],
+                matrix[1, 3],
+                name,
+                color="k",
+                va="bottom",
+                ha="center",
+                fontsize="xx-small",
+            )
+        )
+    return artists
+
+
 if __name__ == "__main__":
 
     m1 = np.array(
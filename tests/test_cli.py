@@ -0,0 +1,110 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import pytest
+import rdflib
+from click.testing import CliRunner
+from rdflib import RDF
+
+from fpm import cli
+from fpm.cli import PIPELINE_TARGETS, _get_batch_model_names, floorplan, generate
+from fpm.constants import FP
+
+
+def test_batch_model_names_are_unique():
+    model_paths = [
+        os.path.join("models", "a", "house.fpm"),
+        os.path.join("models", "b", "house.fpm"),
+        os.path.join("models", "b", "flat.fpm"),
+    ]
+    names = _get_batch_model_names(model_paths)
+
+    assert names == {
+        model_paths[0]: os.path.join("a", "house"),
+        model_paths[1]: os.path.join("b", "house"),
+        model_paths[2]: "flat",
+    }
+
+
+@pytest.fixture
+def floorplan_calls(monkeypatch):
+    calls = list()
+    monkeypatch.setattr(
+        floorplan, "main", lambda args, standalone_mode: calls.append(args)
+    )
+    return calls
+
+
+def test_batch_process_model(tmp_path, floorplan_calls):
+    output_path = cli._batch_process_model(
+        "house.fpm", str(tmp_path), ["mesh", "tasks"], model_name="a/house", prov=True
+    )
+    jsonld_path = os.path.join(output_path, "json-ld")
+
+    assert output_path == os.path.join(str(tmp_path), "a/house")
+    assert os.path.isdir(jsonld_path)
+    assert floorplan_calls == [
+        ["transform", "-m", "house.fpm", "-o", jsonld_path, "--prov"],
+        ["generate", "-i", jsonld_path, "-o", output_path, "-j", "1", "--prov"]
+        + ["all", "-t", "mesh", "-t", "tasks"],
+    ]
+
+
+def test_batch_reports_failed_models(tmp_path, monkeypatch):
+    for folder in ("a", "b"):
+        os.makedirs(tmp_path / folder)
+        (tmp_path / folder / "house.fpm").touch()
+    (tmp_path / "b" / "flat.fpm").touch()
+
+    processed = dict()
+
+    def process_model(model_path, output_path, targets, model_name=None, **kwargs):
+        processed[model_name] = kwargs["model_base_iri"]
+        if model_name == "flat":
+            raise ValueError("Invalid model")
+
+    monkeypatch.setattr(cli, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(cli, "_batch_process_model", process_model)
+    models = [str(tmp_path / "a"), str(tmp_path / "b")]
+    result = CliRunner().invoke(
+        floorplan, ["batch", "-m", models[0], "-m", models[1], "-o", str(tmp_path)]
+    )
+
+    assert result.exit_code == 1
+    assert "1 of 3 models failed" in result.output
+    assert processed == dict.fromkeys(
+        [os.path.join("a", "house"), os.path.join("b", "house"), "flat"],
+        "https://secorolab.github.io/models/floorplan/",
+    )
+
+
+def test_generate_all_runs_every_target(tmp_path, monkeypatch):
+    house = rdflib.URIRef("https://example.org/models/test/house")
+    g = rdflib.Graph()
+    g.bind("test", "https://example.org/models/test/")
+    g.add((house, RDF.type, FP["FloorPlan"]))
+    g.add((house, FP["spaces"], RDF.nil))
+    monkeypatch.setattr(cli, "build_graph_from_directory", lambda *args, **kwargs: g)
+
+    invoked = list()
+    for target in PIPELINE_TARGETS:
+
+        def callback(target=target, **kwargs):
+            ctx = click.get_current_context()
+            invoked.append((target, ctx.obj["model_name"], kwargs))
+            if target == "occ-grid":
+                raise ValueError("No spaces")
+
+        monkeypatch.setattr(generate.commands[target], "callback", callback)
+
+    result = CliRunner().invoke(
+        floorplan, ["generate", "-i", str(tmp_path), "-o", str(tmp_path), "all"]
+    )
+
+    assert result.exit_code == 1
+    assert "Failed to generate: occ-grid" in result.output
+    assert [target for target, _, _ in invoked] == PIPELINE_TARGETS
+    assert {model_name for _, model_name, _ in invoked} == {"house"}
+    # The targets run with the defaults of their own options
+    assert invoked[0][2]["backend"] == "blender"
@@ -0,0 +1,149 @@
+import json
+
+import pytest
+import rdflib
+from pyld import jsonld
+from rdflib import RDF, BNode, Literal
+from rdflib.collection import Collection
+from rdflib.compare import isomorphic
+
+from fpm.compaction import compact_graph, compact_nodes, get_term_map
+from fpm.constants import COORD, FP, POLY, QUDT, QUDT_VOCAB
+from fpm.contexts import METAMODEL_CONTEXTS, ContextNotFoundError, get_jsonld_options
+
+EX = rdflib.Namespace("http://example.org/")
+
+CONTEXT = {
+    "@context": {
+        "@vocab": "http://example.org/",
+        "ex": "http://example.org/",
+        "ref": {"@id": "ex:ref", "@type": "@id"},
+        "kind": {"@id": "ex:kind", "@type": "@vocab"},
+        "count": {
+            "@id": "ex:count",
+            "@type": "http://www.w3.org/2001/XMLSchema#integer",
+        },
+        "points": {"@id": "ex:points", "@container": "@list", "@type": "@id"},
+        "frames": {"@id": "ex:frames", "@container": "@set"},
+    }
+}
+
+
+# Contexts scoped to types and properties, which pyld compacts
+SCOPED_CONTEXT = {
+    "@context": [
+        CONTEXT["@context"],
+        {
+            "Element": {
+                "@id": "ex:Element",
+                "@context": {"ref": {"@id": "ex:ref", "@type": "@vocab"}},
+            },
+            "frames": {
+                "@id": "ex:frames",
+                "@container": "@set",
+                "@context": {"count": "ex:count"},
+            },
+        },
+    ]
+}
+
+# The metamodel contexts are fetched into the user cache when they are not in the
+# context store, and only skipped if that fails (without network access)
+with_contexts = pytest.mark.parametrize(
+    "context",
+    [
+        CONTEXT,
+        SCOPED_CONTEXT,
+        {"@context": METAMODEL_CONTEXTS + [CONTEXT["@context"]]},
+    ],
+    ids=["inline", "scoped", "metamodels"],
+    indirect=True,
+)
+
+
+@pytest.fixture
+def context(request):
+    try:
+        get_term_map(request.param)
+    except ContextNotFoundError as e:
+        pytest.skip(str(e))
+    return request.param
+
+
+def build_graph(size=6):
+    """Graph with several types and values per node, blank nodes and RDF lists
+
+    The types and values are added out of order, and RDF lists only hold IRIs:
+    rdflib writes lists of literals as rdf:first/rdf:rest nodes.
+    """
+    g = rdflib.Graph()
+    types = [FP["Wall"], FP["Space"], COORD["PoseReference"], EX["Element"]]
+    for i in range(size):
+        s = EX["node-{}".format(size - i)]
+        for t in types[: i % len(types) + 1][::-1]:
+            g.add((s, RDF.type, t))
+        g.add((s, EX["name"], Literal("node {}".format(i))))
+        g.add((s, EX["count"], Literal(i)))
+        g.add((s, EX["length"], Literal(i + 0.5)))
+        g.add((s, EX["label"], Literal("node", lang="en")))
+        g.add((s, EX["kind"], EX["kind-{}".format(i % 2)]))
+        g.add((s, QUDT["unit"], QUDT_VOCAB["M"]))
+        g.add((s, COORD["as-seen-by"], EX["node-{}".format(i % size + 1)]))
+        for j in (2, 1):
+            g.add((s, EX["ref"], EX["node-{}".format((i + j) % size + 1)]))
+            g.add((s, FP["walls"], EX["node-{}".format((i + j) % size + 1)]))
+
+        frame = BNode()
+        g.add((s, EX["frames"], frame))
+        g.add((frame, EX["count"], Literal(i)))
+
+        for p in (EX["points"], POLY["points"]):
+            points = BNode()
+            Collection(g, points, [EX["node-{}".format(j + 1)] for j in range(i)])
+            g.add((s, p, points))
+    return g
+
+
+def pyld_compact(document, context):
+    compacted = jsonld.compact(document, context, get_jsonld_options())
+    compacted.get("@graph", []).sort(key=lambda node: node["@id"])
+    return compacted
+
+
+def to_graph(document):
+    options = get_jsonld_options(format="application/n-quads")
+    return rdflib.Graph().parse(data=jsonld.to_rdf(document, options), format="nt")
+
+
+@with_contexts
+def test_compact_graph_matches_pyld(context):
+    g = build_graph()
+    expected = pyld_compact(json.loads(g.serialize(format="json-ld")), context)
+    compacted = compact_graph(g, context)
+
+    assert isomorphic(to_graph(compacted), g)
+    assert compacted == expected
+
+
+@with_contexts
+def test_compact_nodes_matches_pyld(context):
+    nodes = [
+        {
+            "@id": "ex:node-{}".format(i),
+            "@type": ["ex:Wall", "ex:Element"][: i % 2 + 1],
+            "count": i,
+            "ref": ["ex:node-{}".format((i + 1) % 4), "ex:node-{}".format(i)],
+            "points": ["ex:node-{}".format(j) for j in range(i)],
+            "frames": [{"count": i, "kind": "Frame"}],
+        }
+        for i in (3, 0, 2, 1)
+    ]
+    # Types of a node written twice are merged
+    nodes.append({"@id": "ex:node-2", "@type": "ex:Beam", "ref": "ex:node-0"})
+    document = {"@graph": nodes, "@context": context["@context"]}
+    flattened = jsonld.flatten(document, None, get_jsonld_options())
+    expected = pyld_compact(flattened, context)
+    compacted = compact_nodes(nodes, context)
+
+    assert isomorphic(to_graph(compacted), to_graph(document))
+    assert compacted == expected
@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+import rdflib
+from rdflib import RDF, BNode, Literal
+from rdflib.collection import Collection
+
+from fpm import graph
+from fpm.constants import COORD, FP, GEO, GEOM, POLY, QUDT, QUDT_VOCAB
+from fpm.geometry import extract_geometry, get_geometry_model
+
+EX = rdflib.Namespace("https://example.org/models/test/")
+
+
+def add_list(g, items):
+    head = BNode()
+    Collection(g, head, items)
+    return head
+
+
+def add_frame(g, name, wrt, x=0.0, y=0.0, alpha=0.0):
+    g.add((EX[name], RDF.type, GEO["Frame"]))
+    pose = EX["pose-" + name]
+    g.add((pose, RDF.type, GEOM["Pose"]))
+    g.add((pose, GEOM["of"], EX[name]))
+    g.add((pose, GEOM["with-respect-to"], EX[wrt]))
+    coord = EX["coord-" + name]
+    g.add((coord, RDF.type, COORD["PoseCoordinate"]))
+    g.add((coord, RDF.type, COORD["PoseReference"]))
+    g.add((coord, COORD["of-pose"], pose))
+    g.add((coord, COORD["as-seen-by"], EX[wrt]))
+    g.add((coord, QUDT["unit"], QUDT_VOCAB["M"]))
+    for key, value in zip(("x", "y", "z", "alpha"), (x, y, 0.0, alpha)):
+        g.add((coord, COORD[key], Literal(float(value))))
+
+
+def add_points(g, name, frame, coordinates):
+    points = list()
+    for i, (x, y, z) in enumerate(coordinates):
+        point = EX["{}-point-{}".format(name, i)]
+        g.add((point, RDF.type, GEO["Point"]))
+        position = EX["position-{}-{}".format(name, i)]
+        g.add((position, GEOM["of"], point))
+        coord = EX["coord-{}-{}".format(name, i)]
+        g.add((coord, COORD["of-position"], position))
+        g.add((coord, COORD["as-seen-by"], EX[frame]))
+        g.add((coord, QUDT["unit"], QUDT_VOCAB["M"]))
+        for key, value in zip("xyz", (x, y, z)):
+            g.add((coord, COORD[key], Literal(float(value))))
+        points.append(point)
+    return points
+
+
+def add_element(g, name, element_type, frame, length, width, height):
+    """Element with a rectangle shape and a box 3d-shape in its frame"""
+    e = EX[name]
+    g.add((e, RDF.type, FP[element_type]))
+    g.add((e, QUDT["unit"], QUDT_VOCAB["M"]))
+    g.add((e, FP["height"], Literal(float(height))))
+
+    corners = [(0, 0), (length, 0), (length, width), (0, width)]
+    polygon = EX[name + "-polygon"]
+    points = add_points(g, name + "-polygon", frame, [(x, y, 0) for x, y in corners])
+    g.add((polygon, POLY["points"], add_list(g, points)))
+    g.add((e, FP["shape"], polygon))
+
+    coordinates = [(x, y, z) for z in (0, height) for x, y in corners]
+    points = add_points(g, name + "-polyhedron", frame, coordinates)
+    bottom, top = points[:4], points[4:]
+    faces = [bottom, top]
+    for i in range(4):
+        j = (i + 1) % 4
+        faces.append([bottom[i], bottom[j], top[j], top[i]])
+    polyhedron = EX[name + "-polyhedron"]
+    g.add((polyhedron, RDF.type, POLY["Polyhedron"]))
+    g.add((polyhedron, POLY["points"], add_list(g, points)))
+    g.add((polyhedron, POLY["faces"], add_list(g, [add_list(g, f) for f in faces])))
+    g.add((e, FP["3d-shape"], polyhedron))
+    return e
+
+
+def build_graph(n_spaces=2):
+    """Floorplan with rotated spaces, walls, columns and entryways in a frame tree"""
+    g = rdflib.Graph()
+    g.bind("test", EX)
+    g.add((EX["world-frame"], RDF.type, GEO["Frame"]))
+    spaces = list()
+    for s in range(n_spaces):
+        space = "space-{}".format(s)
+        add_frame(g, space + "-frame", "world-frame", x=5.0 * s, y=1.0, alpha=10.0 * s)
+        spaces.append(add_element(g, space, "Space", space + "-frame", 4, 4, 3))
+
+        walls = list()
+        for w in range(2):
+            wall = "{}-wall-{}".format(space, w)
+            wrt = space + "-frame" if w == 0 else "{}-wall-0-frame".format(space)
+            add_frame(
+                g, wall + "-frame", wrt, x=0.0 if w else -2.0, y=4.0 * w, alpha=1.2
+            )
+            walls.append(add_element(g, wall, "Wall", wall + "-frame", 4, 0.2, 2.5))
+        g.add((EX[space], FP["walls"], add_list(g, walls)))
+
+        column = space + "-column"
+        add_frame(g, column + "-frame", space + "-wall-1-frame", 0.5, 0.5, 0.3)
+        add_element(g, column, "Column", column + "-frame", 0.3, 0.3, 2.5)
+
+        entryway = space + "-entryway"
+        add_frame(g, entryway + "-frame", space + "-wall-0-frame", x=1.0)
+        e = add_element(g, entryway, "Entryway", entryway + "-frame", 1, 0.2, 2)
+        g.add((e, FP["voids"], add_list(g, [walls[0]])))
+
+    floorplan = EX["test-floorplan"]
+    g.add((floorplan, RDF.type, FP["FloorPlan"]))
+    g.add((floorplan, FP["spaces"], add_list(g, spaces)))
+    return g
+
+
+def sorted_by_name(elements):
+    return sorted(elements, key=lambda e: e["name"])
+
+
+@pytest.mark.parametrize("element_type", ["Wall", "Column", "Entryway"])
+def test_3d_structure_matches_graph(element_type):
+    g = build_graph()
+    expected = sorted_by_name(graph.get_3d_structure(g, element_type))
+    structure = sorted_by_name(get_geometry_model(g).get_3d_structure(element_type))
+
+    assert len(structure) == len(expected) > 0
+    for e, x in zip(structure, expected):
+        assert e["name"] == x["name"]
+        assert e["faces"] == x["faces"]
+        assert e.get("voids") == x.get("voids")
+        assert np.allclose(e["vertices"], x["vertices"])
+
+
+def test_internal_walls_match_graph():
+    g = build_graph()
+    expected = graph.get_internal_walls(g)
+    internal_walls = get_geometry_model(g).get_internal_walls()
+
+    assert internal_walls.keys() == expected.keys()
+    for space, walls in expected.items():
+        assert internal_walls[space].keys() == walls.keys()
+        for wall, planes in walls.items():
+            assert len(planes) == 1
+            assert np.allclose(internal_walls[space][wall], planes)
+
+
+def test_space_polygons_match_graph():
+    g = build_graph()
+    model = extract_geometry(g)
+    coordinates_map = graph.get_coordinates_map(g)
+    spaces = graph.get_space_points(g)
+
+    assert [e.name for e in model.get_elements("Space")] == ["space-0", "space-1"]
+    for element, space in zip(model.get_elements("Space"), spaces):
+        expected = graph.get_waypoint_coord_array(g, space["points"], coordinates_map)
+        assert np.allclose(model.get_polygon_coord_array(element), expected)
+
+
+def test_geometry_model_is_cached_with_graph():
+    g = build_graph()
+    model = get_geometry_model(g)
+
+    assert get_geometry_model(g) is model
+    g.remove((EX["space-1-column"], None, None))
+    assert get_geometry_model(g) is not model
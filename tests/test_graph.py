@@ -0,0 +1,67 @@
+import json
+
+import pytest
+import rdflib
+from rdflib import RDF
+from rdflib.collection import Collection
+
+from fpm.graph import _parse_graph_from_directory, get_graph_cache, get_list_index
+
+# Prefixes that clash across the models and with the namespaces bound by rdflib
+CONTEXTS = [
+    {"fp": "http://example.org/a/", "x": "http://example.org/x/"},
+    {"fp": "http://example.org/b/", "schema": "http://example.org/schema/"},
+    {"fp1": "http://example.org/c/", "schema1": "http://example.org/s1/"},
+    {"fp": "http://example.org/d/", "schema": "http://example.org/schema2/"},
+    {"@vocab": "http://example.org/v/", "fp2": "http://example.org/a/"},
+]
+
+
+@pytest.fixture
+def models_path(tmp_path):
+    for i, context in enumerate(CONTEXTS):
+        model = {
+            "@context": context,
+            "@id": "http://example.org/models/{}".format(i),
+            "http://example.org/value": i,
+        }
+        with open(tmp_path / "model-{}.json".format(i), "w") as f:
+            json.dump(model, f)
+    return tmp_path
+
+
+def test_parallel_parse_matches_serial(models_path):
+    serial = _parse_graph_from_directory([str(models_path)], workers=1)
+    parallel = _parse_graph_from_directory([str(models_path)], workers=2)
+
+    assert list(parallel.namespaces()) == list(serial.namespaces())
+    assert set(parallel) == set(serial)
+
+
+def test_parse_is_serial_by_default(models_path, monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("Parsed in a process pool")
+
+    monkeypatch.setattr("fpm.graph.ProcessPoolExecutor", no_pool)
+    g = _parse_graph_from_directory([str(models_path)])
+
+    assert len(g) == len(CONTEXTS)
+
+
+def test_graph_cache_is_cleared_on_removal():
+    g = rdflib.Graph()
+    items = [rdflib.URIRef("http://example.org/{}".format(i)) for i in range(3)]
+    head = rdflib.BNode()
+    Collection(g, head, items)
+    assert get_list_index(g)[head][0] == items[0]
+
+    g.remove((head, RDF.first, None))
+    g.add((head, RDF.first, items[2]))
+    assert get_list_index(g)[head][0] == items[2]
+
+    g.remove((head, RDF.first, None))
+    assert head not in get_list_index(g)
+
+    get_graph_cache(g)["derived"] = True
+    g.remove((None, RDF.rest, None))
+    assert "derived" not in get_graph_cache(g)
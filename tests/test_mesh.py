@@ -0,0 +1,145 @@
+import json
+import struct
+
+import numpy as np
+
+from fpm.transformations.mesh import (
+    build_meshes,
+    save_gltf,
+    save_stl,
+    subtract_box_openings,
+    triangulate,
+)
+
+BOX_FACES = [
+    [0, 3, 2, 1],
+    [4, 5, 6, 7],
+    [0, 1, 5, 4],
+    [1, 2, 6, 5],
+    [2, 3, 7, 6],
+    [3, 0, 4, 7],
+]
+
+
+def box(x0, x1, y0, y1, z0, z1):
+    return np.array(
+        [
+            [x0, y0, z0],
+            [x1, y0, z0],
+            [x1, y1, z0],
+            [x0, y1, z0],
+            [x0, y0, z1],
+            [x1, y0, z1],
+            [x1, y1, z1],
+            [x0, y1, z1],
+        ]
+    )
+
+
+def mesh_volume(vertices, triangles):
+    v0, v1, v2 = (vertices[triangles[:, i]] for i in range(3))
+    return np.einsum("ij,ij->i", v0, np.cross(v1, v2)).sum() / 6
+
+
+def wall_elements():
+    wall = box(0, 4, 0, 0.2, 0, 3)
+    door = box(1, 2, -0.1, 0.3, 0, 2)
+    return {
+        "walls": [
+            {"name": "wall", "vertices": wall.tolist(), "faces": BOX_FACES},
+            {"name": "other", "vertices": (wall + 5).tolist(), "faces": BOX_FACES},
+        ],
+        "entryways": [{"name": "door", "vertices": door.tolist(), "voids": ["wall"]}],
+    }
+
+
+def test_triangulate():
+    vertices = box(0, 4, 0, 0.2, 0, 3)
+    # Faces with mixed orientations are made consistent
+    faces = [f if i % 2 else f[::-1] for i, f in enumerate(BOX_FACES)]
+    triangles = triangulate(vertices, faces)
+
+    assert triangles.shape == (12, 3)
+    assert np.isclose(mesh_volume(vertices, triangles), 4 * 0.2 * 3)
+
+
+def test_build_meshes():
+    meshes = build_meshes(wall_elements())
+
+    assert [name for name, _, _ in meshes] == ["wall", "other"]
+    assert np.isclose(mesh_volume(*meshes[0][1:]), (12 - 2) * 0.2)
+    assert np.isclose(mesh_volume(*meshes[1][1:]), 12 * 0.2)
+
+
+def test_build_meshes_reuses_cache():
+    cache = dict()
+    previous = build_meshes(wall_elements(), cache)
+    elements = wall_elements()
+    elements["walls"][1]["vertices"] = (box(0, 4, 0, 0.2, 0, 3) + 6).tolist()
+    meshes = build_meshes(elements, cache)
+
+    assert meshes[0][2] is previous[0][2]
+    assert meshes[1][2] is not previous[1][2]
+    assert np.allclose(meshes[1][1], elements["walls"][1]["vertices"])
+    assert len(cache) == 2
+
+
+def test_save_stl(tmp_path):
+    meshes = build_meshes(wall_elements())
+    save_stl(meshes, str(tmp_path / "mesh.stl"))
+    with open(tmp_path / "mesh.stl", "rb") as f:
+        content = f.read()
+
+    (count,) = struct.unpack("<I", content[80:84])
+    records = np.frombuffer(
+        content[84:],
+        dtype=[("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attr", "<u2")],
+    )
+    triangles = np.concatenate([v[t] for _, v, t in meshes])
+
+    assert count == len(records) == len(triangles)
+    assert np.allclose(records["vertices"], triangles, atol=1e-6)
+    assert np.allclose(np.linalg.norm(records["normal"], axis=1), 1)
+
+
+def test_save_gltf(tmp_path):
+    meshes = build_meshes(wall_elements())
+    save_gltf(meshes, str(tmp_path / "mesh.glb"))
+    with open(tmp_path / "mesh.glb", "rb") as f:
+        content = f.read()
+
+    magic, version, length = struct.unpack("<III", content[:12])
+    json_length, _ = struct.unpack("<II", content[12:20])
+    doc = json.loads(content[20 : 20 + json_length])
+    buffer = content[28 + json_length :]
+
+    assert (magic, version, length) == (0x46546C67, 2, len(content))
+    assert [node["name"] for node in doc["nodes"]] == ["wall", "other"]
+    for i, (_, vertices, triangles) in enumerate(meshes):
+        positions, indices = (doc["accessors"][j] for j in (2 * i, 2 * i + 1))
+        views = [doc["bufferViews"][a["bufferView"]] for a in (positions, indices)]
+        data = [buffer[v["byteOffset"] :][: v["byteLength"]] for v in views]
+        positions = np.frombuffer(data[0], dtype=np.float32).reshape(-1, 3)
+        indices = np.frombuffer(data[1], dtype=np.uint32).reshape(-1, 3)
+
+        # glTF is Y-up
+        assert np.allclose(positions[:, [0, 2]], vertices[:, :2] * [1, -1])
+        assert np.allclose(positions[:, 1], vertices[:, 2])
+        assert np.array_equal(indices, triangles)
+
+
+def test_subtract_box_openings():
+    wall = box(0, 4, 0, 0.2, 0, 3)
+    door = box(1, 2, -0.1, 0.3, 0, 2)
+    window = box(2.5, 3.5, -0.1, 0.3, 1, 2)
+    vertices, triangles = subtract_box_openings(wall, BOX_FACES, [door, window])
+
+    assert np.isclose(mesh_volume(vertices, triangles), (12 - 2 - 1) * 0.2)
+
+
+def test_subtract_box_openings_rejects_other_polyhedra():
+    wall = box(0, 4, 0, 0.2, 0, 3)
+    # Triangular prism with all its vertices on the corners of its bounding box
+    prism = box(1, 2, -0.1, 0.3, 0, 2)[[0, 1, 2, 4, 5, 6]]
+
+    assert subtract_box_openings(wall, BOX_FACES, [prism]) is None
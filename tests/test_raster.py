@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from fpm.raster import distance_transform, fill_polygons
+
+
+def brute_force_distance(mask):
+    cells = np.argwhere(mask)
+    if len(cells) == 0:
+        return np.full(mask.shape, np.inf)
+    rows, cols = np.indices(mask.shape)
+    d = (rows[..., None] - cells[:, 0]) ** 2 + (cols[..., None] - cells[:, 1]) ** 2
+    return np.sqrt(d.min(axis=-1))
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_distance_transform_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    shape = tuple(rng.integers(1, 40, size=2))
+    mask = rng.random(shape) < rng.uniform(0.0, 0.2)
+
+    np.testing.assert_allclose(distance_transform(mask), brute_force_distance(mask))
+
+
+def pil_fill_polygons(shape, polygons, fill):
+    im = Image.new("L", shape[::-1], 0)
+    draw = ImageDraw.Draw(im)
+    for polygon in polygons:
+        draw.polygon(polygon.flatten().tolist(), fill=fill, outline=None, width=1)
+    return np.asarray(im)
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_fill_polygons_matches_pil(seed):
+    rng = np.random.default_rng(seed)
+    shape = tuple(rng.integers(5, 60, size=2))
+    # Quads partly outside the grid, self-intersecting ones included
+    polygons = [
+        rng.integers(-10, max(shape) + 10, size=(4, 2))
+        for _ in range(rng.integers(1, 4))
+    ]
+    grid = fill_polygons(np.zeros(shape, dtype=np.uint8), polygons, 255)
+
+    np.testing.assert_array_equal(grid, pil_fill_polygons(shape, polygons, 255))
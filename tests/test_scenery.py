@@ -0,0 +1,147 @@
+import pytest
+import rdflib
+from rdflib import RDF, BNode, Literal
+from rdflib.collection import Collection
+from rdflib.namespace import XSD
+
+pytest.importorskip("ifcld")
+
+from ifcld.interpreters.namespaces import IFC_CONCEPTS as IFC  # noqa: E402
+
+from fpm.generators import scenery  # noqa: E402
+
+EX = rdflib.Namespace("https://example.org/ifc-model/")
+
+
+def add_numbers(g, values):
+    """List of numbers, with the doubles written as strings like the IFC graphs"""
+    head = BNode()
+    numbers = [
+        Literal(v) if isinstance(v, int) else Literal(str(v), datatype=XSD.double)
+        for v in values
+    ]
+    Collection(g, head, numbers)
+    return head
+
+
+def add_axis_placement(g, name, location, axis=None, ref_direction=None):
+    placement = EX[name]
+    g.add((placement, RDF.type, IFC["IFCAXIS2PLACEMENT3D"]))
+    g.add((placement, IFC["location"], EX[name + "-location"]))
+    g.add((EX[name + "-location"], IFC["coordinates"], add_numbers(g, location)))
+    for key, direction in (("axis", axis), ("refdirection", ref_direction)):
+        if direction is not None:
+            g.add((placement, IFC[key], EX[name + "-" + key]))
+            ratios = add_numbers(g, direction)
+            g.add((EX[name + "-" + key], IFC["directionratios"], ratios))
+    return placement
+
+
+def build_graph():
+    """IFC graph with a chain of placements, extruded solids and a face set"""
+    g = rdflib.Graph()
+    g.bind("ifc-model", EX)
+
+    previous = None
+    for i in range(4):
+        placement = EX["placement-{}".format(i)]
+        g.add((placement, RDF.type, IFC["IFCLOCALPLACEMENT"]))
+        if previous is not None:
+            g.add((placement, IFC["placementrelto"], previous))
+        location = [1.5 * i, i, 0.0] if i % 2 else [0.25, 2, -3.0]
+        axis = [0.0, 0.0, 1] if i != 1 else None
+        ref_direction = [1.0, 0.0, 0.0] if i != 2 else None
+        relative = add_axis_placement(
+            g, "axis-{}".format(i), location, axis, ref_direction
+        )
+        g.add((placement, IFC["relativeplacement"], relative))
+        previous = placement
+
+    solids = list()
+    for kind in ("polyline", "closed-polyline", "circle", "rectangle"):
+        solid = EX["solid-" + kind]
+        g.add((solid, IFC["depth"], Literal("2.5", datatype=XSD.double)))
+        position = add_axis_placement(g, "position-" + kind, [0.0, 0.0, 0.0])
+        g.add((solid, IFC["position"], position))
+        g.add((solid, IFC["extrudeddirection"], EX["direction-" + kind]))
+        direction = add_numbers(g, [0.0, 0.0, 1.0])
+        g.add((EX["direction-" + kind], IFC["directionratios"], direction))
+        area = EX["area-" + kind]
+        g.add((solid, IFC["sweptarea"], area))
+        if kind.endswith("polyline"):
+            g.add((area, RDF.type, IFC["IFCARBITRARYCLOSEDPROFILEDEF"]))
+            g.add((area, IFC["outercurve"], EX["curve-" + kind]))
+            g.add((EX["curve-" + kind], IFC["points"], EX["points-" + kind]))
+            n = 6 if kind.startswith("closed") else 5
+            coordinates = [add_numbers(g, [float(j), j * j / 3]) for j in range(n)]
+            head = BNode()
+            Collection(g, head, coordinates)
+            g.add((EX["points-" + kind], IFC["coordlist"], head))
+        elif kind == "circle":
+            g.add((area, RDF.type, IFC["IFCCIRCLEPROFILEDEF"]))
+            position = add_axis_placement(g, "circle-position", [0.3, 0.4])
+            g.add((area, IFC["position"], position))
+            g.add((area, IFC["radius"], Literal("0.125", datatype=XSD.double)))
+        else:
+            g.add((area, RDF.type, IFC["IFCRECTANGLEPROFILEDEF"]))
+            g.add((area, IFC["xdim"], Literal(0.3)))
+            g.add((area, IFC["ydim"], Literal(4)))
+        solids.append(solid)
+
+    face_set = EX["face-set"]
+    g.add((face_set, IFC["coordinates"], EX["face-set-coordinates"]))
+    points = [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 1.0, 0.0], [0.0, 1.0, 2.5]]
+    head = BNode()
+    Collection(g, head, [add_numbers(g, p) for p in points])
+    g.add((EX["face-set-coordinates"], IFC["coordlist"], head))
+    faces = list()
+    for i, indices in enumerate([[1, 2, 3], [1, 3, 4], [2, 3, 4]]):
+        face = EX["face-{}".format(i)]
+        g.add((face, IFC["coordindex"], add_numbers(g, indices)))
+        faces.append(face)
+    head = BNode()
+    Collection(g, head, faces)
+    g.add((face_set, IFC["faces"], head))
+    return g, solids, face_set
+
+
+def transform_ifc_nodes():
+    g, solids, face_set = build_graph()
+    nodes = scenery.query_ifc_local_placements(g, "M")
+    for i, solid in enumerate(solids):
+        element_id = "element-{}".format(i)
+        nodes.extend(
+            scenery.transform_extruded_area_solid(g, element_id, solid, "M", "parent")
+        )
+    nodes.extend(scenery.transform_polygonal_face_set(g, face_set, "parent", "M"))
+    nodes.extend(
+        scenery.transform_polygonal_face_set(g, face_set, "parent", "M", "placement")
+    )
+    nodes.extend(scenery.create_obj_placement(g, "object", "ref", EX["axis-0"], "MM"))
+    return nodes
+
+
+@pytest.fixture
+def ifc_templates():
+    yield scenery.use_ifc_templates
+    scenery.use_ifc_templates(False)
+
+
+def test_node_builders_match_templates(ifc_templates):
+    ifc_templates(True)
+    expected = transform_ifc_nodes()
+    ifc_templates(False)
+    nodes = transform_ifc_nodes()
+
+    assert len(nodes) == len(expected)
+    for node, x in zip(nodes, expected):
+        assert node == x
+
+
+def test_parallel_transform_matches_serial():
+    g, _, _ = build_graph()
+    expected = scenery.query_ifc_local_placements(g, "M")
+    with scenery.get_ifc_executor(g, workers=2) as executor:
+        nodes = scenery.query_ifc_local_placements(g, "M", executor)
+
+    assert nodes == expected